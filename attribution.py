@@ -0,0 +1,149 @@
+#attribution.py
+# Join stage between the two summaries: every object change is attributed to
+# the acquisition session that encloses it (same host, app and user, time
+# between session start and end). Both tables are sorted by time and joined
+# with a backward as-of join, a single sweep per host/app/user instead of
+# comparing every object with every session.
+import argparse
+from termcolor import colored
+
+from objects_vs_bookings import SESSION_COLUMNS, read_excel_cached
+
+KEYS: list[str] = ["host", "app", "user"]
+
+def attribute_objects(sessions, objects) -> dict:
+    """
+    Assigns each object (objects_summary.xlsx) to its session
+    (history_files_summary.xlsx), both given as polars DataFrames. Returns the
+    "Sessions" sheet, with the number of objects and of distinct userdirs of
+    every session, and the "Objects" sheet, with the session start/end of
+    every object (empty if no session encloses it).
+    """
+    import polars as pl
+    from manage_history_files import NAME_MAP
+
+    # the same session appears in every rotation of a history file, cut short
+    # in the rotations taken while it was running: keep the longest
+    sessions = (
+        sessions
+        .select(
+            *KEYS,
+            "file",
+            pl.col("date_start").cast(pl.Date).dt.combine(pl.col("start")).alias("session_start"),
+            pl.col("date_end").cast(pl.Date).dt.combine(pl.col("end")).alias("session_end"),
+        )
+        .drop_nulls(["host", "session_start", "session_end"])
+        .filter(pl.col("session_end") >= pl.col("session_start"))
+        .group_by([*KEYS, "session_start"], maintain_order=True)
+        .agg(pl.col("file").first(), pl.col("session_end").max())
+        .select(*KEYS, "file", "session_start", "session_end")
+        .sort("session_start")
+    )
+
+    # objects keep the host folder name, sessions the canonical one
+    objects = objects.with_columns(
+        pl.col("host").replace(NAME_MAP),
+        pl.col("date").cast(pl.Date).dt.combine(pl.col("time")).alias("datetime"),
+    )
+    dated = objects.filter(pl.col("datetime").is_not_null()).sort("datetime")
+    undated = objects.filter(pl.col("datetime").is_null())
+
+    # last session started before each object, then kept only if still open
+    attributed = (
+        dated.join_asof(
+            sessions.select(*KEYS, "session_start", "session_end"),
+            left_on="datetime",
+            right_on="session_start",
+            by=KEYS,
+            strategy="backward",
+            check_sortedness=False,  # both sorted above
+        )
+        .with_columns(
+            pl.when(pl.col("datetime") <= pl.col("session_end")).then(pl.col(c)).otherwise(None).alias(c)
+            for c in ["session_start", "session_end"]
+        )
+    )
+    attributed = pl.concat([
+        attributed,
+        undated.with_columns(
+            pl.lit(None, dtype=attributed.schema["session_start"]).alias("session_start"),
+            pl.lit(None, dtype=attributed.schema["session_end"]).alias("session_end"),
+        ),
+    ]).drop("datetime")
+
+    counts = (
+        attributed
+        .drop_nulls("session_start")
+        .group_by([*KEYS, "session_start"])
+        .agg(
+            pl.len().alias("objects"),
+            pl.col("userdir").drop_nulls().n_unique().alias("userdirs"),
+        )
+    )
+    per_session = (
+        sessions
+        .join(counts, on=[*KEYS, "session_start"], how="left")
+        .with_columns(pl.col("objects", "userdirs").fill_null(0))
+        .sort("session_start", descending=True)
+    )
+
+    total = objects.height
+    found = attributed.filter(pl.col("session_start").is_not_null()).height
+    print(f"Objects attributed to a session: {found} of {total} ({100 * found / total if total else 0:.1f}%)")
+    print(f"Sessions with at least one object: {per_session.filter(pl.col('objects') > 0).height} of {per_session.height}")
+
+    return {
+        "Sessions": per_session,
+        "Objects": attributed.sort("session_start", "date", "time", descending=True, nulls_last=True),
+    }
+
+def write_attribution(attribution: dict, output_file: str = "sessions_objects.xlsx") -> None:
+    import pandas as pd
+
+    with pd.ExcelWriter(output_file, engine="openpyxl") as writer:
+        for sheet_name, df in attribution.items():
+            pd.DataFrame(df.to_dict(as_series=False)).to_excel(writer, index=False, sheet_name=sheet_name)
+            ws = writer.sheets[sheet_name]
+
+            # Map column names → desired Excel formats
+            formats = {
+                "date": "yyyy-mm-dd",
+                "time": "hh:mm:ss",
+                "session_start": "yyyy-mm-dd hh:mm:ss",
+                "session_end": "yyyy-mm-dd hh:mm:ss",
+            }
+
+            for col_name, col_idx in zip(df.columns, range(1, len(df.columns) + 1)):
+                if col_name in formats:
+                    fmt = formats[col_name]
+                    (col_cells,) = ws.iter_cols(min_col=col_idx, max_col=col_idx)
+                    for cell in col_cells:
+                        cell.number_format = fmt
+    print(f"{colored('[ OK  ]', 'green', attrs=['bold'])} Attribution written: {output_file}")
+
+def main(sessions_file: str = "history_files_summary.xlsx",
+         objects_file: str = "objects_summary.xlsx",
+         output_file: str = "sessions_objects.xlsx",
+         use_cache: bool = True) -> None:
+    sessions: dict = read_excel_cached(
+        sessions_file,
+        ["History"],
+        use_cache=use_cache,
+        columns=SESSION_COLUMNS,
+    )
+    objects: dict = read_excel_cached(objects_file, ["Objects"], use_cache=use_cache)
+    write_attribution(attribute_objects(sessions["History"], objects["Objects"]), output_file)
+
+def cli(argv: list[str]|None = None) -> None:
+    parser = argparse.ArgumentParser(description="Attribute every object change to its acquisition session")
+    parser.add_argument("--sessions", default="history_files_summary.xlsx", help="Sessions summary (from manage_history_files)")
+    parser.add_argument("--objects", default="objects_summary.xlsx", help="Objects summary (from objects)")
+    parser.add_argument("--output", default="sessions_objects.xlsx", help="Output workbook")
+    parser.add_argument("--no-cache", action="store_true", help="Always parse the Excel files, ignoring their sidecar cache")
+
+    args: argparse.Namespace = parser.parse_args(argv)
+
+    main(args.sessions, args.objects, args.output, use_cache=not args.no_cache)
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,151 @@
+#bench_query_service.py
+# Load test of query_service: a synthetic fleet of sessions and objects is
+# served on a free local port and hit by concurrent clients with a mix of
+# range/user/PI queries drawn from a small pool (as dashboards repeat the
+# same questions). Reports cold and cached latency, throughput, p50/p95 and
+# the cache hit rate, then touches a source file to check that the next
+# query reloads the data.
+import argparse
+import http.client
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from urllib.parse import urlencode
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import query_service
+from manage_history_files import NAME_MAP
+from objects_vs_bookings import PI_DIRS
+
+HOSTS = ["AV300", "AVNeo400", "AV600", "PHARMASCAN"]
+
+def synthetic_loader(sessions_per_host: int, seed: int):
+    """
+    Loader for QueryIndex returning sessions and objects records shaped like
+    the summaries: a session every few hours, objects inside the sessions.
+    """
+    rng = random.Random(seed)
+    users = [folder for dirs in PI_DIRS.values() for folder in dirs.values() if folder] + ["nmr", "guest"]
+
+    def load():
+        sessions: list[dict] = []
+        objects: list[dict] = []
+        for host in HOSTS:
+            t = datetime(2020, 1, 1)
+            for _ in range(sessions_per_host):
+                t += timedelta(minutes=rng.randint(30, 600))
+                end = t + timedelta(minutes=rng.randint(5, 240))
+                user = rng.choice(users)
+                # sessions carry the canonical host name, objects the folder one
+                sessions.append({
+                    "host": NAME_MAP[host], "app": "pv360", "user": user, "file": "history",
+                    "date_start": t.date(), "date_end": end.date(), "start": t.time(), "end": end.time(),
+                })
+                for k in range(rng.randint(0, 4)):
+                    when = t + (end - t) * (k + 1) / 5
+                    objects.append({
+                        "host": host, "app": "pv360", "user": "nmr", "userdir": user, "file": "history",
+                        "date": when.date(), "time": when.time().replace(microsecond=0), "object": f"study{k}",
+                    })
+                t = end
+        return sessions, objects
+    return load
+
+def query_pool(n: int, seed: int) -> list[str]:
+    rng = random.Random(seed)
+    pis = list(PI_DIRS)
+    pool: list[str] = []
+    for _ in range(n):
+        day = datetime(2020, 1, 1) + timedelta(days=rng.randint(0, 700))
+        params = {"from": day.date(), "to": (day + timedelta(days=rng.choice([0, 6, 30]))).date()}
+        if rng.random() < 0.7:
+            params["host"] = rng.choice(HOSTS)
+        if rng.random() < 0.3:
+            params["pi"] = rng.choice(pis)
+        pool.append(f"/{rng.choice(['sessions', 'objects'])}?{urlencode(params)}")
+    return pool
+
+def get(conn: http.client.HTTPConnection, path: str) -> tuple[float, bytes]:
+    t0 = time.perf_counter()
+    conn.request("GET", path)
+    res = conn.getresponse()
+    body = res.read()
+    if res.status != 200:
+        raise RuntimeError(f"{path}: HTTP {res.status} {body!r}")
+    return time.perf_counter() - t0, body
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=20000, help="Sessions per host")
+    parser.add_argument("--clients", type=int, default=8, help="Concurrent clients")
+    parser.add_argument("--requests", type=int, default=2000, help="Requests per client")
+    parser.add_argument("--pool", type=int, default=200, help="Distinct queries")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # stand-ins of the summaries: only their stat() is used, to detect changes
+        sources = [os.path.join(tmp, "history_files_summary.xlsx"), os.path.join(tmp, "objects_summary.xlsx")]
+        for path in sources:
+            Path(path).touch()
+
+        t0 = time.perf_counter()
+        index = query_service.QueryIndex(sources, synthetic_loader(args.sessions, args.seed))
+        index.refresh()
+        print(f"load: {len(HOSTS) * args.sessions} sessions indexed in {time.perf_counter() - t0:.2f} s")
+
+        server = query_service.make_server(index, port=0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        port = server.server_address[1]
+        pool = query_pool(args.pool, args.seed)
+
+        conn = http.client.HTTPConnection("127.0.0.1", port)
+        cold = [get(conn, path)[0] for path in pool]
+        cached = [get(conn, path)[0] for path in pool]
+        print(f"cold:   median {1000 * statistics.median(cold):.2f} ms, max {1000 * max(cold):.2f} ms")
+        print(f"cached: median {1000 * statistics.median(cached):.2f} ms, max {1000 * max(cached):.2f} ms")
+
+        latencies: list[float] = []
+        lock = threading.Lock()
+
+        def client(seed: int) -> None:
+            rng = random.Random(seed)
+            c = http.client.HTTPConnection("127.0.0.1", port)
+            local = [get(c, rng.choice(pool))[0] for _ in range(args.requests)]
+            c.close()
+            with lock:
+                latencies.extend(local)
+
+        t0 = time.perf_counter()
+        threads = [threading.Thread(target=client, args=(args.seed + i,)) for i in range(args.clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - t0
+        latencies.sort()
+        stats = json.loads(get(conn, "/stats")[1])
+        print(f"load:   {len(latencies)} requests from {args.clients} clients in {elapsed:.2f} s ({len(latencies) / elapsed:.0f} req/s)")
+        print(f"        p50 {1000 * latencies[len(latencies) // 2]:.2f} ms, p95 {1000 * latencies[int(len(latencies) * 0.95)]:.2f} ms")
+        print(f"cache:  {stats['hits']} hits, {stats['misses']} misses ({100 * stats['hits'] / (stats['hits'] + stats['misses']):.1f}% hit rate)")
+
+        # a new summary invalidates the cache: the next query reloads
+        os.utime(sources[0], ns=(time.time_ns(), time.time_ns() + 1_000_000_000))
+        reload_time, _ = get(conn, pool[0])
+        stats = json.loads(get(conn, "/stats")[1])
+        print(f"invalidation: first query after the change {1000 * reload_time:.0f} ms (reload), cache now {stats['cached']} entries")
+
+        conn.close()
+        server.shutdown()
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+#bench_startup.py
+# Measures the start-up time of the command line entry points: each command
+# is run in a fresh interpreter, repeated, and the best/median wall times
+# are reported together with the heaviest imports (python -X importtime).
+import argparse
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+COMMANDS: list[list[str]] = [
+    ["-c", "pass"],                                 # bare interpreter, reference
+    ["cli.py", "--help"],
+    ["cli.py", "sessions", "--help"],
+    ["cli.py", "objects", "--help"],
+    ["cli.py", "sync", "--help"],
+    ["cli.py", "match", "--help"],
+    ["cli.py", "match", "--start", "not-a-date"],
+    ["-c", "import pandas"],                        # what a lazy import saves
+    ["-c", "import polars"],
+]
+
+def run_once(args: list[str]) -> float:
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, *args], cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - t0
+
+def top_imports(args: list[str], n: int) -> list[tuple[int, str]]:
+    res = subprocess.run([sys.executable, "-X", "importtime", *args], cwd=ROOT, capture_output=True, text=True)
+    imports: list[tuple[int, str]] = []
+    for line in res.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        fields = [f.strip() for f in line[len("import time:"):].split("|")]
+        if len(fields) == 3 and fields[2] == fields[2].lstrip():
+            imports.append((int(fields[1]), fields[2]))
+    return sorted(imports, reverse=True)[:n]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per command")
+    parser.add_argument("--top", type=int, default=3, help="Heaviest top-level imports shown per command")
+    args = parser.parse_args()
+
+    print(f"{'command':<45} {'best [ms]':>10} {'median [ms]':>12}   heaviest imports")
+    for command in COMMANDS:
+        times = [run_once(command) for _ in range(args.repeat)]
+        imports = ", ".join(f"{name} {us / 1000:.0f}ms" for us, name in top_imports(command, args.top))
+        print(f"{' '.join(command):<45} {1000 * min(times):>10.1f} {1000 * statistics.median(times):>12.1f}   {imports}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#check_archive_roundtrip.py
+# Round trip of the chunk archive on a temporary tree: a plain history file
+# and its .gz/.zst rotations are ingested and read back with open_archived,
+# byte for byte equal to their decompressed content. Also checks that:
+#   - files that are not history files (summaries, temporary files) are not archived
+#   - a file rewritten with the same mtime but another size is archived again
+#   - a rotation removed from disk is dropped from the archive
+# Exits with status 1 if a check fails. The .zst rotation needs zstandard.
+import contextlib
+import gzip
+import io
+import os
+import random
+import sys
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from chunkstore import archived_files, ingest, load_manifest, open_archived
+from compression import zstandard
+
+def history_text(rng: random.Random, lines: int) -> bytes:
+    return "".join(
+        f"2024-03-{rng.randint(1, 28):02} {rng.randint(0, 23):02}:{rng.randint(0, 59):02}:00 study{rng.randint(0, 999)} line {i}\n"
+        for i in range(lines)
+    ).encode("utf-8")
+
+def main():
+    rng = random.Random(1)
+    failures: list[str] = []
+
+    def check(ok: bool, what: str) -> None:
+        print(f"{'ok  ' if ok else 'FAIL'} {what}")
+        if not ok:
+            failures.append(what)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base = Path(tmp) / "j"
+        user_dir = base / "AV300_history-files" / "PV6.0.1" / "prog" / "curdir" / "nmr"
+        user_dir.mkdir(parents=True)
+        archive = Path(tmp) / "archive"
+
+        contents: dict[str, bytes] = {"history": history_text(rng, 20000), "history.1": history_text(rng, 20000)}
+        (user_dir / "history").write_bytes(contents["history"])
+        with gzip.open(user_dir / "history.1.gz", "wb") as f:
+            f.write(contents["history.1"])
+        if zstandard is not None:
+            contents["history.2"] = history_text(rng, 20000)
+            (user_dir / "history.2.zst").write_bytes(zstandard.ZstdCompressor().compress(contents["history.2"]))
+        else:
+            print("skip .zst rotation: zstandard is not installed")
+        (user_dir / "history_files_summary.xlsx").write_bytes(b"not a history file")
+        (user_dir / ".history.tmp").write_bytes(b"partial write")
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            ingest(archive, [str(base)])
+        archived = sorted(Path(p).name for p in archived_files(archive))
+        check(archived == sorted(contents), f"archived {archived}")
+        for name, data in contents.items():
+            with open_archived(archive, str(user_dir / name)) as f:
+                check(f.read() == data, f"{name} read back ({len(data)} bytes)")
+
+        # same mtime, other content and size
+        st = (user_dir / "history").stat()
+        contents["history"] += b"2024-03-29 10:00:00 one more line\n"
+        (user_dir / "history").write_bytes(contents["history"])
+        os.utime(user_dir / "history", ns=(st.st_atime_ns, st.st_mtime_ns))
+        with contextlib.redirect_stdout(io.StringIO()):
+            ingest(archive, [str(base)])
+        with open_archived(archive, str(user_dir / "history")) as f:
+            check(f.read() == contents["history"], "history rewritten within the same mtime archived again")
+
+        # the rotation is gone from disk
+        (user_dir / "history.1.gz").unlink()
+        with contextlib.redirect_stdout(io.StringIO()):
+            ingest(archive, [str(base)])
+        check(load_manifest(archive, str(user_dir / "history.1")) is None, "removed history.1 dropped from the archive")
+        check(str(user_dir / "history.1") not in archived_files(archive), "archived_files no longer lists history.1")
+
+    sys.exit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+#check_finalize_sessions.py
+# Equivalence check of the vectorized session finalization: random session
+# buffers (dates and times in and out of range, leap days, sessions ending on
+# another day, durations written in h or s, or missing) go through
+# extract_fields + finalize_sessions and through the per-buffer extract_data
+# it replaced, kept below as the reference. Every tuple must be identical.
+# Exits with status 1 if any buffer differs.
+import argparse
+import contextlib
+import io
+import random
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import manage_history_files as m
+
+# --- reference: the per-buffer implementation, strptime/timedelta per record ---
+
+def calculate_duration(lines: list, date_start: str, start: str, end: str) -> list[str|None]:
+    new_date: str|None = None
+    for line in reversed(lines):
+        match_nd = m.date_time_start_pattern.search(line.rstrip())
+        if match_nd:
+            new_date = match_nd.group("date")
+            if new_date == date_start:
+                new_date = None
+            break
+    date_end: str = f"{new_date or date_start}, {end}"
+    duration_fmt = "%Y-%m-%d, %H:%M:%S"
+    try:
+        elapsed = datetime.strptime(date_end, duration_fmt) - datetime.strptime(f"{date_start}, {start}", duration_fmt)
+        hours, remainder = divmod(elapsed.total_seconds(), 3600)
+        minutes, seconds = divmod(remainder, 60)
+        return [date_end.split(",")[0], f"{int(hours):02}:{int(minutes):02}:{int(seconds):02} h"]
+    except ValueError:
+        return ["Error", "Error"]
+
+def normalize_time(value: str) -> str:
+    value = value.strip().lower()
+    if value.endswith("h"):
+        return value.replace(" h", "")
+    elif value.endswith("s"):
+        return str(timedelta(seconds=int(round(float(value.replace(" s", ""))))))
+    return value
+
+def reference_extract_data(raw_lines: str) -> tuple|None:
+    lines = raw_lines.splitlines()
+    try:
+        if len(lines) < 1:
+            return None, None, None, None, None
+        match_ds = m.date_time_start_pattern.search(lines[0].rstrip())
+        if not match_ds:
+            return None, None, None, None, None
+        date_start = match_ds.group("date")
+        date_end = date_start
+        start = match_ds.group("start")
+        if not start:
+            match_s = m.start_pattern.search(lines[2].rstrip())
+            if match_s:
+                start = match_s.group("start")
+        match_ed = m.end_duration_pattern.search(lines[-1].rstrip())
+        if match_ed:
+            end = match_ed.group("end")
+            if match_ed.group("duration_h"):
+                duration = f"{match_ed.group('duration_h')} h"
+            elif match_ed.group("duration_s"):
+                duration = f"{match_ed.group('duration_s')} s"
+            else:
+                date_end, duration = calculate_duration(lines, date_start, start, end)
+            return date_start, date_end, start, end, normalize_time(duration)
+        for line in reversed(lines):
+            match_e = m.end_pattern.search(line.rstrip())
+            if match_e:
+                end = match_e.group("end")
+                date_end, duration = calculate_duration(lines, date_start, start, end)
+                return date_start, date_end, start, end, normalize_time(duration)
+        return None
+    except Exception:
+        return None, None, None, None, None
+
+# --- random buffers ---
+
+def random_buffers(n: int, seed: int) -> list[str]:
+    rng = random.Random(seed)
+
+    def t() -> str:
+        if rng.random() < 0.05:
+            # out of range
+            return f"{rng.randint(0, 30):02}:{rng.randint(0, 65):02}:{rng.randint(0, 65):02}"
+        return f"{rng.randint(0, 23):02}:{rng.randint(0, 59):02}:{rng.randint(0, 59):02}"
+
+    def d() -> str:
+        if rng.random() < 0.1:
+            # around the leap day
+            return f"2024-02-{rng.randint(28, 30)}"
+        return f"20{rng.randint(20, 25)}-{rng.randint(1, 12):02}-{rng.randint(1, 31):02}"
+
+    buffers: list[str] = []
+    for _ in range(n):
+        lines: list[str] = [f"{d()} {t()}.000 +0100 JD 2 ISO 8601" if rng.random() < 0.8 else d()]
+        for _ in range(rng.randint(0, 6)):
+            r = rng.random()
+            if r < 0.3:
+                lines.append(f"{t()} something")
+            elif r < 0.4:
+                lines.append(f"{d()} {t()}.000 +0100 JD 2 ISO 8601")
+            elif r < 0.45:
+                lines.append("no time here")
+            else:
+                lines.append(f"{t()} other")
+        r = rng.random()
+        end = t() if rng.random() < 0.8 else t()[1:]
+        if r < 0.3:
+            lines.append(f"{end} history registration finished after {rng.randint(0, 99):02}.{rng.randint(0, 999):03} s")
+        elif r < 0.5:
+            lines.append(f"{end} History registration finished after {t()}")
+        elif r < 0.7:
+            lines.append(f"{end} history registration finished")
+        buffers.append("\n".join(lines) + "\n")
+    return buffers
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--buffers", type=int, default=30000, help="Random session buffers")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    buffers = random_buffers(args.buffers, args.seed)
+    # finalize_sessions prints a line per unparsable date
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.perf_counter()
+        new = m.finalize_sessions([m.extract_fields(buffer) for buffer in buffers])
+        t1 = time.perf_counter()
+        old = [reference_extract_data(buffer) for buffer in buffers]
+        t2 = time.perf_counter()
+
+    differences: int = 0
+    for buffer, a, b in zip(buffers, new, old):
+        a = tuple(a) if a is not None else None
+        b = tuple(b) if b is not None else None
+        if a != b:
+            differences += 1
+            if differences <= 5:
+                print(f"{buffer!r}\n  new: {a}\n  old: {b}")
+
+    kinds = Counter("none" if b is None else "error" if b[1] == "Error" else "ok" for b in old)
+    print(f"{len(buffers)} buffers ({kinds['ok']} ok, {kinds['error']} invalid dates, {kinds['none']} without end): {differences} differences")
+    print(f"vectorized {t1 - t0:.2f} s, per buffer {t2 - t1:.2f} s")
+    sys.exit(1 if differences else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+#fleet_harness.py
+# Runs the sync logic of download_history_files end to end against a local
+# stand-in of the instrument PCs of REMOTES_DATA:
+#   - each host is a directory tree <root>/remote/<host>/opt/<app>/prog/curdir/<user>/
+#   - rsync, ssh and ping are served by FakeTransport, which copies files
+#     between the remote and the local tree, emulating the rsync output parsed
+#     by rsync_files, with configurable latency and failure rate
+#   - between runs the remote history files grow, as on the real instruments
+# Each run reports wall time, round-trips and bytes moved.
+import argparse
+import contextlib
+import io
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import download_history_files
+from compression import BackgroundCompressor
+
+class FakeTransport:
+    """
+    Drop-in replacement of subprocess.run for the commands issued by
+    download_history_files (rsync, ssh, ping).
+    """
+    def __init__(self, remote_root: Path, latency: float = 0.0, failure_rate: float = 0.0, seed: int = 0):
+        self.remote_root = remote_root
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+        self.reset()
+
+    def reset(self) -> None:
+        self.round_trips: Counter = Counter()
+        self.bytes_moved = 0
+        self.failures = 0
+
+    def remote_file(self, spec: str) -> tuple[str, Path]:
+        # user@host:/opt/... -> (host, <root>/remote/<host>/opt/...)
+        user_host, remote_path = spec.split(":", 1)
+        host = user_host.split("@", 1)[1]
+        return host, self.remote_root / host / remote_path.lstrip("/")
+
+    def __call__(self, cmd: list[str], capture_output: bool = False, text: bool = False, **kwargs) -> subprocess.CompletedProcess:
+        kind = Path(cmd[0]).name
+        if kind == "rsync" and "--dry-run" in cmd:
+            kind = "rsync --dry-run"
+        self.round_trips[kind] += 1
+
+        if kind == "ping":
+            return subprocess.CompletedProcess(cmd, 0, "", "")
+
+        time.sleep(self.latency)
+        if self.random.random() < self.failure_rate:
+            self.failures += 1
+            return subprocess.CompletedProcess(cmd, 255, "", "Connection reset by peer (simulated)")
+
+        if kind == "ssh":
+            return self.ssh(cmd)
+        return self.rsync(cmd)
+
+    def ssh(self, cmd: list[str]) -> subprocess.CompletedProcess:
+        # the only remote command issued is the inventory listing
+        host = next(arg for arg in cmd[1:] if not arg.startswith("-")).split("@", 1)[1]
+        host_root = self.remote_root / host
+        lines: list[str] = []
+        for p in sorted(host_root.glob("opt/*/prog/curdir/*/history*")):
+            if p.is_file():
+                st = p.stat()
+                lines.append(f"/{p.relative_to(host_root)}\t{st.st_size}\t{st.st_mtime:.10f}")
+        stdout = "".join(f"{line}\n" for line in lines)
+        self.bytes_moved += len(stdout)
+        return subprocess.CompletedProcess(cmd, 0, stdout, "")
+
+    def rsync(self, cmd: list[str]) -> subprocess.CompletedProcess:
+        dry_run = "--dry-run" in cmd
+        suffix = next((arg.split("=", 1)[1] for arg in cmd if arg.startswith("--suffix=")), None)
+        operands = [arg for arg in cmd[1:] if not arg.startswith("-")]
+        sources, dest_dir = operands[:-1], Path(operands[-1])
+
+        out: list[str] = ["receiving incremental file list"]
+        err: list[str] = []
+        returncode = 0
+        for spec in sources:
+            host, src = self.remote_file(spec)
+            if not src.is_file():
+                err.append(f'rsync: link_stat "{spec.split(":", 1)[1]}" failed: No such file or directory (2)')
+                returncode = 23
+                continue
+
+            dst = dest_dir / src.name
+            if not dst.exists():
+                out.append(f">f+++++++++ {src.name}")
+            elif dst.read_bytes() != src.read_bytes():
+                out.append(f">fcst...... {src.name}")
+            elif int(dst.stat().st_mtime) != int(src.stat().st_mtime):
+                out.append(f".f..t...... {src.name}")
+            else:
+                continue
+
+            if not dry_run:
+                dest_dir.mkdir(parents=True, exist_ok=True)
+                if suffix and dst.exists():
+                    os.replace(dst, dst.with_name(dst.name + suffix))
+                shutil.copy2(src, dst)
+                self.bytes_moved += src.stat().st_size
+
+        out += ["", "sent 1,234 bytes  received 5,678 bytes  13,824.00 bytes/sec", "total size is 0  speedup is 1.00"]
+        stdout = "\n".join(out) + "\n"
+        self.bytes_moved += len(stdout)
+        return subprocess.CompletedProcess(cmd, returncode, stdout, "\n".join(err))
+
+def history_lines(rng: random.Random, n: int) -> str:
+    lines: list[str] = []
+    for _ in range(n):
+        day = f"2025-{rng.randint(1, 12):02}-{rng.randint(1, 28):02}"
+        t = f"{rng.randint(0, 23):02}:{rng.randint(0, 59):02}:{rng.randint(0, 59):02}"
+        lines.append(f"{day} {t}.000 +0100 JD 2460000.5 ISO 8601")
+        lines.append(f"{t}.500 client changed object to \"/opt/data/nmr/exp{rng.randint(1, 99)}/1/pdata/1\"")
+        lines.append(f"{t} history registration finished after {rng.randint(10, 59)}.{rng.randint(0, 999):03} s")
+    return "\n".join(lines) + "\n"
+
+def build_fleet(remote_root: Path, remotes: list[dict], density: float, rng: random.Random) -> list[Path]:
+    """
+    Creates history/history.old files for a fraction (density) of the
+    app/user pairs of each host. Returns the created files.
+    """
+    created: list[Path] = []
+    for remote in remotes:
+        for app in remote["apps"]:
+            for username in remote["usernames"]:
+                if rng.random() >= density:
+                    continue
+                d = remote_root / remote["host"] / "opt" / app / "prog" / "curdir" / username
+                d.mkdir(parents=True, exist_ok=True)
+                (d / "history").write_text(history_lines(rng, rng.randint(50, 500)))
+                created.append(d / "history")
+                if rng.random() < 0.5:
+                    (d / "history.old").write_text(history_lines(rng, rng.randint(50, 500)))
+                    created.append(d / "history.old")
+    return created
+
+def grow(files: list[Path], fraction: float, rng: random.Random) -> int:
+    """
+    Appends sessions to a fraction of the remote files (new acquisitions).
+    """
+    grown = 0
+    for p in files:
+        if p.name == "history" and rng.random() < fraction:
+            with open(p, "a") as f:
+                f.write(history_lines(rng, rng.randint(1, 20)))
+            # make sure the mtime moves even on coarse-grained filesystems
+            st = p.stat()
+            os.utime(p, (st.st_atime, st.st_mtime + 1))
+            grown += 1
+    return grown
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3, help="Consecutive sync runs")
+    parser.add_argument("--latency", type=float, default=0.02, help="Seconds added to every rsync/ssh round-trip")
+    parser.add_argument("--failure-rate", type=float, default=0.0, help="Probability that an rsync/ssh call fails")
+    parser.add_argument("--growth", type=float, default=0.2, help="Fraction of history files growing between runs")
+    parser.add_argument("--density", type=float, default=0.3, help="Fraction of app/user pairs existing on the hosts")
+    parser.add_argument("--no-inventory", action="store_true", help="Probe every app/user pair (no inventory pass)")
+    parser.add_argument("--compress", choices=["none", "gzip", "zstd"], default="none", help="Compress the rotations in the background")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary fleet directory")
+    parser.add_argument("--verbose", action="store_true", help="Show the output of the sync")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    root = Path(tempfile.mkdtemp(prefix="fleet-"))
+    remote_root = root / "remote"
+    local_root = root / "local"
+    local_root.mkdir(parents=True)
+
+    files = build_fleet(remote_root, download_history_files.REMOTES_DATA, args.density, rng)
+    print(f"Fleet: {len(files)} remote files, {sum(p.stat().st_size for p in files)} bytes under {root}")
+
+    transport = FakeTransport(remote_root, latency=args.latency, failure_rate=args.failure_rate, seed=args.seed)
+    download_history_files.run_command = transport
+    download_history_files.RETRY_DELAY = 0
+
+    cwd = os.getcwd()
+    os.chdir(local_root)
+    try:
+        print(f"{'run':>3} {'grown':>6} {'wall [s]':>9} {'round-trips':>12} {'bytes moved':>12} {'failures':>9}   round-trips by command")
+        for run in range(1, args.runs + 1):
+            grown = grow(files, args.growth, rng) if run > 1 else 0
+            transport.reset()
+            t0 = time.perf_counter()
+            output = io.StringIO()
+            with contextlib.redirect_stdout(sys.stdout if args.verbose else output):
+                compressor = BackgroundCompressor(args.compress) if args.compress != "none" else None
+                download_history_files.sync_remotes(download_history_files.REMOTES_DATA, use_inventory=not args.no_inventory, compressor=compressor)
+                wall = time.perf_counter() - t0
+                if compressor is not None:
+                    compressor.close()
+            by_kind = ", ".join(f"{kind}: {n}" for kind, n in sorted(transport.round_trips.items()))
+            print(f"{run:>3} {grown:>6} {wall:>9.2f} {sum(transport.round_trips.values()):>12} {transport.bytes_moved:>12} {transport.failures:>9}   {by_kind}")
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(root)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+#chunkstore.py
+# Content-addressed archive of history files.
+# Rotations (history.N, history.old.N, .stversions/ copies, ...) mostly share
+# long prefixes: each file is cut in content-defined chunks (boundaries on
+# line ends chosen by the content, so equal prefixes give equal chunks), every
+# chunk is stored once under its sha256, and each file becomes a manifest
+# listing its chunks.
+#   <archive>/chunks/ab/abcdef...                raw bytes of a chunk
+#   <archive>/manifests/<original path>.json     {"path", "size", "source_size", "mtime_ns", "sha256", "chunks": [[digest, size], ...]}
+import argparse
+import contextlib
+import fnmatch
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import zlib
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO, Iterable, Iterator
+from termcolor import colored
+
+from compression import open_compressed, plain_name
+from utils import is_history_file
+
+# a line ends a chunk when the low bits of its crc32 are zero (1 line in
+# CHUNK_MASK + 1), within MIN_CHUNK and MAX_CHUNK bytes
+CHUNK_MASK = 0x3FF
+MIN_CHUNK = 16 * 1024
+MAX_CHUNK = 256 * 1024
+
+def iter_chunks(f: BinaryIO, mask: int = CHUNK_MASK, min_size: int = MIN_CHUNK, max_size: int = MAX_CHUNK) -> Iterator[bytes]:
+    """
+    Cuts a binary stream in chunks ending on line boundaries chosen by the
+    content of the lines.
+    """
+    chunk = bytearray()
+    for line in f:
+        chunk += line
+        if len(chunk) >= max_size or (len(chunk) >= min_size and zlib.crc32(line) & mask == 0):
+            yield bytes(chunk)
+            chunk.clear()
+    if chunk:
+        yield bytes(chunk)
+
+def chunk_path(archive: Path, digest: str) -> Path:
+    return Path(archive) / "chunks" / digest[:2] / digest
+
+def manifest_path(archive: Path, path: str) -> Path:
+    # /mnt/j/x/history.1 -> <archive>/manifests/mnt/j/x/history.1.json
+    relative = os.path.normpath(path).lstrip("/\\")
+    return Path(archive) / "manifests" / f"{relative}.json"
+
+def write_atomic(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(f".{path.name}.tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+def archived_name(path: str) -> str:
+    # compressed rotations are archived under their plain name
+    return plain_name(path)
+
+def store_file(archive: Path, source: Path, path: str|None = None) -> tuple[dict, int]:
+    """
+    Stores a file in the archive under path (default: the source path; .gz/.zst
+    rotations are stored decompressed, under their plain name). Returns the
+    manifest and the number of bytes of the new chunks.
+    """
+    source = Path(source)
+    path = archived_name(str(source)) if path is None else path
+
+    st = source.stat()
+    chunks: list[list] = []
+    new_bytes = 0
+    file_hash = hashlib.sha256()
+    with open_compressed(source, "rb") as f:
+        for chunk in iter_chunks(f):
+            digest = hashlib.sha256(chunk).hexdigest()
+            file_hash.update(chunk)
+            target = chunk_path(archive, digest)
+            if not target.exists():
+                write_atomic(target, chunk)
+                new_bytes += len(chunk)
+            chunks.append([digest, len(chunk)])
+
+    manifest = {
+        "path": path,
+        "size": sum(size for digest, size in chunks),
+        "source_size": st.st_size,  # on disk, compressed or not
+        "mtime_ns": st.st_mtime_ns,
+        "sha256": file_hash.hexdigest(),
+        "chunks": chunks,
+    }
+    write_atomic(manifest_path(archive, path), json.dumps(manifest).encode("utf-8"))
+    return manifest, new_bytes
+
+def load_manifest(archive: Path, path: str) -> dict|None:
+    try:
+        with open(manifest_path(archive, path), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def iter_manifests(archive: Path) -> Iterator[dict]:
+    for p in sorted((Path(archive) / "manifests").rglob("*.json")):
+        with open(p, "r", encoding="utf-8") as f:
+            yield json.load(f)
+
+def archived_files(archive: Path, base: Path|None = None, pattern: str|None = None) -> list[str]:
+    """
+    Returns the original paths of the files in the archive. With base and a
+    glob pattern of directories, only the history files found under those
+    directories, as find_history_files() would find them on disk.
+    """
+    paths: list[str] = [manifest["path"] for manifest in iter_manifests(archive)]
+    if base is None:
+        return paths
+
+    segments = pattern.split("/")
+    selected: list[str] = []
+    for path in paths:
+        try:
+            relative = PurePosixPath(path).relative_to(base)
+        except ValueError:
+            continue
+        dirs = relative.parts[:-1]
+        if len(dirs) >= len(segments) and all(fnmatch.fnmatchcase(d, s) for d, s in zip(dirs, segments)) and is_history_file(relative.name):
+            selected.append(path)
+    return selected
+
+def archived_mtime(archive: Path):
+    """
+    Returns a function giving the mtime (seconds) of an archived file, as
+    os.path.getmtime does for files on disk.
+    """
+    def mtime(path: str) -> float:
+        return load_manifest(archive, path)["mtime_ns"] / 1e9
+    return mtime
+
+class ChunkReader(io.RawIOBase):
+    """
+    Reads the content of an archived file, chunk after chunk. Its name is the
+    original path, so the parsers take host/app/user from it as usual.
+    """
+    def __init__(self, archive: Path, manifest: dict):
+        self.archive = Path(archive)
+        self.name = manifest["path"]
+        self.chunks = [digest for digest, size in manifest["chunks"]]
+        self.index = 0
+        self.current: BinaryIO|None = None
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        while True:
+            if self.current is None:
+                if self.index >= len(self.chunks):
+                    return 0
+                self.current = open(chunk_path(self.archive, self.chunks[self.index]), "rb")
+                self.index += 1
+            n = self.current.readinto(b)
+            if n:
+                return n
+            self.current.close()
+            self.current = None
+
+    def close(self) -> None:
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+        super().close()
+
+def open_archived(archive: Path, path: str) -> io.BufferedReader:
+    """
+    Opens an archived file as a binary stream (usable as a source by
+    iter_sessions/iter_objects).
+    """
+    manifest = load_manifest(archive, path)
+    if manifest is None:
+        raise FileNotFoundError(f"{path} is not in the archive {archive}")
+    return io.BufferedReader(ChunkReader(archive, manifest))
+
+def open_source(archive: Path|None, path: str):
+    """
+    Context manager giving the source to parse for path: the archived file
+    if an archive is given, the path itself otherwise.
+    """
+    return open_archived(archive, path) if archive is not None else contextlib.nullcontext(path)
+
+def find_files(roots: Iterable[str]) -> list[str]:
+    """
+    Returns the history files (plain or compressed rotations) under the given
+    directories, keeping the root as given (e.g. ./host/... or /mnt/j/...).
+    """
+    found: list[str] = []
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if is_history_file(filename):
+                    found.append(os.path.join(dirpath, filename))
+    return found
+
+def is_under(path: str, roots: Iterable[str]) -> bool:
+    path = os.path.abspath(path)
+    return any(path.startswith(os.path.join(os.path.abspath(root), "")) for root in roots)
+
+def ingest(archive: Path, roots: Iterable[str]) -> None:
+    """
+    Stores the history files under roots in the archive. Files whose mtime
+    and size did not change since they were stored are skipped (background
+    compression keeps the mtime of the rotations). The manifests of the
+    files no longer found under roots (removed, or renamed by a rotation)
+    are dropped; their chunks go at the next gc.
+    """
+    roots = list(roots)
+    files = find_files(roots)
+    total = stored = skipped = 0
+    for counter, path in enumerate(files, start=1):
+        st = os.stat(path)
+        manifest = load_manifest(archive, archived_name(path))
+        if manifest is not None and (manifest["mtime_ns"], manifest.get("source_size")) == (st.st_mtime_ns, st.st_size):
+            skipped += 1
+            continue
+        manifest, new_bytes = store_file(archive, Path(path))
+        total += manifest["size"]
+        stored += new_bytes
+        print(f"[{counter}] {manifest['path']}: {manifest['size']} bytes, {len(manifest['chunks'])} chunks, {new_bytes} new bytes")
+
+    present: set[str] = {archived_name(path) for path in files}
+    dropped = 0
+    for manifest in list(iter_manifests(archive)):
+        if is_under(manifest["path"], roots) and manifest["path"] not in present:
+            manifest_path(archive, manifest["path"]).unlink()
+            dropped += 1
+            print(f"{colored('[WARN ]', 'yellow', attrs=['bold'])} {manifest['path']} is no longer on disk, dropped from the archive")
+
+    print(f"\n{colored('### Archive', 'green', attrs=['bold'])} {archive}")
+    print(f"  files: {len(files)} ({skipped} unchanged, {dropped} dropped)")
+    print(f"  bytes ingested: {total}, new bytes stored: {stored} ({100 * (1 - stored / total) if total else 0:.1f}% deduplicated)")
+
+def gc(archive: Path) -> None:
+    """
+    Removes the chunks not referenced by any manifest.
+    """
+    referenced = {digest for manifest in iter_manifests(archive) for digest, size in manifest["chunks"]}
+    removed = freed = 0
+    for p in (Path(archive) / "chunks").rglob("*"):
+        if p.is_file() and p.name not in referenced:
+            freed += p.stat().st_size
+            p.unlink()
+            removed += 1
+    print(f"Removed {removed} unreferenced chunks ({freed} bytes)")
+
+def stats(archive: Path) -> None:
+    manifests = list(iter_manifests(archive))
+    logical = sum(manifest["size"] for manifest in manifests)
+    physical = sum(p.stat().st_size for p in (Path(archive) / "chunks").rglob("*") if p.is_file())
+    print(f"files: {len(manifests)}, logical size: {logical}, stored: {physical} ({logical / physical if physical else 0:.1f}x)")
+
+def cli(argv: list[str]|None = None) -> None:
+    parser = argparse.ArgumentParser(description="Content-addressed archive of the history files")
+    parser.add_argument("--archive", type=Path, default=Path("./archive"), help="Archive directory")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    ingest_parser = subparsers.add_parser("ingest", help="Store the history files found under the given directories")
+    ingest_parser.add_argument("roots", nargs="+", help="Directories to scan (e.g. /mnt/j or .)")
+    cat_parser = subparsers.add_parser("cat", help="Write an archived file to stdout")
+    cat_parser.add_argument("path", help="Original path of the file")
+    subparsers.add_parser("gc", help="Remove the chunks no longer referenced")
+    subparsers.add_parser("stats", help="Show the deduplication ratio")
+
+    args: argparse.Namespace = parser.parse_args(argv)
+
+    if args.command == "ingest":
+        ingest(args.archive, args.roots)
+    elif args.command == "cat":
+        with open_archived(args.archive, args.path) as f:
+            shutil.copyfileobj(f, sys.stdout.buffer)
+    elif args.command == "gc":
+        gc(args.archive)
+    else:
+        stats(args.archive)
+
+if __name__ == "__main__":
+    cli()
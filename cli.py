@@ -0,0 +1,37 @@
+#cli.py
+import argparse
+import importlib
+import sys
+
+# subcommand -> (module, description)
+# Modules are imported only when their subcommand runs, so that --help or a
+# wrong option do not pay the pandas/polars/openpyxl import time.
+COMMANDS: dict[str, tuple[str, str]] = {
+    "sync":     ("download_history_files", "Download the history files of the instrument PCs"),
+    "extract":  ("remote_extract",         "Extract sessions and objects on the instrument PCs (*.agent.xlsx summaries)"),
+    "sessions": ("manage_history_files",   "Extract the acquisition sessions (history_files_summary.xlsx)"),
+    "objects":  ("objects",                "Extract the object changes (objects_summary.xlsx)"),
+    "match":    ("objects_vs_bookings",    "Match objects against the bookings calendar"),
+    "attribute": ("attribution",           "Attribute the object changes to their sessions (sessions_objects.xlsx)"),
+    "usage":    ("rollups",                "Sessions, hours and objects per period from the daily rollups"),
+    "serve":    ("query_service",          "HTTP/JSON queries on the sessions and objects (local service)"),
+    "follow":   ("follow",                 "Follow the active history files live (objects_live.csv)"),
+    "archive":  ("chunkstore",             "Deduplicated archive of the history files (ingest/cat/gc/stats)"),
+}
+
+def main(argv: list[str]|None = None) -> None:
+    parser = argparse.ArgumentParser(
+        description="History files tools",
+        epilog="\n".join(f"  {name:<10}{description}" for name, (module, description) in COMMANDS.items()),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument("command", choices=COMMANDS, help="Subcommand (use '<command> --help' for its options)")
+    parser.add_argument("args", nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+
+    args: argparse.Namespace = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+    module = importlib.import_module(COMMANDS[args.command][0])
+    module.cli(args.args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#compression.py
+# Compression of the rotated history files (history.N -> history.N.gz/.zst)
+# by a pool of background workers, so that the sync loop does not wait for it.
+import gzip
+import io
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from typing import NamedTuple
+from termcolor import colored
+
+try:
+    import zstandard
+except ImportError:  # optional: only needed for --compress zstd
+    zstandard = None
+
+# method -> (suffix, default level)
+METHODS: dict[str, tuple[str, int]] = {
+    "gzip": (".gz", 6),
+    "zstd": (".zst", 10),
+}
+
+COMPRESSED_SUFFIXES: tuple[str, ...] = tuple(suffix for suffix, level in METHODS.values())
+
+def plain_name(name: str) -> str:
+    # history.N.gz -> history.N: compressed rotations keep their place in the lineage
+    for suffix in COMPRESSED_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+def open_compressed(path, mode: str = "rb", encoding: str|None = None):
+    """
+    Opens a history file, decompressing .gz/.zst rotations transparently.
+    """
+    path = Path(path)
+    if path.suffix == ".gz":
+        return gzip.open(path, mode, encoding=encoding)
+    if path.suffix == ".zst":
+        if zstandard is None:
+            raise RuntimeError(f"{path}: the zstandard package is needed to read .zst files")
+        # buffered: the zstd reader alone cannot be iterated by lines
+        stream = io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True))
+        return stream if "b" in mode else io.TextIOWrapper(stream, encoding=encoding)
+    return open(path, mode, encoding=encoding)
+
+class CompressionResult(NamedTuple):
+    source: Path
+    target: Path|None       # None if the source changed while being compressed
+    bytes_in: int
+    bytes_out: int
+    seconds: float
+
+def compress_file(source: Path, method: str = "gzip", level: int|None = None) -> CompressionResult:
+    """
+    Compresses source to source<suffix> through a temporary file and
+    os.replace(), then removes source. If source is replaced (e.g. shifted by
+    a rotation) in the meantime, the result is discarded.
+    """
+    if method == "zstd" and zstandard is None:
+        raise RuntimeError(f"{source}: the zstandard package is needed to compress with zstd")
+    suffix, default_level = METHODS[method]
+    level = default_level if level is None else level
+    source = Path(source)
+    target = source.with_name(source.name + suffix)
+    tmp = source.with_name(f".{source.name}.tmp{suffix}")
+
+    t0 = time.perf_counter()
+    st = source.stat()
+    with open(source, "rb") as f_in:
+        if method == "zstd":
+            with open(tmp, "wb") as f_raw, zstandard.ZstdCompressor(level=level).stream_writer(f_raw) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1 << 20)
+        else:
+            with gzip.open(tmp, "wb", compresslevel=level) as f_out:
+                shutil.copyfileobj(f_in, f_out, 1 << 20)
+
+    try:
+        now = source.stat()
+    except FileNotFoundError:
+        now = None
+    if now is None or (now.st_ino, now.st_size, now.st_mtime_ns) != (st.st_ino, st.st_size, st.st_mtime_ns):
+        tmp.unlink()
+        return CompressionResult(source, None, st.st_size, 0, time.perf_counter() - t0)
+
+    shutil.copystat(source, tmp)
+    os.replace(tmp, target)
+    source.unlink()
+    return CompressionResult(source, target, st.st_size, target.stat().st_size, time.perf_counter() - t0)
+
+class BackgroundCompressor:
+    """
+    Pool of workers compressing the files submitted to it. zlib and zstd
+    release the GIL, so threads are enough to use several cores.
+    """
+    def __init__(self, method: str = "gzip", level: int|None = None, workers: int|None = None):
+        if method == "zstd" and zstandard is None:
+            print(f"{colored('[WARN ]', 'yellow', attrs=['bold'])} zstandard is not installed, compressing with gzip")
+            method, level = "gzip", None
+        self.method = method
+        self.level = level
+        self.pool = ThreadPoolExecutor(max_workers=workers or os.cpu_count(), thread_name_prefix="compress")
+        self.futures: list[Future] = []
+        self.submitted: set[Path] = set()
+        self.lock = threading.Lock()
+
+    def submit(self, source: Path) -> None:
+        source = Path(source)
+        with self.lock:
+            if source in self.submitted:
+                return
+            self.submitted.add(source)
+        self.futures.append(self.pool.submit(compress_file, source, self.method, self.level))
+
+    def close(self) -> list[CompressionResult]:
+        """
+        Waits for the pending compressions and prints the report.
+        """
+        t_wait = time.perf_counter()
+        self.pool.shutdown(wait=True)
+        waited = time.perf_counter() - t_wait
+
+        results: list[CompressionResult] = []
+        errors = 0
+        for future in self.futures:
+            try:
+                results.append(future.result())
+            except OSError as e:
+                errors += 1
+                print(f"{colored('[ERROR]', 'cyan', attrs=['bold'])} compression failed: {e}")
+
+        done = [r for r in results if r.target is not None]
+        if not results and not errors:
+            return results
+        bytes_in = sum(r.bytes_in for r in done)
+        bytes_out = sum(r.bytes_out for r in done)
+        saved = bytes_in - bytes_out
+        print(f"\n{colored('### Compression report', 'green', attrs=['bold'])} ({self.method})")
+        print(f"  files compressed: {len(done)} (skipped: {len(results) - len(done)}, failed: {errors})")
+        print(f"  bytes: {bytes_in} -> {bytes_out}, saved {saved} ({100 * saved / bytes_in if bytes_in else 0:.1f}%)")
+        print(f"  worker time: {sum(r.seconds for r in results):.2f} s, waited at the end of the sync: {waited:.2f} s")
+        return results
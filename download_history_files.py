@@ -3,16 +3,30 @@ import subprocess
 import os
 from pathlib import Path
 from time import sleep
-from attr import attrs
 from termcolor import colored
 import glob
 import re
-import shutil
-import gzip
-from utils import run_containment, max_index, fill_gaps
+import argparse
+import json
+import time
+from utils import run_containment, max_index#, fill_gaps
+from compression import BackgroundCompressor, COMPRESSED_SUFFIXES, METHODS
 
 rsync_count = 1
 
+# Every rsync/ssh/ping call goes through run_command, so that the transport
+# can be replaced (see benchmarks/fleet_harness.py)
+run_command = subprocess.run
+
+# seconds between retries of a failed rsync
+RETRY_DELAY = 60
+
+# remote files listed by the inventory pass, cached between runs
+INVENTORY_DIR = Path("./.inventory")
+
+# per host/app/user/file sync state, to resume interrupted runs
+JOURNAL_FILE = Path("./.sync_journal.json")
+
 KEYS = [
     "~/.ssh/id_rsa-centos5",
     "~/.ssh/id_ed25519",
@@ -44,18 +58,130 @@ def add_key_with_passphrase(key_path):
     # You can rely on ssh-add to prompt, or pass via askpass for GUI flows.
     subprocess.check_call(["ssh-add", key_path])
 
+def ssh_options(host: str) -> list[str]:
+    # the AV600 PC (CentOS 5) only speaks legacy key exchange/host key algorithms
+    if host.startswith("AV600"):
+        return ["-oKexAlgorithms=+diffie-hellman-group1-sha1", "-oHostKeyAlgorithms=+ssh-dss"]
+    return []
+
+def remote_inventory(host: str, user: str) -> dict[str, tuple[int, int]]|None:
+    """
+    Lists with a single ssh call the history files of every app/user of host,
+    returning {remote path: (size, mtime)}, or None if the listing failed.
+    """
+    listing = r"find /opt/*/prog/curdir/*/ -maxdepth 1 -type f -name 'history*' -printf '%p\t%s\t%T@\n' 2>/dev/null"
+    cmd = ["ssh", *ssh_options(host), "-oBatchMode=yes", f"{user}@{host}", listing]
+    res = run_command(cmd, capture_output=True, text=True)
+
+    inventory: dict[str, tuple[int, int]] = {}
+    for line in res.stdout.splitlines():
+        parts = line.split("\t")
+        if len(parts) != 3:
+            continue
+        try:
+            inventory[parts[0]] = (int(parts[1]), int(float(parts[2])))
+        except ValueError:
+            continue
+
+    if not inventory and res.returncode != 0:
+        print(f"{colored('[WARN ]', 'yellow', attrs=['bold'])} inventory of {host} failed (rc={res.returncode}), probing every app/user")
+        return None
+    return inventory
+
+def load_inventory(host: str) -> dict[str, tuple[int, int]]:
+    inventory_file = INVENTORY_DIR / f"{host}.json"
+    if not inventory_file.exists():
+        return {}
+    with open(inventory_file, "r", encoding="utf-8") as f:
+        return {path: tuple(stat) for path, stat in json.load(f).items()}
+
+def save_inventory(host: str, inventory: dict[str, tuple[int, int]]) -> None:
+    INVENTORY_DIR.mkdir(exist_ok=True)
+    inventory_file = INVENTORY_DIR / f"{host}.json"
+    tmp_file = INVENTORY_DIR / f".{host}.json.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(inventory, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, inventory_file)
+
+def load_journal() -> dict[str, dict]:
+    if not JOURNAL_FILE.exists():
+        return {}
+    with open(JOURNAL_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_journal(journal: dict[str, dict]) -> None:
+    # written after every step: keep it atomic, runs can be killed at any time
+    tmp_file = JOURNAL_FILE.with_name(f".{JOURNAL_FILE.name}.tmp")
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(journal, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, JOURNAL_FILE)
+
+def journal_key(host: str, app: str, username: str, filename: str) -> str:
+    return f"{host}/{app}/{username}/{filename}"
+
+def is_fresh(entry: dict|None, freshness: float, stat: tuple[int, int]|None = None) -> bool:
+    """
+    Whether a file was confirmed less than freshness seconds ago and, given
+    its (size, mtime) from the inventory, did not change since: other values
+    than the confirmed ones mean new data.
+    """
+    if not entry or entry.get("state") != "confirmed" or time.time() - entry.get("confirmed_at", 0) >= freshness:
+        return False
+    return stat is None or (entry.get("size"), entry.get("mtime")) == tuple(stat)
+
+def finish_interrupted_rotation(dest_file: Path) -> None:
+    """
+    Repairs the rotations of dest_file left by an interrupted
+    rotate_numbered_backup_logrotate():
+      - removes the temporary files of unfinished compressions
+      - renumbers the rotations without gaps (name.N was shifted to name.N+1
+        from the top down, so an interruption leaves a hole), starting from 1
+        if name.1 is still there, from 2 otherwise
+    """
+    dest_file = Path(dest_file)
+    parent = dest_file.parent
+    stem = dest_file.name
+
+    for tmp in parent.glob(f".{stem}.*.tmp.*"):
+        print(f"  Removing unfinished compression {tmp}")
+        tmp.unlink()
+
+    _rotation_re = re.compile(rf"^{re.escape(stem)}\.(?P<number>\d+)(?P<gz>\.gz|\.zst)?$")
+    rotations: list[tuple[int, Path, str]] = []
+    for p in parent.glob(f"{stem}.*"):
+        m = _rotation_re.match(p.name)
+        if m:
+            rotations.append((int(m.group("number")), p, m.group("gz") or ""))
+    rotations.sort()
+    if not rotations:
+        return
+
+    first = 1 if rotations[0][0] == 1 else 2
+    targets = [(p, parent / f"{stem}.{first + i}{gz}") for i, (n, p, gz) in enumerate(rotations)]
+    if all(p == target for p, target in targets):
+        return
+
+    print(f"  Finishing interrupted rotation of {dest_file}")
+    # two steps, so that no rename overwrites a rotation not moved yet
+    moved = []
+    for p, target in targets:
+        tmp = parent / f".{p.name}.renumber"
+        os.replace(p, tmp)
+        moved.append((tmp, target))
+    for tmp, target in moved:
+        os.replace(tmp, target)
+
 def rotate_numbered_backup_logrotate(dest_file: Path,
-                                     max_rotations: int = 100,
-                                     compress: bool = False):
+                                     max_rotations: int = 100):
     """
     Logrotate-like rotation:
-      - Move dest_file -> dest_file.1
       - Shift existing: dest_file.(n) -> dest_file.(n+1), up to max_rotations
+        (compressed rotations dest_file.(n).gz/.zst keep their suffix)
       - Delete dest_file.max_rotations if present
-      - Optionally compress dest_file.1 as dest_file.1.gz
+      - dest_file -> dest_file.1 is done by rsync (--backup --suffix=.1)
 
-    Returns the path of the newly created rotation (e.g., dest_file.1 or dest_file.1.gz),
-    or None if dest_file does not exist (nothing to rotate).
+    Compression of the rotations is done afterwards, in the background, by
+    compression.BackgroundCompressor.
 
     Atomic on the same filesystem via os.replace().
     """
@@ -65,55 +191,39 @@ def rotate_numbered_backup_logrotate(dest_file: Path,
 
     parent = dest_file.parent
     stem = dest_file.name
+    variants = ("", *COMPRESSED_SUFFIXES)
 
-    # Step 1: delete oldest gz rotation (max_rotations) if present
-    oldest_gz = parent / f"{stem}.{max_rotations}.gz"
-    if oldest_gz.exists():
-        oldest_gz.unlink()
+    # Step 1: delete oldest rotation (max_rotations) if present
+    for suffix in variants:
+        oldest = parent / f"{stem}.{max_rotations}{suffix}"
+        if oldest.exists():
+            oldest.unlink()
     
     # Step 2: shift rotations backward from n = max_rotations - 1 down to 1
-    # name.(n) -> name.(n+1), prefer moving .gz if it exists
+    # name.(n)[.gz|.zst] -> name.(n+1)[.gz|.zst]
     for n in range(max_rotations - 1, 0, -1):
-        src_plain = parent / f"{stem}.{n}"
-        src_gz = parent / f"{stem}.{n}.gz"
-        dst_plain = parent / f"{stem}.{n+1}"
-        dst_gz = parent / f"{stem}.{n+1}.gz"
-
-        # move compressed if present, otherwise plain
-        if src_gz.exists():
-            # ensure destination not conflicting
-            if dst_gz.exists():
-                dst_gz.unlink()
-            os.replace(src_gz, dst_gz)
-        elif src_plain.exists():
-            # if destination has a gz, remove to avoid ambiguity
-            if dst_gz.exists():
-                dst_gz.unlink()
-            if dst_plain.exists():
-                dst_plain.unlink()
-            os.replace(src_plain, dst_plain)
+        src = next((parent / f"{stem}.{n}{suffix}" for suffix in variants if (parent / f"{stem}.{n}{suffix}").exists()), None)
+        if src is None:
+            continue
+        # remove any variant of the destination to avoid ambiguity
+        for suffix in variants:
+            dst = parent / f"{stem}.{n+1}{suffix}"
+            if dst.exists():
+                dst.unlink()
+        os.replace(src, parent / f"{stem}.{n+1}{src.name[len(f'{stem}.{n}'):]}")
 
     # Step 3: move current dest_file -> dest_file.1 
     # !!! Done in the rsync call by --suffix=.1 option !!!
 
-    # In case a compressed .1 exists, remove it (we are creating a fresh rotation)
-    if (parent / f"{stem}.1.gz").exists():
-        (parent / f"{stem}.1.gz").unlink()
-
-    # Step 4: optional compression of .1
-    if compress:
-        first_rotation = parent / f"{stem}.1"
-        gz_path = parent / f"{stem}.1.gz"
-        # Compress atomically: write to temp then replace
-        tmp_gz = parent / f".{stem}.1.tmp.gz"
-        with open(first_rotation, "rb") as f_in, gzip.open(tmp_gz, "wb", compresslevel=6) as f_out:
-            shutil.copyfileobj(f_in, f_out)
-        os.replace(tmp_gz, gz_path)
-        # Remove the uncompressed .1
-        first_rotation.unlink()
-
-def rsync_files(host, app, username):
+def rsync_files(host, user, app, username, files=("history", "history.old"), journal: dict|None = None) -> set[str]:
+    """
+    Syncs the given history files of host/app/username, rotating the local
+    copies that changed. Returns the names of the files confirmed in sync.
+    If a journal is given, rotations are recorded in it while in progress,
+    and the ones found in progress are finished first.
+    """
     global rsync_count
+    confirmed: set[str] = set()
 
     remote_path = f"/opt/{app}/prog/curdir/{username}/"
     remote_spec = f"{user}@{host}:{remote_path}"
@@ -130,18 +240,17 @@ def rsync_files(host, app, username):
         "--out-format=%i %n",
     ]
 
-    if host == "AV600":
-        cmd.append("-e ssh -oKexAlgorithms=+diffie-hellman-group1-sha1 -oHostKeyAlgorithms=+ssh-dss")
+    if ssh_options(host):
+        cmd.append("-e ssh " + " ".join(ssh_options(host)))
         
     cmd.extend(
             [
-                f"{remote_spec}history",
-                f"{remote_spec}history.old",
+                *[f"{remote_spec}{name}" for name in files],
                 str(dest_dir)
             ]
         )
 
-    res = subprocess.run(cmd, capture_output=True, text=True)
+    res = run_command(cmd, capture_output=True, text=True)
     
     ## Basic rsync diagnostics
     #print("Return code:", res.returncode)
@@ -205,15 +314,16 @@ def rsync_files(host, app, username):
 
                 n_tries = 1
                 while True:
-                    res = subprocess.run(cmd, capture_output=True, text=True)
+                    res = run_command(cmd, capture_output=True, text=True)
 
                     if res.returncode == 0:
+                        confirmed.add(filename)
                         print(f"{colored('[ NEW ]',  color="white", on_color="on_green", attrs=['bold'])} {host}/{app}/{username}/{filename} is new and will be downloaded")
                         break
                     else:
                         print(f"{colored('[ERROR]', 'cyan', attrs=['bold'])} Try {n_tries}: rsync failed for {host}/{app}/{username}/{filename} (rc={res.returncode}): {res.stderr.strip()}")
-                        print("Retrying in 60 seconds...")
-                        sleep(60)
+                        print(f"Retrying in {RETRY_DELAY} seconds...")
+                        sleep(RETRY_DELAY)
                         if n_tries >= 10:
                             print(f"{colored('[FATAL]', 'red', attrs=['bold'])} Try {n_tries}: rsync of {host}/{app}/{username}/{filename} failed after {n_tries} attempts; moving to next.\n")
                             break
@@ -221,45 +331,59 @@ def rsync_files(host, app, username):
                 
             elif flags.startswith(">fc"):
 
+                resuming = False
+                if journal is not None:
+                    key = journal_key(host, app, username, filename)
+                    resuming = journal.get(key, {}).get("state") == "rotating"
+                    journal[key] = {"state": "rotating", "since": time.time()}
+                    save_journal(journal)
+                    if resuming:
+                        finish_interrupted_rotation(dest_dir / filename)
+
                 max_n = max_index(filename, dest_dir)
-                if max_n != 0: # there exists at least one local backup
+                # an interrupted rotation that already freed .1 must not shift again
+                if resuming and not (dest_dir / f"{filename}.1").exists():
+                    print(f"  Rotation of {filename} already shifted, completing the download")
+                elif max_n != 0: # there exists at least one local backup
                     print(f"  Existing backups found up to {filename}.{max_n} in {dest_dir}")
                     
                     rotate_numbered_backup_logrotate(
                         dest_file=f"{dest_dir}/{filename}",
                         max_rotations = 10,
-                        compress=False,
                         )
                 
                 cmd.insert(-1, f"{user}@{host}:{remote_path}{filename}")
 
                 n_tries = 1
                 while True:
-                    res = subprocess.run(cmd, capture_output=True, text=True)
+                    res = run_command(cmd, capture_output=True, text=True)
 
                     if res.returncode == 0:
+                        confirmed.add(filename)
                         print(f"{colored('[ OK  ]', 'green', attrs=['bold'])} Try {n_tries}: {host}/{app}/{username}/{filename} synced")
                         break
                     else:
                         print(f"{colored('[ERROR]', 'cyan', attrs=['bold'])} Try {n_tries}: rsync failed for {host}/{app}/{username}/{filename} (rc={res.returncode}): {res.stderr.strip()}")
-                        print("Retrying in 60 seconds...")
-                        sleep(60)
+                        print(f"Retrying in {RETRY_DELAY} seconds...")
+                        sleep(RETRY_DELAY)
                         if n_tries >= 10:
                             print(f"{colored('[FATAL]', 'red', attrs=['bold'])} Try {n_tries}: rsync of {host}/{app}/{username}/{filename} failed after {n_tries} attempts; moving to next.\n")
                             break
                         n_tries += 1
 
             elif flags.startswith(".f"):
+                confirmed.add(filename)
                 print(f"{colored('[ --- ]', 'white', attrs=['bold'])} {host}/{app}/{username}/{filename} is already up to date.")
 
             continue
 
     rsync_count += 1
+    return confirmed
 
 def is_host_reachable(host: str) -> bool:
     try:
         # For Linux/WSL: use '-c 1' for one packet
-        result = subprocess.run(
+        result = run_command(
             ["ping", "-c", "1", host],
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL
@@ -268,14 +392,6 @@ def is_host_reachable(host: str) -> bool:
     except Exception:
         return False
 
-start_ssh_agent_if_needed()
-
-if not agent_has_identities():
-    for key in KEYS:
-        add_key_with_passphrase(key)
-else:
-    print("ssh-agent already has identities loaded.")
-
 REMOTES_DATA = [
     {
         "host": "AV600-nmrsu",
@@ -334,32 +450,129 @@ REMOTES_DATA = [
     }
 ]
 
-for remote in REMOTES_DATA:
-    host = remote["host"]
+def sync_remotes(remotes: list[dict], use_inventory: bool = True, freshness: float = 0.0, compressor: BackgroundCompressor|None = None):
+    """
+    Syncs the history files of the given remotes. If a compressor is given,
+    the plain rotations left after the containment step are handed to it.
+    """
+    journal = load_journal()
+
+    for remote in remotes:
+        host = remote["host"]
 
-    if not is_host_reachable(remote["ip"]):
-        print(f"\n{colored('### Host ' + host + ' is not reachable...', 'red', attrs=['bold'])}")
-        continue
-    else:
-        print(f"\n{colored('### Processing ' + host + ' ...', 'green', attrs=['bold'])}")
+        if not is_host_reachable(remote["ip"]):
+            print(f"\n{colored('### Host ' + host + ' is not reachable...', 'red', attrs=['bold'])}")
+            continue
+        else:
+            print(f"\n{colored('### Processing ' + host + ' ...', 'green', attrs=['bold'])}")
+
+        user = remote["user"]
+        apps = remote["apps"]
+        usernames = remote["usernames"]
 
-    user = remote["user"]
-    apps = remote["apps"]
-    usernames = remote["usernames"]
+        # one listing call per host instead of a dry-run per app/user
+        inventory = remote_inventory(host, user) if use_inventory else None
+        known = load_inventory(host)
     
-    for app in apps:
-
-        print(f"\n    *** Processing {app}... ***\n")
-
-        for username in usernames:
-            dest_dir = Path(f"./{host}/{app}/{username}/.")
-            rsync_files(
-                host=host,
-                app=app,
-                username=username,
-                )
-            files: list[Path] = [p for p in dest_dir.glob("*") if p.is_file()]
-            if len(files) > 1:
-                run_containment(files_list=files)
-                fill_gaps(files_list=files)
-            
\ No newline at end of file
+        for app in apps:
+
+            print(f"\n    *** Processing {app}... ***\n")
+
+            for username in usernames:
+                dest_dir = Path(f"./{host}/{app}/{username}/.")
+                names = ["history", "history.old"]
+
+                if inventory is not None:
+                    remote_path = f"/opt/{app}/prog/curdir/{username}/"
+                    # only files that exist remotely and changed since they were last confirmed
+                    names = [
+                        name for name in names
+                        if remote_path + name in inventory
+                        and (known.get(remote_path + name) != inventory[remote_path + name] or not (dest_dir / name).exists())
+                    ]
+                    if not names:
+                        if any(remote_path + name in inventory for name in ("history", "history.old")):
+                            print(f"{colored('[ --- ]', 'white', attrs=['bold'])} {host}/{app}/{username} unchanged since last sync.")
+                        continue
+
+                # files confirmed by a recent (e.g. interrupted) run are not checked again
+                fresh = [
+                    name for name in names
+                    if is_fresh(journal.get(journal_key(host, app, username, name)), freshness, inventory[remote_path + name] if inventory is not None else None)
+                ]
+                if fresh:
+                    print(f"{colored('[ --- ]', 'white', attrs=['bold'])} {host}/{app}/{username}: {', '.join(fresh)} confirmed less than {freshness:.0f} s ago, skipped.")
+                    names = [name for name in names if name not in fresh]
+                    if not names:
+                        continue
+
+                confirmed = rsync_files(
+                    host=host,
+                    user=user,
+                    app=app,
+                    username=username,
+                    files=names,
+                    journal=journal,
+                    )
+
+                for name in confirmed:
+                    entry: dict = {"state": "confirmed", "confirmed_at": time.time()}
+                    if inventory is not None:
+                        entry["size"], entry["mtime"] = inventory[remote_path + name]
+                        known[remote_path + name] = inventory[remote_path + name]
+                    journal[journal_key(host, app, username, name)] = entry
+                save_journal(journal)
+                if inventory is not None:
+                    save_inventory(host, known)
+                # compressed rotations and temporary files are left alone
+                files: list[Path] = [
+                    p for p in dest_dir.glob("*")
+                    if p.is_file() and p.suffix not in COMPRESSED_SUFFIXES and not p.name.startswith(".")
+                ]
+                if len(files) > 1:
+                    run_containment(files_list=files)
+                    #fill_gaps(files_list=files)
+                if compressor is not None:
+                    for p in files:
+                        if p.exists() and re.fullmatch(r"history(\.old)?\.\d+", p.name):
+                            compressor.submit(p)
+
+def main(use_inventory: bool = True, freshness: float = 0.0, compress: str = "none", level: int|None = None, workers: int|None = None, agent: bool = False):
+    start_ssh_agent_if_needed()
+
+    if not agent_has_identities():
+        for key in KEYS:
+            add_key_with_passphrase(key)
+    else:
+        print("ssh-agent already has identities loaded.")
+
+    if agent:
+        # reporting refresh: only the lines needed, extracted on the PCs
+        import remote_extract
+        remote_extract.main()
+        return
+
+    compressor = BackgroundCompressor(compress, level=level, workers=workers) if compress != "none" else None
+    try:
+        sync_remotes(REMOTES_DATA, use_inventory=use_inventory, freshness=freshness, compressor=compressor)
+    except KeyboardInterrupt:
+        print(f"\n{colored('Interrupted:', 'red', attrs=['bold'])} progress saved in {JOURNAL_FILE}, the next run resumes from there.")
+    finally:
+        if compressor is not None:
+            compressor.close()
+
+def cli(argv: list[str]|None = None) -> None:
+    parser = argparse.ArgumentParser(description="Download the history files of the instrument PCs")
+    parser.add_argument("--no-inventory", action="store_true", help="Probe every app/user with an rsync dry-run instead of listing each host once")
+    parser.add_argument("--fresh", type=float, default=0.0, help="Resume an interrupted run: skip files confirmed less than this many seconds ago and unchanged since (default 0, checks everything)")
+    parser.add_argument("--compress", choices=["none", *METHODS], default="none", help="Compress the rotations in the background (zstd needs the zstandard package)")
+    parser.add_argument("--level", type=int, default=None, help="Compression level (default: " + ", ".join(f"{m} {lvl}" for m, (suffix, lvl) in METHODS.items()) + ")")
+    parser.add_argument("--workers", type=int, default=None, help="Compression workers (default: one per CPU)")
+    parser.add_argument("--agent", action="store_true", help="Do not download the files: extract sessions and objects on the PCs (see remote_extract.py)")
+
+    args: argparse.Namespace = parser.parse_args(argv)
+
+    main(use_inventory=not args.no_inventory, freshness=args.fresh, compress=args.compress, level=args.level, workers=args.workers, agent=args.agent)
+
+if __name__ == "__main__":
+    cli()
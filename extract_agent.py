@@ -0,0 +1,151 @@
+# extract_agent.py
+# Extraction agent run ON the instrument PCs (sent over ssh by
+# remote_extract.py): reads the history files from a byte offset and writes
+# back only the lines the parsers need, so that a reporting refresh moves
+# kilobytes instead of whole files.
+#
+# Kept lines, per session buffer (a buffer starts at a date_time_start line):
+#   - the first 3 lines (date/start of the session)
+#   - the last line (end / "history registration finished")
+#   - the last line matching end_pattern (end of sessions without it)
+#   - object changes and date lines (date of the objects)
+# Parsed with the same code, the reduced file gives the same sessions and
+# objects as the original one.
+#
+# It must run on the old Python 2 of the instrument PCs as well as on
+# Python 3: no with/f-strings/b'' literals/json, standard library only.
+#
+# Output, one line per record, prefixed by the index of the file in the job:
+#   <i>\tL\t<line>                                                a kept line
+#   <i>\tE\t<offset>\t<kept bytes>\t<head len>\t<head crc>\t<reset>   end of file
+#   <i>\tM                                                        file missing
+# <offset> is where the last (still open) session starts: the next run
+# starts from there, replacing what follows <kept bytes> in the local copy.
+import re
+import sys
+import zlib
+
+HEAD_SIZE = 1024
+
+def to_bytes(text):
+    return text.encode("ascii")
+
+TAB = to_bytes("\t")
+NEWLINE = to_bytes("\n")
+
+def crc(data):
+    return zlib.crc32(data) & 0xffffffff
+
+class Buffer:
+    """
+    Lines of the current session buffer: [raw, head, other, end, last] with
+    the reasons to keep each of them.
+    """
+    def __init__(self):
+        self.lines = []
+        self.count = 0
+        self.end = None
+        self.last = None
+
+    def add(self, raw, other, end):
+        self.count = self.count + 1
+        entry = [raw, self.count <= 3, other, end, True]
+        if self.last is not None:
+            self.last[4] = False
+        self.last = entry
+        if end:
+            if self.end is not None:
+                self.end[3] = False
+            self.end = entry
+        self.lines.append(entry)
+
+    def kept(self):
+        result = []
+        for entry in self.lines:
+            if entry[1] or entry[2] or entry[3] or entry[4]:
+                result.append(entry[0])
+        return result
+
+def reduce_file(index, path, offset, head_len, head_crc, patterns, out):
+    start_re = patterns["date_time_start"]
+    end_re = patterns["end"]
+    object_re = patterns["object"]
+    date_re = patterns["date"]
+    prefix = to_bytes("%d" % index) + TAB
+
+    try:
+        f = open(path, "rb")
+    except IOError:
+        out.write(prefix + to_bytes("M") + NEWLINE)
+        return
+
+    try:
+        f.seek(0, 2)
+        size = f.tell()
+        f.seek(0)
+        head = f.read(HEAD_SIZE)
+        # rotated or rewritten since the last run: start again
+        reset = 0
+        if size < offset or (head_len and crc(head[:head_len]) != head_crc):
+            reset = 1
+            offset = 0
+
+        f.seek(offset)
+        pos = offset
+        emitted = 0
+        buffer = Buffer()
+        buffer_pos = offset
+        buffer_emitted = 0
+        last_raw = None
+        for raw in f:
+            last_raw = raw
+            text = raw.decode("utf-8", "replace").rstrip("\n")
+            if text.endswith("\r"):
+                text = text[:-1]
+            if text:
+                if start_re.match(text.lstrip()) and buffer.count:
+                    for line in buffer.kept():
+                        if not line.endswith(NEWLINE):
+                            line = line + NEWLINE
+                        out.write(prefix + to_bytes("L") + TAB + line)
+                        emitted = emitted + len(line)
+                    buffer = Buffer()
+                    buffer_pos = pos
+                    buffer_emitted = emitted
+                elif not buffer.count:
+                    buffer_pos = pos
+                    buffer_emitted = emitted
+                rstripped = text.rstrip()
+                other = bool(object_re.search(rstripped) or date_re.search(rstripped))
+                buffer.add(raw, other, bool(end_re.search(rstripped)))
+            pos = pos + len(raw)
+
+        lines = buffer.kept()
+        # the last line of the file closes the last buffer, even when blank
+        if last_raw is not None and not last_raw.rstrip(to_bytes("\r\n")):
+            lines.append(last_raw)
+        for line in lines:
+            if not line.endswith(NEWLINE):
+                line = line + NEWLINE
+            out.write(prefix + to_bytes("L") + TAB + line)
+        new_head = head[:HEAD_SIZE]
+        out.write(prefix + to_bytes("E\t%d\t%d\t%d\t%d\t%d" % (buffer_pos, buffer_emitted, len(new_head), crc(new_head), reset)) + NEWLINE)
+    finally:
+        f.close()
+
+def main(job):
+    """
+    job: (patterns, files) with patterns {name: (source, flags)} and files
+    [(path, offset, head len, head crc), ...]
+    """
+    pattern_sources, files = job
+    patterns = {}
+    for name in pattern_sources:
+        source, flags = pattern_sources[name]
+        patterns[name] = re.compile(source, flags)
+    out = getattr(sys.stdout, "buffer", sys.stdout)
+    index = 0
+    for path, offset, head_len, head_crc in files:
+        reduce_file(index, path, offset, head_len, head_crc, patterns, out)
+        index = index + 1
+    out.flush()
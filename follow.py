@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+#follow.py
+# Live follow mode: keeps one ssh stream per host tailing the active history
+# files, appends the new bytes to the local copies (./<host>/<app>/<user>/history,
+# as laid out by download_history_files) and extracts the object changes as
+# soon as they are written.
+import argparse
+import csv
+import hashlib
+import os
+import shlex
+import subprocess
+import threading
+import time
+from pathlib import Path
+from termcolor import colored
+
+from download_history_files import REMOTES_DATA, remote_inventory, ssh_options
+from objects import ObjectEvent, date_pattern, extract_objects
+
+# replaced in tests/benchmarks with a fake transport
+popen = subprocess.Popen
+
+# bytes of the head of a file compared with the remote one at connection
+HEAD_SIZE = 1024
+# seconds between the remote checks of the followed file identity
+CHECK_INTERVAL = 5
+# seconds a line appended to a local copy may wait for its fsync
+FSYNC_INTERVAL = 1.0
+
+lock = threading.Lock()
+
+def last_date(local_file: Path, chunk: int = 64 * 1024) -> str|None:
+    """
+    Returns the last date found in a history file, reading it backwards.
+    """
+    if not local_file.exists():
+        return None
+    with open(local_file, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        while end > 0:
+            start = max(0, end - chunk)
+            f.seek(start)
+            lines = f.read(end - start + 1024).decode("utf-8", errors="replace").splitlines()
+            # the first line may be cut, unless the read started at the beginning
+            for line in reversed(lines if start == 0 else lines[1:]):
+                match_date = date_pattern.search(line.rstrip())
+                if match_date:
+                    return match_date.group("date")
+            end = start
+    return None
+
+def trailing_partial_line(local_file: Path) -> bytes:
+    """
+    Returns the last line of the local copy if it is not terminated by a
+    newline (the copy was taken while the line was being written).
+    """
+    if not local_file.exists():
+        return b""
+    with open(local_file, "rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        f.seek(max(0, end - 64 * 1024))
+        tail = f.read()
+    if not tail or tail.endswith(b"\n"):
+        return b""
+    return tail.rsplit(b"\n", 1)[-1]
+
+class FollowedFile:
+    """
+    State of one followed history file: local copy, byte offset, date context
+    for lines without a date.
+    """
+    def __init__(self, host: str, app: str, username: str, remote_path: str):
+        self.host = host
+        self.app = app
+        self.username = username
+        self.remote_path = remote_path
+        self.local_file = Path(f"./{host}/{app}/{username}/history")
+        self.date: str|None = last_date(self.local_file)
+        self.partial: bytes = trailing_partial_line(self.local_file)
+        self.rotated: bool = False
+        self.dirty: bool = False
+        self.sync_timer: threading.Timer|None = None
+
+    @property
+    def offset(self) -> int:
+        # bytes already in the local copy: the handshake position
+        return self.local_file.stat().st_size if self.local_file.exists() else 0
+
+    def head_digest(self) -> str:
+        # md5 of the first bytes of the local copy, as printed by md5sum
+        if not self.local_file.exists():
+            return hashlib.md5(b"").hexdigest()
+        with open(self.local_file, "rb") as f:
+            return hashlib.md5(f.read(HEAD_SIZE)).hexdigest()
+
+    def append(self, data: bytes, writer: csv.writer) -> list[ObjectEvent]:
+        """
+        Appends the data of a line to the local copy, then extracts the object
+        changes of the line once it is complete (newline included): a line cut
+        by a dropped stream is completed by the next connection. The copy is
+        flushed at every line and fsynced by a timer at most FSYNC_INTERVAL
+        seconds later.
+        """
+        self.local_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.local_file, "ab") as f:
+            f.write(data)
+            f.flush()
+        self.dirty = True
+        if self.sync_timer is None:
+            self.sync_timer = threading.Timer(FSYNC_INTERVAL, self.sync)
+            self.sync_timer.daemon = True
+            self.sync_timer.start()
+
+        self.partial += data
+        if not self.partial.endswith(b"\n"):
+            return []
+        line = self.partial.decode("utf-8", errors="replace")
+        self.partial = b""
+
+        match_date = date_pattern.search(line.rstrip())
+        if match_date:
+            self.date = match_date.group("date")
+
+        events = list(extract_objects([line], self.host, self.app, self.username, "history", date=self.date))
+        with lock:
+            for event in events:
+                print(f"{colored('[LIVE ]', 'green', attrs=['bold'])} {event.date} {event.time} {event.host} {event.app} {event.user} {event.userdir} {event.object}")
+                writer.writerow(event)
+        return events
+
+    def sync(self) -> None:
+        """
+        Fsyncs the local copy if lines were appended since the last fsync.
+        """
+        # cleared first: a line appended from now on starts a new timer
+        self.sync_timer = None
+        if not self.dirty or not self.local_file.exists():
+            return
+        self.dirty = False
+        with open(self.local_file, "rb") as f:
+            os.fsync(f.fileno())
+
+    def close(self) -> None:
+        # the stream is gone: fsync now rather than when the timer fires
+        timer = self.sync_timer
+        if timer is not None:
+            timer.cancel()
+        self.sync()
+
+    def is_tail_notice(self, data: bytes) -> bool:
+        # tail messages (e.g. "file truncated") come in the stream, in order
+        return b"tail: " in data and self.remote_path.encode("utf-8") in data
+
+def follow_command(files: list[FollowedFile]) -> str:
+    """
+    Remote shell command tailing every file from its offset; each output line
+    is prefixed with the index of its file and a tab. tail -f follows the
+    open file, so a rotated or replaced file is never streamed into the old
+    local copy. The line "<i> R" reports that file <i> is no longer the one
+    of the local copy: its head differs at connection, its inode changed, or
+    tail found it truncated (its message is in the stream). tail writes to a
+    fifo read by sed, so that its own PID is the one killed on rotation.
+    """
+    parts: list[str] = []
+    for i, followed in enumerate(files):
+        path: str = shlex.quote(followed.remote_path)
+        rotated: str = f"echo '{i} R'"
+        parts.append(
+            f"( if [ \"$(head -c {min(followed.offset, HEAD_SIZE)} {path} | md5sum)\" != '{followed.head_digest()}  -' ]; then {rotated}; exit; fi;"
+            f" ino=$(stat -c %i {path}); d=$(mktemp -d) && mkfifo \"$d/out\" || exit;"
+            f" sed -u 's/^/{i}\t/' < \"$d/out\" &"
+            f" LC_ALL=C tail -c +{followed.offset + 1} -f {path} > \"$d/out\" 2>&1 & tpid=$!;"
+            f" while sleep {CHECK_INTERVAL} && [ \"$(stat -c %i {path} 2>/dev/null)\" = \"$ino\" ]; do :; done;"
+            f" {rotated}; kill $tpid; rm -rf \"$d\" ) &"
+        )
+    parts.append("wait")
+    return " ".join(parts)
+
+def follow_host(remote: dict, writer: csv.writer, max_backoff: float = 60.0, stop: threading.Event|None = None) -> None:
+    """
+    Follows the active history files of a host, reconnecting with exponential
+    backoff. At every (re)connection the offsets are taken from the local
+    copies, so no line is lost or appended twice.
+    """
+    host: str = remote["host"]
+    user: str = remote["user"]
+    backoff = 1.0
+    stop = stop or threading.Event()
+
+    while not stop.is_set():
+        inventory = remote_inventory(host, user)
+        files: list[FollowedFile] = []
+        if inventory is not None:
+            for app in remote["apps"]:
+                for username in remote["usernames"]:
+                    remote_path = f"/opt/{app}/prog/curdir/{username}/history"
+                    if remote_path not in inventory:
+                        continue
+                    followed = FollowedFile(host, app, username, remote_path)
+                    if inventory[remote_path][0] < followed.offset:
+                        print(f"{colored('[WARN ]', 'yellow', attrs=['bold'])} {host}/{app}/{username}/history is shorter than the local copy (rotated?): run the sync, not followed")
+                        continue
+                    files.append(followed)
+
+        if not files:
+            print(f"{colored('[WARN ]', 'yellow', attrs=['bold'])} {host}: nothing to follow, retrying in {backoff:.0f} s")
+            stop.wait(backoff)
+            backoff = min(backoff * 2, max_backoff)
+            continue
+
+        cmd = ["ssh", *ssh_options(host), "-oBatchMode=yes", "-oServerAliveInterval=30", f"{user}@{host}", follow_command(files)]
+        print(f"{colored('[LIVE ]', 'white', attrs=['bold'])} {host}: following {len(files)} history files")
+        proc = popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        try:
+            for raw in proc.stdout:
+                index, sep, data = raw.partition(b"\t")
+                rotated: bool = False
+                if not sep:
+                    index, sep, kind = raw.rstrip(b"\n").partition(b" ")
+                    rotated = kind == b"R"
+                if not sep or not index.isdigit() or int(index) >= len(files):
+                    continue
+                followed = files[int(index)]
+                if followed.rotated:
+                    continue
+                if rotated or followed.is_tail_notice(data):
+                    # what follows is not the content of the local copy
+                    followed.rotated = True
+                    print(f"{colored('[WARN ]', 'yellow', attrs=['bold'])} {host}/{followed.app}/{followed.username}/history was rotated or replaced: run the sync, not followed")
+                    if all(f.rotated for f in files):
+                        break
+                    continue
+                followed.append(data, writer)
+                backoff = 1.0
+                if stop.is_set():
+                    break
+        finally:
+            proc.kill()
+            proc.wait()
+            for followed in files:
+                followed.close()
+
+        if not stop.is_set():
+            print(f"{colored('[WARN ]', 'yellow', attrs=['bold'])} {host}: stream closed, reconnecting in {backoff:.0f} s")
+            stop.wait(backoff)
+            backoff = min(backoff * 2, max_backoff)
+
+def main(hosts: list[str]|None = None, output_file: str = "objects_live.csv"):
+    remotes = [remote for remote in REMOTES_DATA if not hosts or remote["host"] in hosts]
+
+    new_file = not Path(output_file).exists()
+    with open(output_file, "a", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        if new_file:
+            writer.writerow(ObjectEvent._fields)
+
+        class FlushingWriter:
+            # rows are visible to readers of the csv as soon as they are written
+            def writerow(self, row):
+                writer.writerow(row)
+                f.flush()
+
+        stop = threading.Event()
+        threads = [
+            threading.Thread(target=follow_host, args=(remote, FlushingWriter()), kwargs={"stop": stop}, daemon=True)
+            for remote in remotes
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in threads):
+                time.sleep(1)
+        except KeyboardInterrupt:
+            stop.set()
+            print("Follow stopped.")
+
+def cli(argv: list[str]|None = None) -> None:
+    parser = argparse.ArgumentParser(description="Follow the active history files of the instrument PCs")
+    parser.add_argument("--host", action="append", dest="hosts", help="Follow only this host (repeatable)")
+    parser.add_argument("--output", default="objects_live.csv", help="CSV file the object changes are appended to")
+
+    args: argparse.Namespace = parser.parse_args(argv)
+
+    main(hosts=args.hosts, output_file=args.output)
+
+if __name__ == "__main__":
+    cli()
@@ -1,11 +1,19 @@
 import os
 import re
 import datetime
-from datetime import timedelta, datetime
-import pandas as pd
-from utils import find_history_files, run_containment#, fill_gaps
+from datetime import datetime, date
+from utils import find_history_files, plan_containment, materialize, source_name, iter_lines_since, with_last, modified_since, parse_date#, fill_gaps
+from watch import watch_files
+from chunkstore import archived_files, archived_mtime, open_source
+from compression import open_compressed, plain_name
+from sinks import write_pipelined
+from rollups import ROLLUP_FILE, RollupSink
+from retention import PRUNE_MANIFEST, prune_stversions
+from sharding import parse_shard, select_files, partial_name, write_partial, read_partials
 from pathlib import Path
-import shutil
+from typing import Iterable, Iterator, NamedTuple
+import argparse
+import itertools
 
 NAME_MAP = {
     # canonical names used in final columns
@@ -64,55 +72,38 @@ end_duration_pattern = re.compile(
     r"(?:\safter\s((?P<duration_h>\d{1,2}:\d{2}:\d{2})(?:.*)?|(?P<duration_s>\d{2}\.\d{3})\ss))?$",
     re.IGNORECASE
 )
-def calculate_duration(lines: list, date_start:str, start: str, end: str) -> list[str|None]:
-    new_date:str|None = None
+class RawSession(NamedTuple):
+    """
+    Fields of a session as found in its buffer, before the end date and the
+    duration are computed (finalize_sessions).
+    """
+    date_start: str|None
+    start: str|None
+    end: str|None
+    duration_h: str|None    # "history registration finished after HH:MM:SS"
+    duration_s: str|None    # "history registration finished after SS.mmm s"
+    new_date: str|None      # date of the last date line, if not date_start
+
+def last_new_date(lines: list, date_start: str) -> str|None:
+    # the last date line of the buffer, if the session ended on another day
     for line in reversed(lines):
         match_nd = date_time_start_pattern.search(line.rstrip())
         if match_nd:
             new_date = match_nd.group("date")
-            if new_date != date_start:
-                break
-            else:
-                new_date = None
-                break
-    date_end: str|None = None
-    if new_date:
-        date_end = f"{new_date}, {end}"
-    else:
-        date_end = f"{date_start}, {end}"
+            return new_date if new_date != date_start else None
+    return None
 
-    date_start = f"{date_start}, {start}"
-    
-    duration_fmt = "%Y-%m-%d, %H:%M:%S"
-    
-    try:
-        start_dt = datetime.strptime(date_start, duration_fmt)
-        end_dt = datetime.strptime(date_end, duration_fmt)
-        elapsed = end_dt - start_dt
-        hours, remainder = divmod(elapsed.total_seconds(), 3600)
-        minutes, seconds = divmod(remainder, 60)
-        duration = f"{int(hours):02}:{int(minutes):02}:{int(seconds):02} h" 
-        return [date_end.split(",")[0], duration]
-
-    except ValueError:
-        print(f"Error parsing dates in buffer.")
-        return ["Error", "Error"]
-    
-def extract_data(raw_lines) -> str|None:
+def extract_fields(raw_lines) -> RawSession|None:
     date_start: str|None
-    date_end: str|None
     start: str|None
     end: str|None
-    duration: str|None
     lines = raw_lines.splitlines()
     try:
         if len(lines) >= 1:
             match_ds = date_time_start_pattern.search(lines[0].rstrip())
             if match_ds:
                 date_start = match_ds.group("date")
-                date_end = date_start
                 start = match_ds.group("start")
-                duration = None
                 if not start:
                     match_s = start_pattern.search(lines[2].rstrip())
                     if match_s:
@@ -124,75 +115,192 @@ def extract_data(raw_lines) -> str|None:
                     end: str|None = match_ed.group("end")
                     duration_h: str|None = match_ed.group("duration_h")
                     duration_s: str|None = match_ed.group("duration_s")
-                    if duration_h:
-                        duration = f"{duration_h} h"
-                    elif duration_s:
-                        duration = f"{duration_s} s"
-                    else:
-                        date_end, duration = calculate_duration(lines, date_start, start, end)
-
-                    return date_start, date_end, start, end, normalize_time(duration)
+                    if duration_h or duration_s:
+                        return RawSession(date_start, start, end, duration_h, duration_s, None)
+                    return RawSession(date_start, start, end, None, None, last_new_date(lines, date_start))
                 else:
                     for line in reversed(lines):
                         match_e = end_pattern.search(line.rstrip())
                         if match_e:
                             end: str|None = match_e.group("end")
-                            date_end, duration = calculate_duration(lines, date_start, start, end)
-                            return date_start, date_end, start, end, normalize_time(duration)
+                            return RawSession(date_start, start, end, None, None, last_new_date(lines, date_start))
                         continue
             else:
-                return None, None, None, None, None
+                return RawSession(None, None, None, None, None, None)
         else:
             print(f"Buffer has less than 3 lines.")
-            return None, None, None, None, None
+            return RawSession(None, None, None, None, None, None)
     except Exception as e:
         print(f"Exception caught: {e}")
-        return None, None, None, None, None
-
-def normalize_time(value: str) -> str:
-    value = value.strip().lower()
-    if value.endswith('h'):  # e.g., "14:56:45 h"
-        # Remove 'h' and return as HH:MM:SS
-        return value.replace(' h', '')
-    elif value.endswith('s'):  # e.g., "29.442 s"
-        # Extract seconds, discard milliseconds
-        seconds = float(value.replace(' s', ''))
-        whole_seconds = int(round(seconds))  # discard ms
-        # Convert to HH:MM:SS
-        return str(timedelta(seconds=whole_seconds))
-    else:
-        return value  # fallback
+        return RawSession(None, None, None, None, None, None)
 
-def main():
-    records = []  # collect rows here
+def parse_days(values: list[str|None]):
+    """
+    Days since 1970-01-01 of YYYY-MM-DD strings, and whether they are valid
+    dates (as datetime.strptime would tell).
+    """
+    import numpy as np
+
+    raw = np.array([(value or "").encode("ascii", "replace") for value in values], dtype="S10")
+    digits = np.frombuffer(raw.tobytes(), dtype=np.uint8).reshape(len(values), 10).astype(np.int64) - ord("0")
+    y = digits[:, 0] * 1000 + digits[:, 1] * 100 + digits[:, 2] * 10 + digits[:, 3]
+    m = digits[:, 5] * 10 + digits[:, 6]
+    d = digits[:, 8] * 10 + digits[:, 9]
+
+    leap = (y % 4 == 0) & ((y % 100 != 0) | (y % 400 == 0))
+    days_in_month = np.array([31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31])[np.clip(m, 1, 12) - 1] + ((m == 2) & leap)
+    valid = np.array([value is not None for value in values], dtype=bool) & (y >= 1) & (m >= 1) & (m <= 12) & (d >= 1) & (d <= days_in_month)
+
+    # days from civil (proleptic Gregorian calendar)
+    y = y - (m <= 2)
+    era = np.floor_divide(y, 400)
+    yoe = y - era * 400
+    doy = (153 * (m + np.where(m > 2, -3, 9)) + 2) // 5 + d - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468, valid
+
+def parse_seconds(values: list[str|None]):
+    """
+    Seconds since midnight of H:MM:SS / HH:MM:SS strings, and whether they
+    are valid times.
+    """
+    import numpy as np
+
+    raw = np.array([(value or "").zfill(8).encode("ascii", "replace") for value in values], dtype="S8")
+    digits = np.frombuffer(raw.tobytes(), dtype=np.uint8).reshape(len(values), 8).astype(np.int64) - ord("0")
+    h = digits[:, 0] * 10 + digits[:, 1]
+    m = digits[:, 3] * 10 + digits[:, 4]
+    s = digits[:, 6] * 10 + digits[:, 7]
+    valid = np.array([value is not None for value in values], dtype=bool) & (h >= 0) & (h <= 23) & (m >= 0) & (m <= 59) & (s >= 0) & (s <= 59)
+    return h * 3600 + m * 60 + s, valid
+
+def finalize_sessions(raw_sessions: list[RawSession|None]) -> list[tuple|None]:
+    """
+    Computes, in one vectorized pass, the end dates and the durations of the
+    sessions extracted by extract_fields. Returns the
+    (date_start, date_end, start, end, duration) tuples.
+    Durations are HH:MM:SS strings: the one written in the history file,
+    the rounded seconds of "... after SS.mmm s", or end - start (across
+    midnight if the session ended on another day); "Error" if the dates
+    cannot be parsed.
+    """
+    import numpy as np
+
+    results: list[tuple|None] = [None] * len(raw_sessions)
+    seconds_idx: list[int] = []
+    computed_idx: list[int] = []
+    for i, raw in enumerate(raw_sessions):
+        if raw is None:
+            continue
+        if raw.date_start is None:
+            results[i] = (None, None, None, None, None)
+        elif raw.duration_h:
+            results[i] = (raw.date_start, raw.date_start, raw.start, raw.end, raw.duration_h.lower())
+        elif raw.duration_s:
+            seconds_idx.append(i)
+        else:
+            computed_idx.append(i)
+
+    if seconds_idx:
+        # whole seconds (round half to even, as round()) formatted as str(timedelta)
+        total = np.round(np.array([raw_sessions[i].duration_s for i in seconds_idx], dtype=np.float64)).astype(np.int64)
+        days, rest = np.divmod(total, 86400)
+        hours, rest = np.divmod(rest, 3600)
+        minutes, seconds = np.divmod(rest, 60)
+        text = np.char.add(np.char.add(np.char.add(hours.astype(str), ":"), np.char.zfill(minutes.astype(str), 2)), ":")
+        text = np.char.add(text, np.char.zfill(seconds.astype(str), 2))
+        prefix = np.where(days == 0, "", np.char.add(days.astype(str), np.where(days == 1, " day, ", " days, ")))
+        for i, duration in zip(seconds_idx, np.char.add(prefix, text).tolist()):
+            raw = raw_sessions[i]
+            results[i] = (raw.date_start, raw.date_start, raw.start, raw.end, duration)
+
+    if computed_idx:
+        raws = [raw_sessions[i] for i in computed_idx]
+        date_end = [raw.new_date or raw.date_start for raw in raws]
+        day_start, valid_ds = parse_days([raw.date_start for raw in raws])
+        day_end, valid_de = parse_days(date_end)
+        time_start, valid_ts = parse_seconds([raw.start for raw in raws])
+        time_end, valid_te = parse_seconds([raw.end for raw in raws])
+        valid = valid_ds & valid_de & valid_ts & valid_te
+
+        elapsed = (day_end - day_start) * 86400 + time_end - time_start
+        hours, rest = np.divmod(elapsed, 3600)
+        minutes, seconds = np.divmod(rest, 60)
+        # f"{hours:02}": a negative elapsed time gives e.g. "-3:59:00"
+        text = np.char.add(np.char.add(np.char.zfill(hours.astype(str), 2), ":"), np.char.zfill(minutes.astype(str), 2))
+        text = np.char.add(np.char.add(text, ":"), np.char.zfill(seconds.astype(str), 2))
+
+        for i, raw, end_day, ok, duration in zip(computed_idx, raws, date_end, valid.tolist(), text.tolist()):
+            if ok:
+                results[i] = (raw.date_start, end_day, raw.start, raw.end, duration)
+            else:
+                print(f"Error parsing dates in buffer.")
+                results[i] = (raw.date_start, "Error", raw.start, raw.end, "error")
+
+    return results
+
+def extract_data(raw_lines) -> tuple|None:
+    return finalize_sessions([extract_fields(raw_lines)])[0]
+
+def lineage_key(path: str) -> tuple[str, str|None, str, str]|None:
+    """
+    Returns the (host, host_600, app, user) lineage of a history file path,
+    ignoring whether it lives in the .stversions/ folder or not.
+    """
+    match = host_app_user_pattern_syncthing.search(str(path))
+    if not match:
+        return None
+    return (match.group("host"), match.group("host_600"), match.group("app"), match.group("user"))
+
+def group_stversions(results: list[str]) -> list[list[Path]]:
+    """
+    Groups history files by lineage in a single pass and returns, sorted,
+    the groups containing at least one .stversions/ file.
+    """
+    groups: dict[tuple, list[Path]] = {}
+    has_stversions: set[tuple] = set()
+    for path in results:
+        key = lineage_key(path)
+        if key is None:
+            continue
+        groups.setdefault(key, []).append(Path(path))
+        if ".stversions/" in path:
+            has_stversions.add(key)
+
+    return [sorted(groups[key]) for key in groups if key in has_stversions]
+
+def discover_history_files(base: Path,
+                           stversions: bool = False,
+                           shard: tuple[int, int]|None = None,
+                           hosts: list[str]|None = None,
+                           apps: list[str]|None = None) -> list[str]:
+    """
+    Returns the history files found in the main history directories under base
+    and, if stversions is True, also in the .stversions/ folders.
+    Only the files of the given shard, hosts and apps are returned.
+    """
     results = []  # collect files paths here
     matches: list[Path] = []
-    records_counter = 1
-    base = Path("/mnt/j")
 
     matches.extend(list(base.glob("*history*/*/prog/curdir/*")))
-    matches.extend(list(base.glob("*history*/.stversions/*/prog/curdir/*")))
+    if stversions:
+        matches.extend(list(base.glob("*history*/.stversions/*/prog/curdir/*")))
     
     for m in matches:
         results.extend(find_history_files(str(m.absolute())))
 
+    return select_files(results, host_app_user_pattern_syncthing, shard, hosts, apps, name_map=NAME_MAP)
+
+def promote_stversions(base: Path, link_mode: str = "auto", **selection) -> None:
+    results: list[str] = discover_history_files(base, stversions=True, **selection)
+
     # Run containment if stversions are present
-    to_be_contained: list[list[Path]] = []
-    for path in results:
-        if ".stversions/" in path:
-            sublist: list[Path] = []
-            before, sep, after = path.partition(".stversions/")
-            after, sep, filename = after.partition("history")
-            for item in results:
-                if before in item and after in item:
-                    sublist.append(Path(item))
-
-            sublist = sorted(sublist)
-            if sublist not in to_be_contained:
-                to_be_contained.append(sublist)
-
-    # Move .stversions/ files to main history directory
+    to_be_contained: list[list[Path]] = group_stversions(results)
+
+    # Check containment against the .stversions/ originals in place and
+    # move to the main history directory only the files surviving it
     for item in to_be_contained:
+        sources: dict[Path, Path] = {}
         for i, file in enumerate(item):
             if ".stversions/" in str(file):
                 source: Path = file
@@ -202,95 +310,257 @@ def main():
                 
                 # Check if destination exists
                 if not destination.exists():
-                    shutil.copy2(source, destination)
-                    print(f"!!! {source.name} copied to {destination.parent}/")
+                    sources[destination] = source
                 else:
                     print(f"File already exists: {destination}")
         
         # removes duplicates, preserving order, by converting to dict (keys are unique) and back to list
         item: list[Path] = list(dict.fromkeys(item))
     
-        run_containment(files_list=item)
+        to_be_deleted: list[Path] = plan_containment(files_list=item, sources=sources)
+        for file in item:
+            if file in to_be_deleted:
+                if file not in sources:
+                    file.unlink()
+            elif file in sources:
+                how: str = materialize(sources[file], file, link_mode=link_mode)
+                print(f"!!! {sources[file].name} {how} to {file.parent}/")
         #fill_gaps(files_list=item)
-    
-    results.clear()
-    matches.clear()
 
-    matches.extend(list(base.glob("*history*/*/prog/curdir/*")))
-    for m in matches:
-        results.extend(find_history_files(str(m.absolute())))
+class Session(NamedTuple):
+    host: str|None
+    app: str|None
+    user: str|None
+    file: str|None
+    date_start: str|None    # YYYY-MM-DD
+    date_end: str|None      # YYYY-MM-DD
+    start: str|None         # HH:MM:SS
+    end: str|None           # HH:MM:SS
+    duration: str|None      # H:MM:SS
 
-    for file_counter, path in enumerate(results, start=1):
+def source_metadata(source) -> tuple[str|None, str|None, str|None, str|None]:
+    """
+    Returns (host, app, user, file) of a history file source from its path,
+    or Nones for sources without a recognizable path.
+    """
+    name: str|None = source_name(source)
+    if name is None:
+        return None, None, None, None
 
-        match = host_app_user_pattern_syncthing.search(str(path))
-        
-        if match:
-            host: str|None = match.group("host")
-            stversions: str|None = None
-            if match.groupdict().get("host_600") is not None:
-                host = match.group("host_600")
-            if match.groupdict().get("stversions") is not None:
-                stversions = match.group("stversions")
-            host = NAME_MAP.get(host)
-            app: str|None = match.group("app")
-            user: str|None = match.group("user")
-            file: str|None = match.group("file")
-
-            #if host in ["AV600-nmrsu",
-            #            "AV300", 
-            #            "AvanceNeo400",
-            #            "PharmaScan"] :
-            #    continue
-
-            buffer = ''
-            with open(path, 'r', encoding='utf-8') as f:
-
-                print(f"[{file_counter}] Processing file: {path}")
-                lines = f.readlines()
-                buffer_number = 1
-                
-                for i, raw_line in enumerate(lines):
-                   
-                    line = raw_line.rstrip("\n")
-                    if line:
-                        if date_time_start_pattern.match(line.lstrip()) or (i == len(lines) - 1):
-                            # processa buffer precedente
-                            if buffer:
-                                
-                                # last line of the file
-                                if raw_line == lines[-1]:
-                                    buffer += line + "\n"
-                                
-                                #print(f"Processing buffer {buffer_number}")
-                                date_start, date_end, start, end, duration = extract_data(buffer)
-                                print(f"[{records_counter}] Record found: {host}/{app}/{user} -> {file} ({date_start}, {start}, {date_end}, {end}, {duration})")
-                                
-                                # append a structured record
-                                records.append({
-                                    "host": host,
-                                    "app": app,
-                                    "user": user,
-                                    "file": file,
-                                    "date_start": date_start,   # ideally a datetime.date / str in ISO format
-                                    "date_end": date_end,       # ideally a datetime.date / str in ISO format
-                                    "start": start,             # ideally a datetime / time / str in ISO
-                                    "end": end,                 # ideally a datetime.date / str in ISO format
-                                    "duration": duration        # seconds, HH:MM:SS, etc.
-                                })
-
-                                records_counter += 1
-                                buffer_number += 1
-                                buffer = line + "\n"   # start new buffer
-                            else:
-                                # riga di continuazione
-                                buffer += line + "\n"
-                        else:
-                            # riga di continuazione
-                            buffer += line + "\n"
+    match = host_app_user_pattern_syncthing.search(name)
+    if match:
+        host: str|None = match.group("host")
+        if match.groupdict().get("host_600") is not None:
+            host = match.group("host_600")
+        host = NAME_MAP.get(host)
+        return host, match.group("app"), match.group("user"), plain_name(match.group("file"))
+
+    match = host_app_user_pattern_local.search(name)
+    if match:
+        return NAME_MAP.get(match.group("host")), match.group("app"), match.group("user"), plain_name(match.group("file"))
+
+    return None, None, None, plain_name(os.path.basename(name))
+
+def session_buffer_step(buffer: str, raw_line: str, is_last: bool) -> tuple[str|None, str]:
+    """
+    One step of the session buffer state machine: adds a line to the current
+    buffer and returns (the buffer completed by this line or None, the new
+    current buffer).
+    """
+    line = raw_line.rstrip("\n")
+    if line:
+        if date_time_start_pattern.match(line.lstrip()) or is_last:
+            # processa buffer precedente
+            if buffer:
+
+                # last line of the file
+                if is_last:
+                    buffer += line + "\n"
+
+                return buffer, line + "\n"   # start new buffer
+            else:
+                # riga di continuazione
+                buffer += line + "\n"
+        else:
+            # riga di continuazione
+            buffer += line + "\n"
+    return None, buffer
+
+def iter_session_buffers(lines: Iterable[str]) -> Iterator[str]:
+    """
+    Splits the lines of a history file in session buffers, each one starting
+    with a date line (date_time_start_pattern). The last line of the file
+    closes the last buffer.
+    """
+    buffer = ''
+    for raw_line, is_last in with_last(lines):
+        done, buffer = session_buffer_step(buffer, raw_line, is_last)
+        if done:
+            yield done
+
+def decode_lines(data: bytes) -> list[str]:
+    # the lines of a history file, as read in text mode (universal newlines)
+    lines = []
+    for line in data.splitlines(keepends=True):
+        text = line.decode("utf-8")
+        if text.endswith("\r\n"):
+            text = text[:-2] + "\n"
+        elif text.endswith("\r"):
+            text = text[:-1] + "\n"
+        lines.append(text)
+    return lines
+
+def group_prefixes(contents: dict[str, bytes]) -> dict[str, list[str]]:
+    """
+    Maps each file that is not a byte prefix of a bigger one (root) to the
+    files that are (ending on one of its line ends, or identical).
+    """
+    roots: dict[str, list[str]] = {}
+    for path in sorted(contents, key=lambda path: len(contents[path]), reverse=True):
+        data = contents[path]
+        root = None
+        if data:
+            root = next((r for r in roots if contents[r].startswith(data) and (data.endswith(b"\n") or len(data) == len(contents[r]))), None)
+        if root is None:
+            roots[path] = []
+        else:
+            roots[root].append(path)
+    return roots
+
+def iter_root_buffers(lines: list[str], prefixes: dict[str, int]) -> tuple[list[str], dict[str, tuple[int, str|None]]]:
+    """
+    Splits the lines of a root file in session buffers, and derives those of
+    its prefix files (given with their number of lines) on the way: the first
+    k buffers of the root, plus the buffer closed by their own last line.
+    Returns the root buffers and, for each prefix, (k, last buffer).
+    """
+    ending: dict[int, list[str]] = {}
+    for path, n_lines in prefixes.items():
+        ending.setdefault(n_lines - 1, []).append(path)
+
+    buffers: list[str] = []
+    derived: dict[str, tuple[int, str|None]] = {}
+    buffer = ''
+    for i, raw_line in enumerate(lines):
+        for path in ending.get(i, ()):
+            done, _ = session_buffer_step(buffer, raw_line, True)
+            derived[path] = (len(buffers), done)
+        done, buffer = session_buffer_step(buffer, raw_line, i == len(lines) - 1)
+        if done:
+            buffers.append(done)
+    return buffers, derived
+
+def group_lineages(paths: list[str]) -> dict[str, list[str]]:
+    # history files by folder (host/app/user), in discovery order
+    lineages: dict[str, list[str]] = {}
+    for path in paths:
+        lineages.setdefault(os.path.dirname(path), []).append(path)
+    return lineages
+
+def parse_lineage(paths: list[str],
+                  file_counter: int = 1,
+                  records_counter: int = 1,
+                  since: date|None = None,
+                  archive: Path|None = None) -> list[dict]:
+    """
+    Parses the history files of one host/app/user lineage (rotations, .old
+    and timestamped copies). A file that is a byte prefix of a bigger one is
+    not parsed again: its sessions are taken from the bigger file. Returns
+    one record per distinct session, with the files it appears in ("files").
+    With since, files are parsed one by one from the start date on.
+    """
+    sessions_by_file: dict[str, list[Session]] = {}
+
+    if since is not None:
+        for path in paths:
+            print(f"[{file_counter}] Processing file: {path}")
+            file_counter += 1
+            with open_source(archive, path) as source:
+                sessions_by_file[path] = list(iter_sessions([source], since=since))
+    else:
+        contents: dict[str, bytes] = {}
+        for path in paths:
+            with open_source(archive, path) as source:
+                if isinstance(source, str):
+                    with open_compressed(source, "rb") as f:
+                        contents[path] = f.read()
+                else:
+                    contents[path] = source.read()
+
+        for root, prefixes in group_prefixes(contents).items():
+            print(f"[{file_counter}] Processing file: {root}")
+            file_counter += 1
+            for path in prefixes:
+                print(f"[{file_counter}] Prefix of {os.path.basename(root)}, not parsed again: {path}")
+                file_counter += 1
+
+            n_lines = {path: len(contents[path].splitlines()) for path in prefixes}
+            buffers, derived = iter_root_buffers(decode_lines(contents[root]), n_lines)
+
+            # end dates and durations of all the buffers in one pass
+            last_buffers: list[str] = [derived[path][1] for path in prefixes if derived[path][1]]
+            data: list[tuple] = finalize_sessions([extract_fields(buffer) for buffer in buffers + last_buffers])
+            last_data = iter(data[len(buffers):])
+
+            host, app, user, file = source_metadata(root)
+            sessions_by_file[root] = [Session(host, app, user, file, *fields) for fields in data[:len(buffers)]]
+            for path in prefixes:
+                k, last = derived[path]
+                file = source_metadata(path)[3]
+                sessions_by_file[path] = [session._replace(file=file) for session in sessions_by_file[root][:k]]
+                if last:
+                    sessions_by_file[path].append(Session(host, app, user, file, *next(last_data)))
+
+    # the same session found in several files is one record
+    records: dict[tuple, dict] = {}
+    for path in paths:
+        for session in sessions_by_file[path]:
+            key = session._replace(file=None)
+            record = records.get(key)
+            if record is None:
+                records[key] = {**session._asdict(), "files": [session.file]}
+            elif session.file not in record["files"]:
+                record["files"].append(session.file)
+
+    for record in records.values():
+        record["files"] = ", ".join(record["files"])
+        print(f"[{records_counter}] Record found: {record['host']}/{record['app']}/{record['user']} -> {record['files']} ({record['date_start']}, {record['start']}, {record['date_end']}, {record['end']}, {record['duration']})")
+        records_counter += 1
+
+    return list(records.values())
+
+# sessions finalized together by iter_sessions
+FINALIZE_BATCH = 4096
+
+def iter_sessions(sources: Iterable, since: date|None = None) -> Iterator[Session]:
+    """
+    Lazily yields the sessions found in the given history files, one file at
+    a time. Sources can be paths, open (text or binary) file objects or bytes;
+    host/app/user/file are taken from the path, when there is one.
+    With since, parsing starts at the first session started on that day or later.
+    """
+    for source in sources:
+        host, app, user, file = source_metadata(source)
+        buffers = iter_session_buffers(iter_lines_since(source, since, date_time_start_pattern))
+        # end dates and durations are computed a batch of sessions at a time
+        while batch := [extract_fields(buffer) for buffer in itertools.islice(buffers, FINALIZE_BATCH)]:
+            for date_start, date_end, start, end, duration in finalize_sessions(batch):
+                yield Session(host, app, user, file, date_start, date_end, start, end, duration)
+
+def parse_history_file(path: str, file_counter: int = 1, records_counter: int = 1, since: date|None = None) -> list[dict]:
+    records = []  # collect rows here
+
+    print(f"[{file_counter}] Processing file: {source_name(path)}")
+    for session in iter_sessions([path], since=since):
+        print(f"[{records_counter}] Record found: {session.host}/{session.app}/{session.user} -> {session.file} ({session.date_start}, {session.start}, {session.date_end}, {session.end}, {session.duration})")
+        records.append(session._asdict())
+        records_counter += 1
+
+    return records
+
+def write_summary(records: list[dict], output_file: str = "history_files_summary.xlsx") -> None:
+    import pandas as pd
 
-    print(f"Total files found: {len(results)}")
-    print(f"Total records collected: {len(records)}")
-    
     # export to Excel
     df = pd.DataFrame(records)
     df["date_start"] = pd.to_datetime(df["date_start"], errors="coerce")
@@ -301,8 +571,6 @@ def main():
 
     df = df.sort_values(by=["date_start", "start"], ascending=[False, False], na_position="last")
 
-    output_file = "history_files_summary.xlsx"
-
     with pd.ExcelWriter(output_file, engine="openpyxl") as writer:
         df = df.drop_duplicates()
         df.to_excel(writer, index=False, sheet_name="History")
@@ -324,5 +592,176 @@ def main():
                 for cell in col_cells:
                     cell.number_format = fmt
 
+def main(link_mode: str = "auto",
+         watch: bool = False,
+         interval: float = 5.0,
+         debounce: float = 2.0,
+         shard: tuple[int, int]|None = None,
+         hosts: list[str]|None = None,
+         apps: list[str]|None = None,
+         partial: str|None = None,
+         archive: Path|None = None,
+         since: date|None = None,
+         sinks: list[str]|None = None,
+         rollup: str|None = ROLLUP_FILE,
+         prune: bool = False,
+         dry_run: bool = False,
+         manifest: str|None = PRUNE_MANIFEST,
+         output_file: str = "history_files_summary.xlsx"):
+    base = Path("/mnt/j")
+    selection = dict(shard=shard, hosts=hosts, apps=apps)
+
+    def retain_stversions() -> None:
+        promote_stversions(base, link_mode=link_mode, **selection)
+        # .stversions/ files already contained in the main directory (see retention.py)
+        if prune:
+            prune_stversions(group_stversions(discover_history_files(base, stversions=True, **selection)), dry_run, manifest)
+
+    # a slice of the files gives a partial result, to be merged later
+    if shard or hosts or apps:
+        partial = partial or partial_name(output_file, shard)
+
+    def write(records: list[dict]) -> None:
+        if partial:
+            write_partial(records, partial)
+        else:
+            write_summary(records, output_file)
+
+    if archive is not None:
+        # rotations read through the chunk store (see chunkstore.py)
+        archived: list[str] = archived_files(archive, base, "*history*/*/prog/curdir/*")
+        results: list[str] = select_files(archived, host_app_user_pattern_syncthing, **selection, name_map=NAME_MAP)
+    else:
+        retain_stversions()
+        results: list[str] = discover_history_files(base, **selection)
+    results = modified_since(results, since, archived_mtime(archive) if archive is not None else os.path.getmtime)
+    # files are parsed by lineage (folder), so that shared prefixes are parsed once
+    records_by_lineage: dict[str, list[dict]] = {}
+    # files of each lineage at its last parse (watch mode)
+    paths_by_lineage: dict[str, set[str]] = {}
+    records_counter = 1
+
+    def parse_lineages() -> Iterator[list[dict]]:
+        nonlocal records_counter
+        file_counter = 1
+        for lineage, paths in group_lineages(results).items():
+            records = parse_lineage(paths, file_counter, records_counter, since=since, archive=archive)
+            records_counter += len(records)
+            file_counter += len(paths)
+            if watch:
+                records_by_lineage[lineage] = records
+                paths_by_lineage[lineage] = set(paths)
+            yield records
+
+    # daily rollups are updated with the records as they come (see rollups.py)
+    rollup_sink: RollupSink|None = RollupSink(rollup, "sessions") if rollup else None
+
+    if not watch:
+        # records go to the sinks while parsing, the summary is written at the end
+        total: int = write_pipelined(parse_lineages(), sinks, partial, write_summary, output_file, table="sessions",
+                                     extra_sinks=[rollup_sink] if rollup_sink else None)
+        print(f"Total files found: {len(results)}")
+        print(f"Total records collected: {total}")
+        return
+
+    for records in parse_lineages():
+        if rollup_sink:
+            rollup_sink.write(records)
+    records = [record for lineage_records in records_by_lineage.values() for record in lineage_records]
+
+    print(f"Total files found: {len(results)}")
+    print(f"Total records collected: {len(records)}")
+    
+    write(records)
+
+    def on_change(changed: set[str]) -> None:
+        nonlocal records_counter
+        if any(".stversions/" in path for path in changed):
+            retain_stversions()
+
+        current: dict[str, list[str]] = group_lineages(modified_since(discover_history_files(base, **selection), since))
+        for lineage in set(records_by_lineage) - set(current):
+            print(f"Folder removed: {lineage}")
+            del records_by_lineage[lineage]
+            del paths_by_lineage[lineage]
+        changed_lineages: set[str] = {os.path.dirname(path) for path in changed}
+        # files added (e.g. promoted from .stversions/) or removed since the last parse
+        changed_lineages |= {lineage for lineage, paths in current.items() if set(paths) != paths_by_lineage.get(lineage)}
+        for lineage, paths in current.items():
+            if lineage in changed_lineages:
+                records_by_lineage[lineage] = parse_lineage(paths, 1, records_counter, since=since)
+                paths_by_lineage[lineage] = set(paths)
+                records_counter += len(records_by_lineage[lineage])
+                if rollup_sink:
+                    rollup_sink.write(records_by_lineage[lineage])
+
+        write([record for lineage_records in records_by_lineage.values() for record in lineage_records])
+        print(f"Summary updated ({len(records_by_lineage)} folders)")
+
+    watch_files(
+        discover=lambda: discover_history_files(base, stversions=True, **selection),
+        on_change=on_change,
+        interval=interval,
+        debounce=debounce,
+    )
+
+def cli(argv: list[str]|None = None) -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--link-mode",
+        choices=["auto", "reflink", "hardlink", "copy"],
+        default="auto",
+        help="How .stversions/ files surviving containment are moved to the main history directory"
+    )
+    parser.add_argument("--watch", action="store_true", help="Keep the summary updated as history files change")
+    parser.add_argument("--interval", type=float, default=5.0, help="Polling interval in seconds (non-inotify mounts)")
+    parser.add_argument("--debounce", type=float, default=2.0, help="Quiet time in seconds before updating the summary")
+    parser.add_argument("--shard", type=parse_shard, default=None, help="Process only shard i of N (i/N) and write a partial result")
+    parser.add_argument("--host", action="append", dest="hosts", help="Process only this host (repeatable)")
+    parser.add_argument("--app", action="append", dest="apps", help="Process only this app (repeatable)")
+    parser.add_argument("--partial", default=None, help="Partial result file (default: derived from the shard)")
+    parser.add_argument("--archive", type=Path, default=None, help="Read the history files from this chunk store (see chunkstore.py)")
+    parser.add_argument("--sink", action="append", dest="sinks", help="Also write the records, while parsing, to this .csv, .sqlite/.db or .parquet file (repeatable)")
+    parser.add_argument("--since", type=parse_date, default=None, help="Parse only what was recorded from this date on (dd-mm-yyyy)")
+    parser.add_argument("--rollup", default=ROLLUP_FILE, help="Daily rollups database updated with the records (see rollups.py)")
+    parser.add_argument("--no-rollup", action="store_const", const=None, dest="rollup", help="Do not update the daily rollups")
+    parser.add_argument("--prune-stversions", action="store_true", help="Delete the .stversions/ files contained in the main history directory")
+    parser.add_argument("--dry-run", action="store_true", help="With --prune-stversions, only report what would be pruned")
+    parser.add_argument("--prune-manifest", default=PRUNE_MANIFEST, help="Audit manifest (JSON lines) of the pruned .stversions/ files")
+
+    subparsers = parser.add_subparsers(dest="command")
+    merge_parser = subparsers.add_parser("merge", help="Merge partial results into the final summary")
+    merge_parser.add_argument("partials", nargs="+", type=Path, help="Partial result files")
+    merge_parser.add_argument("--output", default="history_files_summary.xlsx", help="Summary file")
+
+    args: argparse.Namespace = parser.parse_args(argv)
+    if args.watch and args.archive:
+        parser.error("--watch cannot be used with --archive")
+    if args.watch and args.sinks:
+        parser.error("--watch cannot be used with --sink")
+    if args.dry_run and not args.prune_stversions:
+        parser.error("--dry-run requires --prune-stversions")
+
+    if args.command == "merge":
+        write_summary(read_partials(args.partials), args.output)
+    else:
+        main(
+            link_mode=args.link_mode,
+            watch=args.watch,
+            interval=args.interval,
+            debounce=args.debounce,
+            shard=args.shard,
+            hosts=args.hosts,
+            apps=args.apps,
+            partial=args.partial,
+            archive=args.archive,
+            since=args.since,
+            sinks=args.sinks,
+            rollup=args.rollup,
+            prune=args.prune_stversions,
+            dry_run=args.dry_run,
+            manifest=args.prune_manifest,
+        )
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    cli()
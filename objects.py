@@ -1,7 +1,16 @@
+import os
 import re
-from utils import find_history_files
-import pandas as pd
+from datetime import date
+from utils import find_history_files, source_name, iter_lines_since, modified_since, parse_date
 from pathlib import Path
+from typing import Iterable, Iterator, NamedTuple
+import argparse
+from watch import watch_files
+from chunkstore import archived_files, archived_mtime, open_source
+from compression import plain_name
+from sinks import write_pipelined
+from rollups import ROLLUP_FILE, RollupSink
+from sharding import parse_shard, select_files, partial_name, write_partial, read_partials
 
 object_pattern = re.compile(
     r"^((?P<date>\d{4}-\d{2}-\d{2})\s+)?"
@@ -36,66 +45,103 @@ date_pattern = re.compile(
     r".*$"
 )
 
-def main():
-    records = []  # collect rows here
-    results = []  # collect files paths here
-    objects_counter = 1
+def discover_history_files(base: Path,
+                           shard: tuple[int, int]|None = None,
+                           hosts: list[str]|None = None,
+                           apps: list[str]|None = None) -> list[str]:
+    # --host also matches the canonical names, as for the sessions
+    from manage_history_files import NAME_MAP
 
-    base = Path("/mnt/j")
+    results = []  # collect files paths here
     matches: list[Path] = []
     matches.extend(list(base.glob("*history*/*/prog/curdir/*")))
 
     for m in matches:
         results.extend(find_history_files(str(m.absolute())))
 
-    for path in results:
-        match_hauf = host_app_user_pattern_syncthing.search(str(path))
-        if match_hauf:
-            host: str|None = match_hauf.group("host")
-            app: str|None = match_hauf.group("app")
-            user: str|None = match_hauf.group("user")
-            file: str|None = match_hauf.group("file")
-                
-            with open(path, 'r', encoding='utf-8') as f:
-                lines = f.readlines()
-                date: str|None = None
-                for line in lines:
-                    line = line.rstrip()
-
-                    match_date = date_pattern.search(line)
-                    if match_date: 
-                        date = match_date.group("date")
-
-                    match_dto = object_pattern.search(line)
-                    if match_dto:
-                        date: str = match_dto.group("date") if match_dto.group("date") else date
-                        time: str = match_dto.group("time")
-                        object: str = match_dto.group("object")
-                        userdir: str|None = None
-
-                        in_object_pattern = re.compile(
-                            rf"^\"\/opt\/(?:.*?\/)?(?:.*?data\/)?(?P<userdir>.*?)\/(?:data\/)?.*$"
-                        )
-
-                        in_object_match = in_object_pattern.search(object)
-                        if in_object_match:
-                            userdir= in_object_match.group("userdir")
-
-                        print(f"[{objects_counter}] Object found: {date} {time} {host} {app} {user} {userdir} {object}")
-                        # append a structured record
-                        records.append({
-                            "date": date,
-                            "time": time,
-                            "host": host,
-                            "app": app,
-                            "file": file,
-                            "user": user,
-                            "userdir": userdir,
-                            "object": object,
-                        })
-
-                        objects_counter += 1
-    
+    return select_files(results, host_app_user_pattern_syncthing, shard, hosts, apps, name_map=NAME_MAP)
+
+# userdir inside the object path, e.g. "/opt/topspin/data/<userdir>/nmr/..."
+in_object_pattern = re.compile(
+    rf"^\"\/opt\/(?:.*?\/)?(?:.*?data\/)?(?P<userdir>.*?)\/(?:data\/)?.*$"
+)
+
+class ObjectEvent(NamedTuple):
+    date: str|None          # YYYY-MM-DD
+    time: str|None          # HH:MM:SS
+    host: str|None
+    app: str|None
+    file: str|None
+    user: str|None
+    userdir: str|None
+    object: str|None
+
+def source_metadata(source) -> tuple[str|None, str|None, str|None, str|None]:
+    """
+    Returns (host, app, user, file) of a history file source from its path,
+    or Nones for sources without a recognizable path.
+    """
+    name: str|None = source_name(source)
+    if name is None:
+        return None, None, None, None
+
+    match_hauf = host_app_user_pattern_syncthing.search(name)
+    if not match_hauf:
+        match_hauf = host_app_user_pattern.search(name)
+    if match_hauf:
+        return match_hauf.group("host"), match_hauf.group("app"), match_hauf.group("user"), plain_name(match_hauf.group("file"))
+
+    return None, None, None, plain_name(os.path.basename(name))
+
+def extract_objects(lines: Iterable[str], host=None, app=None, user=None, file=None, date: str|None = None) -> Iterator[ObjectEvent]:
+    """
+    Yields the "client changed object to" events of the given lines. Lines
+    without a date take it from the last date line seen (or from date).
+    """
+    for line in lines:
+        line = line.rstrip()
+
+        match_date = date_pattern.search(line)
+        if match_date: 
+            date = match_date.group("date")
+
+        match_dto = object_pattern.search(line)
+        if match_dto:
+            date: str = match_dto.group("date") if match_dto.group("date") else date
+            time: str = match_dto.group("time")
+            object: str = match_dto.group("object")
+            userdir: str|None = None
+
+            in_object_match = in_object_pattern.search(object)
+            if in_object_match:
+                userdir= in_object_match.group("userdir")
+
+            yield ObjectEvent(date, time, host, app, file, user, userdir, object)
+
+def iter_objects(sources: Iterable, since: date|None = None) -> Iterator[ObjectEvent]:
+    """
+    Lazily yields the object changes found in the given history files, one
+    file at a time. Sources can be paths, open (text or binary) file objects
+    or bytes; host/app/user/file are taken from the path, when there is one.
+    With since, parsing starts at the first date line of that day or later.
+    """
+    for source in sources:
+        host, app, user, file = source_metadata(source)
+        yield from extract_objects(iter_lines_since(source, since, date_pattern), host, app, user, file)
+
+def parse_objects_file(path: str, objects_counter: int = 1, since: date|None = None) -> list[dict]:
+    records = []  # collect rows here
+
+    for event in iter_objects([path], since=since):
+        print(f"[{objects_counter}] Object found: {event.date} {event.time} {event.host} {event.app} {event.user} {event.userdir} {event.object}")
+        records.append(event._asdict())
+        objects_counter += 1
+
+    return records
+
+def write_summary(records: list[dict], output_file: str = "objects_summary.xlsx") -> None:
+    import pandas as pd
+
     # export to Excel
     df = pd.DataFrame(records)
     df["date"] = pd.to_datetime(df["date"], errors="coerce")
@@ -103,7 +149,7 @@ def main():
 
     df = df.sort_values(by=["date", "time"], ascending=[False, False], na_position="last")
 
-    with pd.ExcelWriter("objects_summary.xlsx", engine="openpyxl") as writer:
+    with pd.ExcelWriter(output_file, engine="openpyxl") as writer:
         df.to_excel(writer, index=False, sheet_name="Objects")
         ws = writer.sheets["Objects"]
 
@@ -120,5 +166,132 @@ def main():
                 for cell in col_cells:
                     cell.number_format = fmt
 
+def main(watch: bool = False,
+         interval: float = 5.0,
+         debounce: float = 2.0,
+         shard: tuple[int, int]|None = None,
+         hosts: list[str]|None = None,
+         apps: list[str]|None = None,
+         partial: str|None = None,
+         archive: Path|None = None,
+         since: date|None = None,
+         sinks: list[str]|None = None,
+         rollup: str|None = ROLLUP_FILE,
+         output_file: str = "objects_summary.xlsx"):
+    base = Path("/mnt/j")
+    selection = dict(shard=shard, hosts=hosts, apps=apps)
+
+    # a slice of the files gives a partial result, to be merged later
+    if shard or hosts or apps:
+        partial = partial or partial_name(output_file, shard)
+
+    def write(records: list[dict]) -> None:
+        if partial:
+            write_partial(records, partial)
+        else:
+            write_summary(records, output_file)
+
+    if archive is not None:
+        from manage_history_files import NAME_MAP
+
+        # rotations read through the chunk store (see chunkstore.py)
+        archived: list[str] = archived_files(archive, base, "*history*/*/prog/curdir/*")
+        results: list[str] = select_files(archived, host_app_user_pattern_syncthing, **selection, name_map=NAME_MAP)
+    else:
+        results: list[str] = discover_history_files(base, **selection)
+    results = modified_since(results, since, archived_mtime(archive) if archive is not None else os.path.getmtime)
+    records_by_file: dict[str, list[dict]] = {}
+    objects_counter = 1
+
+    def parse_files() -> Iterator[list[dict]]:
+        nonlocal objects_counter
+        for path in results:
+            with open_source(archive, path) as source:
+                records = parse_objects_file(source, objects_counter, since=since)
+            objects_counter += len(records)
+            if watch:
+                records_by_file[path] = records
+            yield records
+
+    # daily rollups are updated with the records as they come (see rollups.py)
+    rollup_sink: RollupSink|None = RollupSink(rollup, "objects") if rollup else None
+
+    if not watch:
+        # records go to the sinks while parsing, the summary is written at the end
+        write_pipelined(parse_files(), sinks, partial, write_summary, output_file, table="objects",
+                        extra_sinks=[rollup_sink] if rollup_sink else None)
+        return
+
+    for records in parse_files():
+        if rollup_sink:
+            rollup_sink.write(records)
+    write([record for file_records in records_by_file.values() for record in file_records])
+
+    def on_change(changed: set[str]) -> None:
+        nonlocal objects_counter
+        current: list[str] = modified_since(discover_history_files(base, **selection), since)
+        for path in set(records_by_file) - set(current):
+            print(f"File removed: {path}")
+            del records_by_file[path]
+        for path in current:
+            if path in changed or path not in records_by_file:
+                records_by_file[path] = parse_objects_file(path, objects_counter, since=since)
+                objects_counter += len(records_by_file[path])
+                if rollup_sink:
+                    rollup_sink.write(records_by_file[path])
+
+        write([record for file_records in records_by_file.values() for record in file_records])
+        print(f"Summary updated ({len(records_by_file)} files)")
+
+    watch_files(
+        discover=lambda: discover_history_files(base, **selection),
+        on_change=on_change,
+        interval=interval,
+        debounce=debounce,
+    )
+
+def cli(argv: list[str]|None = None) -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--watch", action="store_true", help="Keep the summary updated as history files change")
+    parser.add_argument("--interval", type=float, default=5.0, help="Polling interval in seconds (non-inotify mounts)")
+    parser.add_argument("--debounce", type=float, default=2.0, help="Quiet time in seconds before updating the summary")
+    parser.add_argument("--shard", type=parse_shard, default=None, help="Process only shard i of N (i/N) and write a partial result")
+    parser.add_argument("--host", action="append", dest="hosts", help="Process only this host (repeatable)")
+    parser.add_argument("--app", action="append", dest="apps", help="Process only this app (repeatable)")
+    parser.add_argument("--partial", default=None, help="Partial result file (default: derived from the shard)")
+    parser.add_argument("--archive", type=Path, default=None, help="Read the history files from this chunk store (see chunkstore.py)")
+    parser.add_argument("--sink", action="append", dest="sinks", help="Also write the records, while parsing, to this .csv, .sqlite/.db or .parquet file (repeatable)")
+    parser.add_argument("--since", type=parse_date, default=None, help="Parse only what was recorded from this date on (dd-mm-yyyy)")
+    parser.add_argument("--rollup", default=ROLLUP_FILE, help="Daily rollups database updated with the records (see rollups.py)")
+    parser.add_argument("--no-rollup", action="store_const", const=None, dest="rollup", help="Do not update the daily rollups")
+
+    subparsers = parser.add_subparsers(dest="command")
+    merge_parser = subparsers.add_parser("merge", help="Merge partial results into the final summary")
+    merge_parser.add_argument("partials", nargs="+", type=Path, help="Partial result files")
+    merge_parser.add_argument("--output", default="objects_summary.xlsx", help="Summary file")
+
+    args: argparse.Namespace = parser.parse_args(argv)
+    if args.watch and args.archive:
+        parser.error("--watch cannot be used with --archive")
+    if args.watch and args.sinks:
+        parser.error("--watch cannot be used with --sink")
+
+    if args.command == "merge":
+        write_summary(read_partials(args.partials), args.output)
+    else:
+        main(
+            watch=args.watch,
+            interval=args.interval,
+            debounce=args.debounce,
+            shard=args.shard,
+            hosts=args.hosts,
+            apps=args.apps,
+            partial=args.partial,
+            archive=args.archive,
+            since=args.since,
+            sinks=args.sinks,
+            rollup=args.rollup,
+        )
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    cli()
\ No newline at end of file
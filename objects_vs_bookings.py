@@ -1,11 +1,10 @@
 from pathlib import Path
-import pandas as pd
-import polars as pl
 from datetime import datetime
 import argparse
-
-import manage_history_files
-import objects
+import hashlib
+import json
+import os
+from utils import parse_date
 
 SHEET_NAMES: list[str] = ["300", "400", "600", "PS"]
 NAMES: dict[str, str] = {
@@ -162,36 +161,221 @@ def from_objects_to_bookings(bookings, objects, start=None):
         print(f"{inst:>3}: {percentage_objects:.2f} %")
         pass
 
-def main(start=None):
+# columns of history_files_summary.xlsx read by the reports, attribution.py
+# and query_service.py: the same list shares one sidecar cache file
+SESSION_COLUMNS: list[str] = ["host", "app", "user", "file", "date_start", "date_end", "start", "end"]
+
+def read_excel_cached(file_path: str, sheet_names: list[str], use_cache: bool = True, columns: list[str]|None = None) -> dict:
+    """
+    Reads the given sheets (and columns, if given) of an Excel workbook as polars DataFrames.
+    The parsed sheets are kept in a sidecar folder (<workbook>.cache/) as Arrow
+    IPC files named after a hash of the path, size and mtime of the workbook
+    and of the columns read: as long as the workbook does not change they are
+    read from there, skipping the Excel parsing. Callers reading different
+    columns of the same workbook keep their own files.
+    """
+    import polars as pl
+
+    workbook = Path(file_path)
+    cache_dir = workbook.with_name(f"{workbook.name}.cache")
+    st = workbook.stat()
+    version: str = hashlib.sha1(json.dumps([str(workbook.resolve()), st.st_size, st.st_mtime_ns]).encode("utf-8")).hexdigest()[:16]
+    key: str = hashlib.sha1(json.dumps(list(columns) if columns else None).encode("utf-8")).hexdigest()[:8]
+    cache_files: dict[str, Path] = {sheet: cache_dir / f"{sheet}.{version}.{key}.arrow" for sheet in sheet_names}
+
+    if use_cache and all(path.exists() for path in cache_files.values()):
+        try:
+            sheets = {sheet: pl.read_ipc(path) for sheet, path in cache_files.items()}
+            print(f"  [cache]   {workbook.name}")
+            return sheets
+        except (OSError, pl.exceptions.PolarsError) as e:
+            print(f"  [cache]   {workbook.name}: cache not readable ({e}), parsing again")
+
+    print(f"  [parsing] {workbook.name}")
+    sheets: dict[str, pl.DataFrame] = {name: pl.DataFrame(df) for name, df in pl.read_excel(
+        workbook, sheet_name = sheet_names, engine="openpyxl", columns=columns
+    ).items()}
+
+    if use_cache:
+        try:
+            cache_dir.mkdir(exist_ok=True)
+            for sheet, df in sheets.items():
+                # written aside and renamed: a cache file is complete or missing
+                tmp_file = cache_dir / f".{cache_files[sheet].name}.{os.getpid()}.tmp"
+                try:
+                    df.write_ipc(tmp_file)
+                    os.replace(tmp_file, cache_files[sheet])
+                finally:
+                    tmp_file.unlink(missing_ok=True)
+            # files of previous versions of the workbook
+            for path in cache_dir.glob("*.arrow"):
+                if path.name.split(".")[-3] != version:
+                    path.unlink(missing_ok=True)
+        except (OSError, pl.exceptions.PolarsError) as e:
+            print(f"  [cache]   {workbook.name}: cache not written ({e})")
+
+    return sheets
+
+def utilization_report(bookings: dict, sessions, start=None) -> dict:
+    """
+    Compares booked hours with the hours actually recorded in the history
+    files, per instrument, PI, week and month.
+    Sessions (from history_files_summary.xlsx) are assigned to a PI through
+    PI_DIRS and deduplicated, since the same session appears in every rotation
+    of a history file. Everything is computed with polars expressions.
+    Returns one DataFrame per report sheet.
+    """
+    import polars as pl
+    from manage_history_files import NAME_MAP
+
+    # booking sheet -> instrument name used in the sessions table
+    instruments: dict[str, str] = {inst: NAME_MAP[NAMES[inst]] for inst in SHEET_NAMES}
+
+    pi_users = pl.DataFrame(
+        [
+            {"instrument": instruments[inst], "user": user, "PI": pi}
+            for pi, dirs in PI_DIRS.items()
+            for inst, user in dirs.items()
+            if user
+        ],
+        schema={"instrument": pl.String, "user": pl.String, "PI": pl.String},
+    )
+
+    booked = pl.concat([
+        bookings[inst]
+        .select(
+            pl.lit(instruments[inst]).alias("instrument"),
+            pl.col("PI").cast(pl.String),
+            pl.col("start").cast(pl.Datetime("us")),
+            pl.col("end").cast(pl.Datetime("us")),
+        )
+        for inst in SHEET_NAMES
+    ])
+
+    recorded = (
+        sessions
+        .select(
+            pl.col("host").alias("instrument"),
+            "app",
+            "user",
+            pl.col("date_start").cast(pl.Date).dt.combine(pl.col("start")).alias("start"),
+            pl.col("date_end").cast(pl.Date).dt.combine(pl.col("end")).alias("end"),
+        )
+        .drop_nulls(["instrument", "start", "end"])
+        # a truncated rotation copy has a shorter end: the longest one is kept
+        .sort("end")
+        .unique(subset=["instrument", "app", "user", "start"], keep="last", maintain_order=True)
+        .join(pi_users, on=["instrument", "user"], how="left")
+    )
+
+    if start:
+        booked = booked.filter(pl.col("start").dt.date() >= start)
+        recorded = recorded.filter(pl.col("start").dt.date() >= start)
+
+    def hours(frame):
+        return frame.with_columns(
+            ((pl.col("end") - pl.col("start")).dt.total_seconds() / 3600).clip(lower_bound=0).alias("hours"),
+            pl.col("PI").fill_null("(unknown)"),
+            pl.col("start").dt.truncate("1w").dt.date().alias("week"),
+            pl.col("start").dt.truncate("1mo").dt.date().alias("month"),
+        )
+
+    booked = hours(booked)
+    recorded = hours(recorded)
+
+    def compare(keys: list[str]):
+        return (
+            booked.group_by(keys).agg(
+                pl.col("hours").sum().alias("booked_h"),
+                pl.len().alias("bookings"),
+            )
+            .join(
+                recorded.group_by(keys).agg(
+                    pl.col("hours").sum().alias("recorded_h"),
+                    pl.len().alias("sessions"),
+                ),
+                on=keys,
+                how="full",
+                coalesce=True,
+            )
+            .with_columns(pl.col("booked_h", "recorded_h", "bookings", "sessions").fill_null(0))
+            .with_columns(
+                pl.when(pl.col("booked_h") > 0)
+                .then(100 * pl.col("recorded_h") / pl.col("booked_h"))
+                .otherwise(None)
+                .alias("utilization_%")
+            )
+            .sort(keys)
+        )
+
+    return {
+        "Instrument": compare(["instrument"]),
+        "PI": compare(["instrument", "PI"]),
+        "Week": compare(["instrument", "PI", "week"]),
+        "Month": compare(["instrument", "PI", "month"]),
+    }
+
+def write_report(report: dict, output_file: str = "utilization_report.xlsx") -> None:
+    import pandas as pd
+
+    with pd.ExcelWriter(output_file, engine="openpyxl") as writer:
+        for sheet_name, df in report.items():
+            pd.DataFrame(df.to_dict(as_series=False)).to_excel(writer, index=False, sheet_name=sheet_name)
+            ws = writer.sheets[sheet_name]
+
+            # Map column names → desired Excel formats
+            formats = {
+                "week": "yyyy-mm-dd",
+                "month": "yyyy-mm",
+                "booked_h": "0.00",
+                "recorded_h": "0.00",
+                "utilization_%": "0.0",
+            }
+
+            for col_name, col_idx in zip(df.columns, range(1, len(df.columns) + 1)):
+                if col_name in formats:
+                    fmt = formats[col_name]
+                    (col_cells,) = ws.iter_cols(min_col=col_idx, max_col=col_idx)
+                    for cell in col_cells:
+                        cell.number_format = fmt
+    print(f"Utilization report written: {output_file}")
+
+def windowed_name(summary: str) -> str:
+    # objects_summary.xlsx -> objects_summary.since.xlsx
+    path = Path(summary)
+    return str(path.with_name(f"{path.stem}.since{path.suffix}"))
+
+def main(start=None, use_cache: bool = True, utilization: bool = False, windowed: bool = False):
     #objects_file_path: str = "D:/Walter/src/Python/manageHistoryFiles/objects_summary.xlsx"
     #bookings_file_path: str = "D:/Walter/src/Python/download_google_calendars/cost_calendar.xlsx"
     objects_file_path: str = "/mnt/d/Walter/src/Python/manageHistoryFiles/objects_summary.xlsx"
+    sessions_file_path: str = "/mnt/d/Walter/src/Python/manageHistoryFiles/history_files_summary.xlsx"
+    if windowed:
+        # recalculated from the start date only (see cli)
+        objects_file_path = windowed_name(objects_file_path)
+        sessions_file_path = windowed_name(sessions_file_path)
     bookings_file_path: str = "/mnt/d/Walter/src/Python/download_google_calendars/cost_calendar.xlsx"
-    # Parse the Excel files
-    print(f"  [parsing] {Path(objects_file_path).name}")
-    objects: dict[str, pl.DataFrame] = {key: pl.DataFrame(df) for key, df in pl.read_excel(
-        objects_file_path, sheet_name = ["Objects"], engine="openpyxl"
-    ).items()}
-    print(f"  [parsing] {Path(bookings_file_path).name}")
-    bookings: dict[str, pl.DataFrame] = {key: pl.DataFrame(df) for key, df in pl.read_excel(
-        bookings_file_path, sheet_name = SHEET_NAMES, engine="openpyxl"
-    ).items()}
+    # Parse the Excel files (or read them from their sidecar cache)
+    objects: dict = read_excel_cached(objects_file_path, ["Objects"], use_cache=use_cache)
+    bookings: dict = read_excel_cached(bookings_file_path, SHEET_NAMES, use_cache=use_cache)
     
     from_bookings_to_objects(bookings=bookings, objects=objects, start=start)
     from_objects_to_bookings(bookings=bookings, objects=objects, start=start)
 
-def parse_date(date_str) -> datetime.date :
-    date_str: str = str.replace(date_str, '/', '-')
-    try:
-        # Convert string like "16-03-2025" to a date object
-        return datetime.strptime(date_str, "%d-%m-%Y").date()
-    except ValueError:
-        raise argparse.ArgumentTypeError(f"Invalid date: '{date_str}'. Expected format dd-mm-yyyy")
+    if utilization:
+        sessions: dict = read_excel_cached(
+            sessions_file_path,
+            ["History"],
+            use_cache=use_cache,
+            columns=SESSION_COLUMNS,
+        )
+        write_report(utilization_report(bookings=bookings, sessions=sessions["History"], start=start))
 
-if __name__ == "__main__":
-    
+def cli(argv: list[str]|None = None) -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--no-recalc", action="store_true", help="Do no recalc objects")
+    parser.add_argument("--no-cache", action="store_true", help="Always parse the Excel files, ignoring their sidecar cache")
+    parser.add_argument("--utilization", action="store_true", help="Write the booked vs recorded hours report (utilization_report.xlsx)")
     parser.add_argument(
         "--start",
         type=parse_date,
@@ -199,13 +383,26 @@ if __name__ == "__main__":
         help="Start date (dd-mm-yyyy)"
     )
 
-    args: argparse.Namespace = parser.parse_args()    
+    args: argparse.Namespace = parser.parse_args(argv)
 
     if not args.no_recalc:
-        manage_history_files.main()
-        objects.main()
+        import manage_history_files
+        import objects
+
+        # history files are chronological: parsing starts at the start date. The
+        # result covers the window only, so it never replaces the full summaries
+        if args.start:
+            manage_history_files.main(since=args.start, output_file=windowed_name("history_files_summary.xlsx"))
+            objects.main(since=args.start, output_file=windowed_name("objects_summary.xlsx"))
+        else:
+            manage_history_files.main()
+            objects.main()
 
+    windowed: bool = bool(args.start) and not args.no_recalc
     if args.start:
-        main(args.start)
+        main(args.start, use_cache=not args.no_cache, utilization=args.utilization, windowed=windowed)
     else:
-        main()
+        main(use_cache=not args.no_cache, utilization=args.utilization)
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,328 @@
+#query_service.py
+# Local HTTP/JSON query service over the two summaries, so that questions
+# like "who used AV600 last Tuesday" do not need the workbooks:
+#   GET /sessions?host=AV600&from=2024-03-05&to=2024-03-05&user=...&pi=...&limit=...
+#   GET /objects?host=AV300&from=2024-03-01T08:00&to=2024-03-01T12:00&pi=Longo
+#   GET /hosts                 hosts, record counts and time span
+#   GET /stats                 cache statistics
+# Sessions and objects are kept per host, sorted by time, and ranges are
+# found by bisection. Query results are kept in an LRU cache, cleared when
+# the summaries change (checked on every request with a stat()).
+import argparse
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, NamedTuple
+from urllib.parse import parse_qs, urlparse
+from termcolor import colored
+
+from objects_vs_bookings import NAMES, PI_DIRS
+
+class HostIndex(NamedTuple):
+    sessions: list[dict]            # sorted by start
+    session_starts: list[datetime]
+    max_session: timedelta          # longest session: how far back an overlapping one can start
+    objects: list[dict]             # sorted by time
+    object_times: list[datetime]
+
+def load_summaries(sessions_file: str, objects_file: str) -> tuple[list[dict], list[dict]]:
+    """
+    Reads the sessions and the objects from the summaries (through the
+    sidecar cache of read_excel_cached).
+    """
+    from objects_vs_bookings import SESSION_COLUMNS, read_excel_cached
+
+    sessions = read_excel_cached(
+        sessions_file,
+        ["History"],
+        columns=SESSION_COLUMNS,
+    )["History"].to_dicts()
+    objects = read_excel_cached(objects_file, ["Objects"])["Objects"].to_dicts()
+    return sessions, objects
+
+def combine(day, time_of_day) -> datetime|None:
+    if day is None or time_of_day is None:
+        return None
+    return datetime.combine(day.date() if isinstance(day, datetime) else day, time_of_day)
+
+def pi_folders() -> dict[tuple[str, str], str]:
+    """
+    (canonical host, user folder) -> PI, from PI_DIRS.
+    """
+    from manage_history_files import NAME_MAP
+
+    return {
+        (NAME_MAP[NAMES[inst]], folder): pi
+        for pi, dirs in PI_DIRS.items()
+        for inst, folder in dirs.items()
+        if folder
+    }
+
+def build_indexes(sessions: list[dict], objects: list[dict]) -> dict[str, HostIndex]:
+    """
+    Groups sessions and objects by (canonical) host, sorted by time. Sessions
+    repeated in several rotations are kept once, with their longest end.
+    """
+    from manage_history_files import NAME_MAP
+
+    pis = pi_folders()
+    by_host_sessions: dict[str, dict[tuple, dict]] = {}
+    for row in sessions:
+        start = combine(row["date_start"], row["start"])
+        end = combine(row["date_end"], row["end"])
+        if row["host"] is None or start is None or end is None or end < start:
+            continue
+        key = (row["app"], row["user"], start)
+        host_sessions = by_host_sessions.setdefault(row["host"], {})
+        if key not in host_sessions or end > host_sessions[key]["end"]:
+            host_sessions[key] = {
+                "host": row["host"], "app": row["app"], "user": row["user"], "file": row["file"],
+                "start": start, "end": end, "pi": pis.get((row["host"], row["user"])),
+            }
+
+    by_host_objects: dict[str, list[dict]] = {}
+    for row in objects:
+        when = combine(row["date"], row["time"])
+        host = NAME_MAP.get(row["host"], row["host"])
+        if host is None or when is None:
+            continue
+        by_host_objects.setdefault(host, []).append({
+            "host": host, "app": row["app"], "user": row["user"], "userdir": row["userdir"],
+            "time": when, "object": row["object"], "pi": pis.get((host, row["userdir"])) or pis.get((host, row["user"])),
+        })
+
+    indexes: dict[str, HostIndex] = {}
+    for host in set(by_host_sessions) | set(by_host_objects):
+        host_sessions = sorted(by_host_sessions.get(host, {}).values(), key=lambda s: s["start"])
+        host_objects = sorted(by_host_objects.get(host, []), key=lambda o: o["time"])
+        indexes[host] = HostIndex(
+            sessions=host_sessions,
+            session_starts=[s["start"] for s in host_sessions],
+            max_session=max((s["end"] - s["start"] for s in host_sessions), default=timedelta(0)),
+            objects=host_objects,
+            object_times=[o["time"] for o in host_objects],
+        )
+    return indexes
+
+def parse_time(value: str|None, end: bool = False) -> datetime|None:
+    """
+    Parses a from/to parameter: YYYY-MM-DD or YYYY-MM-DDTHH:MM[:SS]. A bare
+    date as the end of a range includes the whole day.
+    """
+    if not value:
+        return None
+    if len(value) == 10:
+        day = datetime.combine(date.fromisoformat(value), datetime.min.time())
+        return day + timedelta(days=1) if end else day
+    return datetime.fromisoformat(value)
+
+def to_json(record: dict) -> dict:
+    return {k: v.isoformat() if isinstance(v, datetime) else v for k, v in record.items()}
+
+class QueryIndex:
+    """
+    In-memory indexes of the summaries, reloaded when one of the source
+    files changes, with an LRU cache of the query results (as JSON bytes).
+    """
+    def __init__(self,
+                 sources: list[str],
+                 loader: Callable[[], tuple[list[dict], list[dict]]],
+                 cache_size: int = 1024):
+        self.sources = sources
+        self.loader = loader
+        self.lock = threading.Lock()
+        self.version: tuple|None = None
+        self.failed_version: tuple|None = None
+        self.error: str|None = None     # why the last load failed
+        self.indexes: dict[str, HostIndex] = {}
+        self.loaded_at = 0.0
+        self.query = functools.lru_cache(maxsize=cache_size)(self.run_query)
+
+    def current_version(self) -> tuple:
+        version = []
+        for path in self.sources:
+            try:
+                st = os.stat(path)
+                version.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                version.append(None)
+        return tuple(version)
+
+    def refresh(self) -> tuple|None:
+        """
+        Reloads the indexes (and clears the cache) if the sources changed.
+        Returns the data version, part of every cache key, or None while no
+        indexes could be loaded. A load that fails (e.g. a summary caught
+        while it is written) keeps the previous indexes, and is tried again
+        once the sources change again.
+        """
+        version = self.current_version()
+        if version != self.version and version != self.failed_version:
+            with self.lock:
+                if version != self.version and version != self.failed_version:
+                    t0 = time.perf_counter()
+                    try:
+                        indexes = build_indexes(*self.loader())
+                    except Exception as e:
+                        self.failed_version, self.error = version, f"{type(e).__name__}: {e}"
+                        print(f"{colored('[WARN ]', 'yellow', attrs=['bold'])} summaries not loaded ({self.error}), {'serving the previous indexes' if self.version else 'nothing to serve yet'}")
+                        return self.version
+                    self.query.cache_clear()
+                    self.indexes, self.version = indexes, version
+                    self.failed_version, self.error = None, None
+                    self.loaded_at = time.time()
+                    print(f"{colored('[ OK  ]', 'green', attrs=['bold'])} indexes loaded: {len(indexes)} hosts in {time.perf_counter() - t0:.2f} s")
+        return self.version
+
+    def hosts(self, host: str|None) -> list[str]:
+        from manage_history_files import NAME_MAP
+
+        if host is None:
+            return sorted(self.indexes)
+        return [NAME_MAP.get(host, host)]
+
+    def run_query(self, version: tuple, kind: str, host: str|None, start: datetime|None, end: datetime|None,
+                  user: str|None, pi: str|None, limit: int|None) -> bytes:
+        results: list[dict] = []
+        for name in self.hosts(host):
+            index = self.indexes.get(name)
+            if index is None:
+                continue
+            if kind == "sessions":
+                # sessions overlapping [start, end): they start before end, and
+                # not earlier than start minus the longest session
+                lo = 0 if start is None else bisect.bisect_left(index.session_starts, start - index.max_session)
+                hi = len(index.sessions) if end is None else bisect.bisect_left(index.session_starts, end)
+                candidates = (s for s in index.sessions[lo:hi] if start is None or s["end"] > start)
+            else:
+                lo = 0 if start is None else bisect.bisect_left(index.object_times, start)
+                hi = len(index.objects) if end is None else bisect.bisect_left(index.object_times, end)
+                candidates = iter(index.objects[lo:hi])
+            results.extend(
+                record for record in candidates
+                if (user is None or record["user"] == user) and (pi is None or record["pi"] == pi)
+            )
+        results.sort(key=lambda r: r["start" if kind == "sessions" else "time"])
+        if limit is not None:
+            results = results[:limit]
+        return json.dumps({"count": len(results), kind: [to_json(r) for r in results]}).encode("utf-8")
+
+    def summary(self) -> dict:
+        hosts = {}
+        for name, index in sorted(self.indexes.items()):
+            times = index.session_starts + index.object_times
+            hosts[name] = {
+                "sessions": len(index.sessions),
+                "objects": len(index.objects),
+                "from": min(times).isoformat() if times else None,
+                "to": max(times).isoformat() if times else None,
+            }
+        return hosts
+
+    def stats(self) -> dict:
+        info = self.query.cache_info()
+        return {
+            "hits": info.hits,
+            "misses": info.misses,
+            "cached": info.currsize,
+            "cache_size": info.maxsize,
+            "loaded_at": datetime.fromtimestamp(self.loaded_at).isoformat(timespec="seconds") if self.loaded_at else None,
+            "sources": self.sources,
+            "load_error": self.error,
+        }
+
+class QueryHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive: every response has a Content-Length
+    disable_nagle_algorithm = True # headers and body are separate writes
+    index: QueryIndex       # set by make_server()
+    quiet: bool = True
+
+    def send_json(self, status: int, body: bytes) -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            version = self.index.refresh()
+            if version is None:
+                self.send_json(503, json.dumps({"error": f"summaries not loaded: {self.index.error}"}).encode("utf-8"))
+                return
+            if url.path in ("/sessions", "/objects"):
+                limit = int(params["limit"]) if "limit" in params else None
+                body = self.index.query(
+                    version,
+                    url.path.lstrip("/"),
+                    params.get("host"),
+                    parse_time(params.get("from")),
+                    parse_time(params.get("to"), end=True),
+                    params.get("user"),
+                    params.get("pi"),
+                    limit,
+                )
+            elif url.path == "/hosts":
+                body = json.dumps(self.index.summary()).encode("utf-8")
+            elif url.path == "/stats":
+                body = json.dumps(self.index.stats()).encode("utf-8")
+            else:
+                self.send_json(404, json.dumps({"error": f"unknown path {url.path}"}).encode("utf-8"))
+                return
+        except ValueError as e:
+            self.send_json(400, json.dumps({"error": str(e)}).encode("utf-8"))
+            return
+        except Exception as e:
+            # e.g. a column missing from the summaries: answer instead of dropping the connection
+            print(f"{colored('[ERROR]', 'cyan', attrs=['bold'])} {self.path}: {type(e).__name__}: {e}")
+            self.send_json(500, json.dumps({"error": f"{type(e).__name__}: {e}"}).encode("utf-8"))
+            return
+        self.send_json(200, body)
+
+    def log_message(self, format: str, *args) -> None:
+        if not self.quiet:
+            super().log_message(format, *args)
+
+def make_server(index: QueryIndex, address: str = "127.0.0.1", port: int = 8765, quiet: bool = True) -> ThreadingHTTPServer:
+    handler = type("Handler", (QueryHandler,), {"index": index, "quiet": quiet})
+    return ThreadingHTTPServer((address, port), handler)
+
+def main(sessions_file: str = "history_files_summary.xlsx",
+         objects_file: str = "objects_summary.xlsx",
+         address: str = "127.0.0.1",
+         port: int = 8765,
+         cache_size: int = 1024,
+         quiet: bool = False) -> None:
+    index = QueryIndex([sessions_file, objects_file], lambda: load_summaries(sessions_file, objects_file), cache_size)
+    index.refresh()
+    server = make_server(index, address, port, quiet)
+    print(f"Serving on http://{address}:{server.server_address[1]}/ (sessions, objects, hosts, stats)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Server stopped.")
+    finally:
+        server.server_close()
+
+def cli(argv: list[str]|None = None) -> None:
+    parser = argparse.ArgumentParser(description="HTTP/JSON queries on the sessions and objects summaries")
+    parser.add_argument("--sessions", default="history_files_summary.xlsx", help="Sessions summary (from manage_history_files)")
+    parser.add_argument("--objects", default="objects_summary.xlsx", help="Objects summary (from objects)")
+    parser.add_argument("--address", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on")
+    parser.add_argument("--cache-size", type=int, default=1024, help="Query results kept in the LRU cache")
+    parser.add_argument("--quiet", action="store_true", help="Do not log the requests")
+
+    args: argparse.Namespace = parser.parse_args(argv)
+
+    main(args.sessions, args.objects, args.address, args.port, args.cache_size, args.quiet)
+
+if __name__ == "__main__":
+    cli()
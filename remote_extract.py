@@ -0,0 +1,203 @@
+#remote_extract.py
+# Reporting refresh without downloading the history files: extract_agent.py
+# is sent to each instrument PC over ssh and sends back, from where the
+# previous run stopped, only the lines the parsers need (see its header).
+# The reduced copies are kept in ./.agent/<host>/<app>/<user>/<file> and
+# parsed into their own summaries (history_files_summary.agent.xlsx,
+# objects_summary.agent.xlsx), to be given to attribute/serve with
+# --sessions/--objects. They only cover the active history files: the full
+# summaries, with the rotations and the .stversions/ copies, still come from
+# the full sync (download_history_files), which stays the way to archive the
+# files.
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+from termcolor import colored
+
+import download_history_files
+from download_history_files import REMOTES_DATA, is_host_reachable, ssh_options
+
+AGENT_SOURCE: str = Path(__file__).with_name("extract_agent.py").read_text(encoding="utf-8")
+
+# reduced copies and, in state.json, where each remote file was left
+AGENT_DIR = Path("./.agent")
+STATE_FILE = AGENT_DIR / "state.json"
+
+# the PCs have python3 or, the oldest ones, only python 2
+REMOTE_PYTHON = 'exec "$(command -v python3 || command -v python)" -'
+
+def load_state() -> dict[str, dict]:
+    if not STATE_FILE.exists():
+        return {}
+    with open(STATE_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def save_state(state: dict[str, dict]) -> None:
+    AGENT_DIR.mkdir(exist_ok=True)
+    tmp_file = STATE_FILE.with_name(f".{STATE_FILE.name}.tmp")
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, STATE_FILE)
+
+def agent_patterns() -> dict[str, tuple[str, int]]:
+    """
+    The patterns of the parsers, sent to the agent so that both sides always
+    use the same ones.
+    """
+    from manage_history_files import date_time_start_pattern, end_pattern
+    from objects import object_pattern, date_pattern
+
+    return {
+        "date_time_start": (date_time_start_pattern.pattern, date_time_start_pattern.flags),
+        "end": (end_pattern.pattern, end_pattern.flags),
+        "object": (object_pattern.pattern, object_pattern.flags),
+        "date": (date_pattern.pattern, date_pattern.flags),
+    }
+
+def agent_script(files: list[tuple[str, int, int, int]]) -> bytes:
+    # the job is appended as a Python literal: the agent needs no json module
+    job = (agent_patterns(), files)
+    return f"{AGENT_SOURCE}\nmain({job!r})\n".encode("utf-8")
+
+def parse_agent_output(stdout: bytes) -> dict[int, dict]:
+    """
+    Groups the agent output by file index: {"lines": [...], "end": (offset,
+    kept bytes, head len, head crc, reset)} or {"missing": True}.
+    """
+    results: dict[int, dict] = {}
+    for raw in stdout.splitlines(keepends=True):
+        index, sep, rest = raw.partition(b"\t")
+        if not sep or not index.isdigit():
+            continue
+        result = results.setdefault(int(index), {"lines": [], "end": None, "missing": False})
+        kind, sep, data = rest.partition(b"\t")
+        if kind == b"L":
+            result["lines"].append(data)
+        elif kind == b"E":
+            result["end"] = tuple(int(value) for value in data.split(b"\t"))
+        elif kind.rstrip() == b"M":
+            result["missing"] = True
+    return results
+
+def extract_host(remote: dict, state: dict[str, dict]) -> tuple[int, int]:
+    """
+    Runs the agent on a host and updates the reduced copies of its history
+    files. Returns (bytes received, bytes of the remote files read).
+    """
+    host: str = remote["host"]
+    user: str = remote["user"]
+
+    keys: list[tuple[str, str, str]] = [
+        (app, username, name)
+        for app in remote["apps"]
+        for username in remote["usernames"]
+        for name in ("history", "history.old")
+    ]
+    files: list[tuple[str, int, int, int]] = []
+    for app, username, name in keys:
+        entry = state.get(f"{host}/{app}/{username}/{name}", {})
+        files.append((f"/opt/{app}/prog/curdir/{username}/{name}", entry.get("offset", 0), entry.get("head_len", 0), entry.get("head_crc", 0)))
+
+    cmd = ["ssh", *ssh_options(host), "-oBatchMode=yes", f"{user}@{host}", REMOTE_PYTHON]
+    res = download_history_files.run_command(cmd, input=agent_script(files), capture_output=True)
+    results = parse_agent_output(res.stdout)
+    if res.returncode != 0 or not results:
+        print(f"{colored('[ERROR]', 'cyan', attrs=['bold'])} extraction agent failed on {host} (rc={res.returncode}): {res.stderr.decode('utf-8', errors='replace').strip()}")
+        return len(res.stdout), 0
+
+    read = 0
+    for index, (app, username, name) in enumerate(keys):
+        result = results.get(index)
+        if result is None or result["missing"]:
+            continue
+        if result["end"] is None:
+            print(f"{colored('[WARN ]', 'yellow', attrs=['bold'])} {host}/{app}/{username}/{name}: agent output cut short, not updated")
+            continue
+        key = f"{host}/{app}/{username}/{name}"
+        entry = state.get(key, {})
+        offset, kept, head_len, head_crc, reset = result["end"]
+        local = 0 if reset else entry.get("local", 0)
+        if reset and entry:
+            print(f"{colored('[WARN ]', 'yellow', attrs=['bold'])} {key} was rotated or rewritten, extracted again from the start")
+
+        # the last session of the previous run is replaced by what follows it
+        local_file = AGENT_DIR / host / app / username / name
+        local_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(local_file, "r+b" if local_file.exists() else "wb") as f:
+            f.truncate(local)
+            f.seek(local)
+            f.writelines(result["lines"])
+        read += offset - (0 if reset else entry.get("offset", 0))
+        state[key] = {"offset": offset, "local": local + kept, "head_len": head_len, "head_crc": head_crc, "extracted_at": time.time()}
+        print(f"{colored('[ OK  ]', 'green', attrs=['bold'])} {key}: {sum(len(line) for line in result['lines'])} bytes extracted")
+
+    return len(res.stdout), read
+
+def write_agent_summaries(output_dir: Path = Path(".")) -> tuple[str, str]:
+    """
+    Parses the reduced copies into the summaries of the sessions and of the
+    objects, next to (never over) the full ones. Returns their paths.
+    """
+    from manage_history_files import NAME_MAP, group_lineages, parse_lineage, write_summary as write_sessions_summary
+    from objects import extract_objects, write_summary as write_objects_summary
+    from utils import iter_lines
+
+    paths: list[str] = sorted(
+        str(p) for p in AGENT_DIR.glob("*/*/*/*")
+        if p.is_file() and p.name in ("history", "history.old")
+    )
+
+    sessions: list[dict] = []
+    objects: list[dict] = []
+    for lineage, lineage_paths in group_lineages(paths).items():
+        host, app, username = Path(lineage).relative_to(AGENT_DIR).parts
+        # the reduced copies have no recognizable path: metadata set here
+        for record in parse_lineage(lineage_paths):
+            record.update(host=NAME_MAP.get(host), app=app, user=username)
+            sessions.append(record)
+        for path in lineage_paths:
+            for event in extract_objects(iter_lines(path), host, app, username, Path(path).name):
+                objects.append(event._asdict())
+
+    sessions_file = str(output_dir / "history_files_summary.agent.xlsx")
+    objects_file = str(output_dir / "objects_summary.agent.xlsx")
+    for records, write_summary, path in [(sessions, write_sessions_summary, sessions_file), (objects, write_objects_summary, objects_file)]:
+        if not records:
+            print(f"{colored('[WARN ]', 'yellow', attrs=['bold'])} nothing extracted, {path} not written")
+            continue
+        write_summary(records, path)
+        print(f"{colored('[ OK  ]', 'green', attrs=['bold'])} {path}: {len(records)} records")
+    return sessions_file, objects_file
+
+def main(hosts: list[str]|None = None) -> None:
+    remotes = [remote for remote in REMOTES_DATA if not hosts or remote["host"] in hosts]
+    state = load_state()
+    received = read = 0
+    for remote in remotes:
+        if not is_host_reachable(remote["ip"]):
+            print(f"\n{colored('### Host ' + remote['host'] + ' is not reachable...', 'red', attrs=['bold'])}")
+            continue
+        print(f"\n{colored('### Extracting ' + remote['host'] + ' ...', 'green', attrs=['bold'])}")
+        host_received, host_read = extract_host(remote, state)
+        save_state(state)
+        received += host_received
+        read += host_read
+        print(f"  {host_received} bytes received for {host_read} bytes of history read remotely")
+
+    sessions_file, objects_file = write_agent_summaries()
+    print(f"\nTotal: {received} bytes received, {read} bytes of history read remotely")
+    # merged into the full summaries they would replace what only the full sync sees
+    print(f"Use with: attribution.py --sessions {sessions_file} --objects {objects_file} (or query_service.py)")
+
+def cli(argv: list[str]|None = None) -> None:
+    parser = argparse.ArgumentParser(description="Extract sessions and objects on the instrument PCs, transferring only the lines needed")
+    parser.add_argument("--host", action="append", dest="hosts", help="Extract only this host (repeatable)")
+
+    args: argparse.Namespace = parser.parse_args(argv)
+
+    main(hosts=args.hosts)
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,89 @@
+#retention.py
+# Retention of the Syncthing .stversions/ folders. Syncthing keeps a
+# history~YYYYMMDD-hhmmss copy of every version of a history file forever,
+# and each run discovers them and checks them for containment again. Once
+# promote_stversions has run, a version whose content is contained in a file
+# of the main history directory of its lineage brings nothing new: it is
+# deleted, and recorded in an audit manifest (JSON lines):
+#   {"pruned_at", "path", "size", "sha256", "contained_in", "offset"}
+import hashlib
+import json
+import os
+from datetime import datetime
+from pathlib import Path
+from termcolor import colored
+
+from compression import open_compressed, plain_name
+
+PRUNE_MANIFEST = "stversions_pruned.jsonl"
+
+def read_content(path: Path) -> bytes:
+    # .gz/.zst rotations are compared by their decompressed content
+    with open_compressed(path, "rb") as f:
+        return f.read()
+
+def is_stversion(path: Path) -> bool:
+    return ".stversions/" in str(path)
+
+def find_container(version: Path, data: bytes, retained: list[Path], contents: dict[Path, bytes]) -> tuple[Path, int]|None:
+    """
+    Returns the retained file holding the whole content of a version, and
+    where it starts in it. The file with the same name (the promoted copy) is
+    tried first, then the others from the smallest.
+    """
+    for path in retained:
+        if path not in contents:
+            contents[path] = read_content(path)
+    candidates: list[Path] = [p for p in retained if len(contents[p]) >= len(data)]
+    candidates.sort(key=lambda p: (plain_name(p.name) != plain_name(version.name), len(contents[p])))
+    for path in candidates:
+        offset: int = contents[path].find(data)
+        if offset >= 0:
+            return path, offset
+    return None
+
+def record_pruned(manifest: str, entry: dict) -> None:
+    # on disk before the file is deleted: a crash cannot lose a deletion
+    with open(manifest, "a", encoding="utf-8") as f:
+        f.write(json.dumps(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+def prune_stversions(groups: list[list[Path]], dry_run: bool = False, manifest: str|None = PRUNE_MANIFEST) -> int:
+    """
+    Deletes the .stversions/ files of each lineage group (see group_stversions)
+    contained in a file of the main history directory, appending each deletion
+    to manifest. With dry_run nothing is deleted or recorded.
+    Returns the number of files (to be) pruned.
+    """
+    pruned: int = 0
+    pruned_bytes: int = 0
+    kept: int = 0
+    for group in groups:
+        retained: list[Path] = [p for p in group if not is_stversion(p) and p.is_file()]
+        contents: dict[Path, bytes] = {}
+        for version in (p for p in group if is_stversion(p)):
+            data: bytes = read_content(version)
+            found = find_container(version, data, retained, contents)
+            if found is None:
+                kept += 1
+                continue
+            container, offset = found
+            print(f"{colored(version.name, 'red', attrs=['bold'])} {'would be' if dry_run else 'is'} pruned from .stversions/ (contained in {colored(container.name, 'green', attrs=['bold'])})")
+            pruned += 1
+            pruned_bytes += len(data)
+            if dry_run:
+                continue
+            if manifest:
+                record_pruned(manifest, {
+                    "pruned_at": datetime.now().isoformat(timespec="seconds"),
+                    "path": str(version),
+                    "size": len(data),
+                    "sha256": hashlib.sha256(data).hexdigest(),
+                    "contained_in": str(container),
+                    "offset": offset,
+                })
+            version.unlink()
+
+    print(f"{colored('[ OK  ]', 'green', attrs=['bold'])} .stversions/: {pruned} files ({pruned_bytes / 1e6:.1f} MB) {'to prune (dry run)' if dry_run else 'pruned'}, {kept} kept")
+    return pruned
@@ -0,0 +1,184 @@
+#rollups.py
+# Daily rollups per host/app/user (sessions, total duration, objects), kept
+# in a SQLite database next to the summaries and updated incrementally while
+# the records are parsed. Every run re-parses the same sessions and objects
+# (and a session appears in every rotation of its history file), so the
+# records already counted are kept in seen_* tables: only new sessions, the
+# growth of a session still running at the previous run, and new objects
+# change the totals.
+#   daily(host, app, user, day, sessions, duration_s, objects)
+import argparse
+import sqlite3
+from datetime import datetime
+
+ROLLUP_FILE = "daily_rollups.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS daily (
+    host TEXT NOT NULL, app TEXT NOT NULL, user TEXT NOT NULL, day TEXT NOT NULL,
+    sessions INTEGER NOT NULL DEFAULT 0,
+    duration_s INTEGER NOT NULL DEFAULT 0,
+    objects INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (host, app, user, day)
+);
+CREATE TABLE IF NOT EXISTS seen_sessions (
+    host TEXT NOT NULL, app TEXT NOT NULL, user TEXT NOT NULL, day TEXT NOT NULL, start TEXT NOT NULL,
+    duration_s INTEGER NOT NULL,
+    PRIMARY KEY (host, app, user, day, start)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS seen_objects (
+    host TEXT NOT NULL, app TEXT NOT NULL, user TEXT NOT NULL, day TEXT NOT NULL, time TEXT NOT NULL, object TEXT NOT NULL,
+    PRIMARY KEY (host, app, user, day, time, object)
+) WITHOUT ROWID;
+CREATE TEMP TABLE IF NOT EXISTS batch_sessions (host, app, user, day, start, duration_s);
+CREATE TEMP TABLE IF NOT EXISTS batch_objects (host, app, user, day, time, object);
+"""
+
+# new sessions count once, sessions seen shorter add what they grew
+ADD_SESSIONS = """
+INSERT INTO daily (host, app, user, day, sessions, duration_s)
+SELECT b.host, b.app, b.user, b.day, SUM(s.duration_s IS NULL), SUM(b.duration_s - COALESCE(s.duration_s, 0))
+FROM (SELECT host, app, user, day, start, MAX(duration_s) AS duration_s FROM batch_sessions GROUP BY host, app, user, day, start) AS b
+LEFT JOIN seen_sessions AS s USING (host, app, user, day, start)
+WHERE s.duration_s IS NULL OR b.duration_s > s.duration_s
+GROUP BY b.host, b.app, b.user, b.day
+ON CONFLICT (host, app, user, day) DO UPDATE SET
+    sessions = sessions + excluded.sessions,
+    duration_s = duration_s + excluded.duration_s
+"""
+
+SEE_SESSIONS = """
+INSERT INTO seen_sessions (host, app, user, day, start, duration_s)
+SELECT host, app, user, day, start, MAX(duration_s) FROM batch_sessions WHERE true GROUP BY host, app, user, day, start
+ON CONFLICT (host, app, user, day, start) DO UPDATE SET duration_s = MAX(duration_s, excluded.duration_s)
+"""
+
+ADD_OBJECTS = """
+INSERT INTO daily (host, app, user, day, objects)
+SELECT host, app, user, day, COUNT(*)
+FROM (SELECT DISTINCT host, app, user, day, time, object FROM batch_objects) AS b
+WHERE NOT EXISTS (
+    SELECT 1 FROM seen_objects AS s
+    WHERE s.host = b.host AND s.app = b.app AND s.user = b.user AND s.day = b.day AND s.time = b.time AND s.object = b.object
+)
+GROUP BY host, app, user, day
+ON CONFLICT (host, app, user, day) DO UPDATE SET objects = objects + excluded.objects
+"""
+
+SEE_OBJECTS = "INSERT OR IGNORE INTO seen_objects SELECT DISTINCT * FROM batch_objects"
+
+def session_seconds(record: dict) -> int:
+    """
+    Duration of a session record in seconds, from its start and end (0 if
+    they are missing or not valid).
+    """
+    try:
+        start = datetime.strptime(f"{record['date_start']} {record['start']}", "%Y-%m-%d %H:%M:%S")
+        end = datetime.strptime(f"{record['date_end']} {record['end']}", "%Y-%m-%d %H:%M:%S")
+    except (TypeError, ValueError):
+        return 0
+    return max(0, int((end - start).total_seconds()))
+
+class RollupSink:
+    """
+    Sink (see sinks.py) updating the daily rollups with the records of the
+    "sessions" or "objects" table. Sessions are counted on their start day.
+    """
+    readable = False
+
+    def __init__(self, path: str = ROLLUP_FILE, table: str = "sessions"):
+        self.path = str(path)
+        self.table = table
+        # the writer thread is the only user of the connection; shards running
+        # at the same time wait for each other's transactions
+        self.db = sqlite3.connect(self.path, timeout=60, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.name_map: dict[str, str] = {}
+        if table == "objects":
+            # objects keep the host folder name, sessions the canonical one
+            from manage_history_files import NAME_MAP
+            self.name_map = NAME_MAP
+
+    def write(self, records: list[dict]) -> None:
+        if self.table == "sessions":
+            rows = [
+                (r["host"] or "", r["app"] or "", r["user"] or "", r["date_start"], r["start"], session_seconds(r))
+                for r in records
+                if r["date_start"] is not None and r["start"] is not None
+            ]
+            batch, add, see = "batch_sessions", ADD_SESSIONS, SEE_SESSIONS
+        else:
+            rows = [
+                (self.name_map.get(r["host"], r["host"]) or "", r["app"] or "", r["user"] or "", r["date"], r["time"], r["object"])
+                for r in records
+                if r["date"] is not None and r["time"] is not None and r["object"] is not None
+            ]
+            batch, add, see = "batch_objects", ADD_OBJECTS, SEE_OBJECTS
+        if not rows:
+            return
+
+        # one transaction per batch: the totals and the seen records move together
+        with self.db:
+            self.db.executemany(f"INSERT INTO {batch} VALUES ({', '.join('?' * len(rows[0]))})", rows)
+            self.db.execute(add)
+            self.db.execute(see)
+            self.db.execute(f"DELETE FROM {batch}")
+
+    def close(self) -> None:
+        self.db.close()
+
+# period -> SQL expression of the day column
+PERIODS: dict[str, str] = {
+    "day": "day",
+    "week": "date(day, '-6 days', 'weekday 1')",   # monday of the week
+    "month": "substr(day, 1, 7)",
+    "year": "substr(day, 1, 4)",
+}
+
+def query(path: str = ROLLUP_FILE,
+          period: str = "month",
+          by: list[str]|None = None,
+          hosts: list[str]|None = None,
+          since: str|None = None) -> list[tuple]:
+    """
+    Sums the daily rollups by period and by the given columns (host, app,
+    user). Returns (period, *by, sessions, hours, objects) rows.
+    """
+    by = by if by is not None else ["host"]
+    where: list[str] = []
+    params: list = []
+    if hosts:
+        where.append(f"host IN ({', '.join('?' * len(hosts))})")
+        params.extend(hosts)
+    if since:
+        where.append("day >= ?")
+        params.append(since)
+    columns = ", ".join([f"{PERIODS[period]} AS period", *by])
+    sql = (
+        f"SELECT {columns}, SUM(sessions), ROUND(SUM(duration_s) / 3600.0, 2), SUM(objects) FROM daily"
+        f"{' WHERE ' + ' AND '.join(where) if where else ''}"
+        f" GROUP BY {', '.join(['period', *by])} ORDER BY {', '.join(['period', *by])}"
+    )
+    db = sqlite3.connect(path)
+    try:
+        return db.execute(sql, params).fetchall()
+    finally:
+        db.close()
+
+def cli(argv: list[str]|None = None) -> None:
+    parser = argparse.ArgumentParser(description="Usage from the daily rollups (sessions, hours, objects)")
+    parser.add_argument("--db", default=ROLLUP_FILE, help="Rollups database (written by manage_history_files/objects)")
+    parser.add_argument("--period", choices=PERIODS, default="month", help="Time period of the rows")
+    parser.add_argument("--by", action="append", choices=["host", "app", "user"], help="Group also by this column (repeatable, default: host)")
+    parser.add_argument("--host", action="append", dest="hosts", help="Only this host (repeatable)")
+    parser.add_argument("--since", default=None, help="Only from this day on (YYYY-MM-DD)")
+
+    args: argparse.Namespace = parser.parse_args(argv)
+
+    by: list[str] = args.by or ["host"]
+    print(f"{'period':<12}" + "".join(f"{c:<16}" for c in by) + f"{'sessions':>10}{'hours':>12}{'objects':>10}")
+    for period, *values, sessions, hours, objects in query(args.db, args.period, by, args.hosts, args.since):
+        print(f"{period:<12}" + "".join(f"{v:<16}" for v in values) + f"{sessions:>10}{hours:>12.2f}{objects:>10}")
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,92 @@
+#sharding.py
+import argparse
+import csv
+import hashlib
+import os
+import re
+from pathlib import Path
+
+def parse_shard(value: str) -> tuple[int, int]:
+    """
+    Parses a shard specification 'i/N' (1 <= i <= N).
+    """
+    m = re.fullmatch(r"(?P<index>\d+)/(?P<count>\d+)", value.strip())
+    if not m or not 1 <= int(m.group("index")) <= int(m.group("count")):
+        raise argparse.ArgumentTypeError(f"Invalid shard: '{value}'. Expected format i/N with 1 <= i <= N")
+    return int(m.group("index")), int(m.group("count"))
+
+def shard_of(path: str, count: int) -> int:
+    """
+    Returns the shard (1..count) of a history file.
+    The hash is taken on its lineage directory, with the .stversions/ folder
+    and the file name stripped, so that all the rotations of a host/app/user
+    land in the same shard, on every machine.
+    """
+    lineage = os.path.dirname(str(path)).replace("/.stversions/", "/")
+    digest = hashlib.sha1(lineage.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count + 1
+
+def select_files(results: list[str],
+                 pattern: re.Pattern,
+                 shard: tuple[int, int]|None = None,
+                 hosts: list[str]|None = None,
+                 apps: list[str]|None = None,
+                 name_map: dict[str, str]|None = None) -> list[str]:
+    """
+    Keeps the files of the given shard and, if given, of the given hosts and apps.
+    Hosts are compared with the host folder names matched by pattern and,
+    if name_map is given, with their canonical names.
+    """
+    selected: list[str] = []
+    for path in results:
+        if shard and shard_of(path, shard[1]) != shard[0]:
+            continue
+        if hosts or apps:
+            match = pattern.search(str(path))
+            if not match:
+                continue
+            names = {match.group("host"), match.groupdict().get("host_600")}
+            if name_map:
+                names |= {name_map.get(name) for name in names}
+            if hosts and not names & set(hosts):
+                continue
+            if apps and match.group("app") not in apps:
+                continue
+        selected.append(path)
+    return selected
+
+def partial_name(output_file: str, shard: tuple[int, int]|None) -> str:
+    stem = Path(output_file).stem
+    if shard:
+        return f"{stem}.shard-{shard[0]}-of-{shard[1]}.csv"
+    return f"{stem}.partial.csv"
+
+def write_partial(records: list[dict], path: str) -> None:
+    fieldnames: list[str] = list(records[0].keys()) if records else []
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        for record in records:
+            writer.writerow({k: "" if v is None else v for k, v in record.items()})
+    print(f"Partial result written: {path} ({len(records)} records)")
+
+def read_partials(paths: list[Path]) -> list[dict]:
+    """
+    Reads back the records of the partial results. Rows found in more than
+    one partial (e.g. overlapping --host/--app runs) are kept only once.
+    """
+    records: list[dict] = []
+    seen: set[tuple] = set()
+    for path in paths:
+        current: set[tuple] = set()
+        with open(path, "r", newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                record = {k: None if v == "" else v for k, v in row.items()}
+                key = tuple(record.items())
+                if key in seen:
+                    continue
+                current.add(key)
+                records.append(record)
+        seen |= current
+        print(f"Partial result read: {path}")
+    return records
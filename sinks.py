@@ -0,0 +1,234 @@
+#sinks.py
+# Output pipeline: the parsers push batches of records into a bounded queue
+# and a writer thread appends them to the sinks (CSV, SQLite, Parquet) while
+# parsing goes on. Only the Excel view, which needs the whole sorted record
+# set, is written at the end, reading the records back from a sink.
+import csv
+import os
+import queue
+import sqlite3
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+from termcolor import colored
+
+class CsvSink:
+    """
+    Appends records to a CSV file (None written as "", as write_partial does).
+    """
+    readable = True
+
+    def __init__(self, path: str):
+        self.path = str(path)
+        self.f = open(self.path, "w", newline="", encoding="utf-8")
+        self.writer: csv.DictWriter|None = None
+
+    def write(self, records: list[dict]) -> None:
+        if not records:
+            return
+        if self.writer is None:
+            self.writer = csv.DictWriter(self.f, fieldnames=list(records[0].keys()))
+            self.writer.writeheader()
+        for record in records:
+            self.writer.writerow({k: "" if v is None else v for k, v in record.items()})
+
+    def close(self) -> None:
+        self.f.close()
+
+    def read(self) -> Iterator[dict]:
+        with open(self.path, "r", newline="", encoding="utf-8") as f:
+            for row in csv.DictReader(f):
+                yield {k: (v if v != "" else None) for k, v in row.items()}
+
+class SqliteSink:
+    """
+    Appends records to a table of a SQLite database (replaced at every run).
+    """
+    readable = True
+
+    def __init__(self, path: str, table: str = "records"):
+        self.path = str(path)
+        self.table = table
+        # the writer thread is the only user of the connection
+        self.db = sqlite3.connect(self.path, check_same_thread=False)
+        self.db.execute(f'DROP TABLE IF EXISTS "{table}"')
+        self.columns: list[str]|None = None
+
+    def write(self, records: list[dict]) -> None:
+        if not records:
+            return
+        if self.columns is None:
+            self.columns = list(records[0].keys())
+            self.db.execute(f'CREATE TABLE "{self.table}" ({", ".join(f"{c!r} TEXT" for c in self.columns)})')
+        placeholders = ", ".join("?" for _ in self.columns)
+        self.db.executemany(
+            f'INSERT INTO "{self.table}" VALUES ({placeholders})',
+            ([record.get(c) for c in self.columns] for record in records),
+        )
+        self.db.commit()
+
+    def close(self) -> None:
+        self.db.commit()
+        self.db.close()
+
+    def read(self) -> Iterator[dict]:
+        db = sqlite3.connect(self.path)
+        try:
+            cursor = db.execute(f'SELECT * FROM "{self.table}"')
+            columns = [d[0] for d in cursor.description]
+            for row in cursor:
+                yield dict(zip(columns, row))
+        except sqlite3.OperationalError:
+            return  # no records, no table
+        finally:
+            db.close()
+
+class ParquetSink:
+    """
+    Appends records to a Parquet file, one row group per batch (needs pyarrow).
+    """
+    readable = False
+
+    def __init__(self, path: str):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise RuntimeError(f"{path}: the pyarrow package is needed for Parquet output")
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = str(path)
+        self.writer = None
+
+    def write(self, records: list[dict]) -> None:
+        if not records:
+            return
+        columns = list(records[0].keys())
+        table = self.pa.table({c: self.pa.array([record.get(c) for record in records], type=self.pa.string()) for c in columns})
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self) -> None:
+        if self.writer is not None:
+            self.writer.close()
+
+def open_sink(path: str, table: str = "records"):
+    """
+    Returns the sink for path, chosen by its extension (.csv, .sqlite/.db, .parquet).
+    """
+    suffix = Path(path).suffix.lower()
+    if suffix == ".csv":
+        return CsvSink(path)
+    if suffix in (".sqlite", ".sqlite3", ".db"):
+        return SqliteSink(path, table)
+    if suffix == ".parquet":
+        return ParquetSink(path)
+    raise ValueError(f"Unknown sink type: '{path}'. Expected .csv, .sqlite/.db or .parquet")
+
+class RecordPipeline:
+    """
+    Bounded queue of record batches consumed by a writer thread appending
+    them to the sinks. put() blocks when the writer is maxsize batches
+    behind, so memory stays bounded.
+    """
+    def __init__(self, sinks: list, maxsize: int = 8):
+        self.sinks = sinks
+        self.queue: queue.Queue = queue.Queue(maxsize=maxsize)
+        self.error: BaseException|None = None
+        self.failed_sink = None
+        self.records = 0
+        self.write_time = 0.0
+        self.wait_time = 0.0
+        self.thread = threading.Thread(target=self.run, name="sink-writer", daemon=True)
+        self.thread.start()
+
+    def run(self) -> None:
+        while (batch := self.queue.get()) is not None:
+            if self.error is not None:
+                continue  # drain the queue, so put() never blocks forever
+            t0 = time.perf_counter()
+            try:
+                for sink in self.sinks:
+                    sink.write(batch)
+                # counted only once every sink holds the batch
+                self.records += len(batch)
+            except BaseException as e:
+                self.error = e
+                self.failed_sink = sink
+            self.write_time += time.perf_counter() - t0
+
+    def put(self, batch: list[dict]) -> None:
+        if self.error is not None:
+            raise self.error
+        t0 = time.perf_counter()
+        self.queue.put(batch)
+        self.wait_time += time.perf_counter() - t0
+
+    def close(self) -> None:
+        """
+        Waits for the writer and closes every sink, then raises the first
+        failure: a write failure before a close failure.
+        """
+        self.queue.put(None)
+        self.thread.join()
+        close_error: BaseException|None = None
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except BaseException as e:
+                print(f"{colored('[ERROR]', 'cyan', attrs=['bold'])} Closing {type(sink).__name__} {getattr(sink, 'path', '')}: {e}")
+                close_error = close_error or e
+        if self.error is not None:
+            print(f"{colored('[ERROR]', 'cyan', attrs=['bold'])} Writing to {type(self.failed_sink).__name__} {getattr(self.failed_sink, 'path', '')} failed after {self.records} records: {self.error}")
+            raise self.error
+        if close_error is not None:
+            raise close_error
+
+def write_pipelined(batches: Iterable[list[dict]],
+                    sink_paths: list[str]|None,
+                    partial: str|None,
+                    write_summary: Callable[[list[dict], str], None],
+                    output_file: str,
+                    table: str = "records",
+                    extra_sinks: list|None = None) -> int:
+    """
+    Consumes the record batches of a parser, writing them to the sinks (the
+    given paths, plus already opened sinks such as rollups.RollupSink) as
+    they come; then writes the partial result or the Excel summary, read back
+    from a sink (a temporary CSV if none can be read). Returns the number of
+    records.
+    """
+    sinks = [open_sink(path, table) for path in sink_paths or []] + list(extra_sinks or [])
+    spool: CsvSink|None = None
+    if partial:
+        # same format as write_partial()
+        sinks.append(CsvSink(partial))
+    elif not any(sink.readable for sink in sinks):
+        fd, spool_path = tempfile.mkstemp(prefix=f".{Path(output_file).stem}.", suffix=".csv", dir=".")
+        os.close(fd)
+        spool = CsvSink(spool_path)
+        sinks.append(spool)
+
+    pipeline = RecordPipeline(sinks)
+    t0 = time.perf_counter()
+    try:
+        for batch in batches:
+            pipeline.put(batch)
+    finally:
+        pipeline.close()
+    elapsed = time.perf_counter() - t0
+    print(f"Records written while parsing: {pipeline.records} in {elapsed:.2f} s (sinks busy {pipeline.write_time:.2f} s, parser waited {pipeline.wait_time:.2f} s)")
+
+    try:
+        if partial:
+            print(f"Partial result written: {partial} ({pipeline.records} records)")
+        else:
+            source = spool or next(sink for sink in sinks if sink.readable)
+            write_summary(list(source.read()), output_file)
+    finally:
+        if spool is not None:
+            os.remove(spool.path)
+    return pipeline.records
@@ -1,13 +1,20 @@
 #utils.py
 from pathlib import Path
+from datetime import date, datetime
+import argparse
+import io
+import itertools
 import os
 import re
+import shutil
+from typing import BinaryIO, Iterable, Iterator
 from termcolor import colored
+from compression import COMPRESSED_SUFFIXES, open_compressed, plain_name
 
 def max_index(filename: str, dest_dir: Path) -> int:
     # Look for files named 'stem.<n>' and 'stem.<n>.gz' in the same directory
-    # Matches 'name.<number>' or 'name.<number>.gz' (for compressed rotations)
-    _suffix_re = re.compile(r"\.(?P<number>\d+)(?:\.gz)?$")
+    # Matches 'name.<number>' or 'name.<number>.gz'/'.zst' (for compressed rotations)
+    _suffix_re = re.compile(r"\.(?P<number>\d+)(?:\.gz|\.zst)?$")
     
     # Look for files named 'stem.<n>' and 'stem.<n>.gz' in the same directory
     max_n = 0
@@ -22,32 +29,162 @@ def max_index(filename: str, dest_dir: Path) -> int:
                 pass
     return max_n
 
-def find_history_files(start_dir="."):
-    target_names = {"history", "history.old"}
-    # Add history.old.n for n = 1..10
-    for n in range(1, 11):
-        target_names.add(f"history.{n}")
-        target_names.add(f"history.old.{n}")
-
-    # Regex for timestamped variants:
-    #   history~20251229-131900
-    #   history~20251229-131900.old
-    # Pattern details:
-    #   - YYYYMMDD: 8 digits
-    #   - '-'
-    #   - HHMMSS: 6 digits (24h)
-    #   - optional '.old'
-    ts_pattern = re.compile(r"^history~\d{8}-\d{6}(?:\.old)?$")
+# Regex for timestamped variants:
+#   history~20251229-131900
+#   history~20251229-131900.old
+# Pattern details:
+#   - YYYYMMDD: 8 digits
+#   - '-'
+#   - HHMMSS: 6 digits (24h)
+#   - optional '.old'
+ts_pattern = re.compile(r"^history~\d{8}-\d{6}(?:\.old)?$")
+
+target_names = {"history", "history.old"}
+# Add history.old.n for n = 1..10
+for n in range(1, 11):
+    target_names.add(f"history.{n}")
+    target_names.add(f"history.old.{n}")
+
+def is_history_file(fname: str) -> bool:
+    # also the .gz/.zst rotations written by download_history_files --compress
+    fname = plain_name(fname)
+    return fname in target_names or bool(ts_pattern.fullmatch(fname))
 
+def find_history_files(start_dir="."):
     matches = []
 
     for root, dirs, files in os.walk(start_dir):
         for fname in files:
-            if fname in target_names or ts_pattern.fullmatch(fname):
+            if is_history_file(fname):
                 matches.append(os.path.join(root, fname))
 
     return matches
 
+def source_name(source) -> str|None:
+    """
+    Returns the path of a history file source: a path, or the name of an open
+    file object (None for anonymous streams and bytes).
+    """
+    if isinstance(source, (str, os.PathLike)):
+        return os.fspath(source)
+    name = getattr(source, "name", None)
+    return name if isinstance(name, str) else None
+
+def iter_lines(source) -> Iterator[str]:
+    """
+    Lazily yields the text lines of a history file given as a path (.gz/.zst
+    rotations are decompressed), an open text or binary file object, or
+    bytes. File objects are not closed.
+    """
+    if isinstance(source, (str, os.PathLike)):
+        with open_compressed(source, 'rt', encoding='utf-8') as f:
+            yield from f
+    elif isinstance(source, (bytes, bytearray, memoryview)):
+        yield from io.TextIOWrapper(io.BytesIO(source), encoding='utf-8')
+    elif isinstance(source, io.TextIOBase) or isinstance(source.read(0), str):
+        yield from source
+    else:
+        wrapper = io.TextIOWrapper(source, encoding='utf-8')
+        try:
+            yield from wrapper
+        finally:
+            # leave the caller's stream open
+            wrapper.detach()
+
+def parse_date(date_str) -> date:
+    date_str: str = str.replace(date_str, '/', '-')
+    try:
+        # Convert string like "16-03-2025" to a date object
+        return datetime.strptime(date_str, "%d-%m-%Y").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid date: '{date_str}'. Expected format dd-mm-yyyy")
+
+def is_date_line_since(line: str, since: str, pattern: re.Pattern) -> bool:
+    match = pattern.match(line.rstrip("\r\n").lstrip())
+    return bool(match) and match.group("date") >= since
+
+def find_offset_since(f: BinaryIO, since: str, pattern: re.Pattern, block: int = 64 * 1024) -> int:
+    """
+    Returns the byte offset of the first date line (matched by pattern, with
+    a 'date' group) dated since (YYYY-MM-DD) or later, or the file size if
+    there is none. History files are chronological, so the offset is found by
+    bisection and only about log2(size / block) lines are read, plus one block.
+    """
+    def next_date(pos: int) -> str|None:
+        # date of the first date line starting after pos
+        f.seek(pos)
+        if pos > 0:
+            f.readline()  # partial line
+        for line in f:
+            match = pattern.match(line.decode("utf-8", errors="replace").rstrip("\r\n").lstrip())
+            if match:
+                return match.group("date")
+        return None
+
+    size = f.seek(0, os.SEEK_END)
+    lo, hi = 0, size
+    # invariant: the first date line after lo is older than since (or lo = 0),
+    # the first date line after hi is not
+    while hi - lo > block:
+        mid = (lo + hi) // 2
+        date_mid = next_date(mid)
+        if date_mid is None or date_mid >= since:
+            hi = mid
+        else:
+            lo = mid
+
+    f.seek(lo)
+    if lo > 0:
+        f.readline()
+    offset = f.tell()
+    for line in f:
+        if is_date_line_since(line.decode("utf-8", errors="replace"), since, pattern):
+            return offset
+        offset += len(line)
+    return size
+
+def iter_lines_since(source, since: date|None, pattern: re.Pattern) -> Iterator[str]:
+    """
+    Like iter_lines(), but starts at the first date line (see
+    find_offset_since) dated since or later. Plain files are entered by
+    bisection; streams and compressed rotations are read up to that line.
+    """
+    if since is None:
+        yield from iter_lines(source)
+        return
+    since_str: str = since.isoformat()
+
+    if isinstance(source, (str, os.PathLike)) and not os.fspath(source).endswith(COMPRESSED_SUFFIXES):
+        with open(source, 'rb') as f:
+            f.seek(find_offset_since(f, since_str, pattern))
+            yield from io.TextIOWrapper(f, encoding='utf-8')
+        return
+
+    yield from itertools.dropwhile(lambda line: not is_date_line_since(line, since_str, pattern), iter_lines(source))
+
+def modified_since(paths: list[str], since: date|None, mtime=os.path.getmtime) -> list[str]:
+    """
+    Drops the files last modified before since: they cannot hold newer lines.
+    """
+    if since is None:
+        return paths
+    limit: float = datetime.combine(since, datetime.min.time()).timestamp()
+    return [path for path in paths if mtime(path) >= limit]
+
+def with_last(items: Iterable) -> Iterator[tuple[object, bool]]:
+    """
+    Yields (item, is_last) pairs, looking one item ahead.
+    """
+    iterator = iter(items)
+    try:
+        previous = next(iterator)
+    except StopIteration:
+        return
+    for item in iterator:
+        yield previous, False
+        previous = item
+    yield previous, True
+
 def is_equal(smaller, bigger):
     return smaller == bigger
 
@@ -145,19 +282,36 @@ def rename_files_sequentially(file_list: list[Path]) -> None:
 
 def is_old(file: Path) -> bool:
     if file.exists():
-        if file.suffix == ".old":
+        if Path(plain_name(file.name)).suffix == ".old":
             return True
         return False
     else:
         print(f"Warning: file {file} does not exists!")
         exit(1)
 
-def run_containment(files_list: list[Path]) -> bool:
-    
+def plan_containment(files_list: list[Path], sources: dict[Path, Path]|None = None) -> list[Path]:
+    """
+    Runs the containment passes without touching the disk and returns the
+    files of files_list that would be deleted.
+    Files not yet materialized can be given in sources, mapping their final
+    path to the file holding their content (e.g. the .stversions/ original).
+    """
+    sources = sources or {}
+    contents: dict[Path, bytes] = {}
+
+    def read(path: Path) -> bytes:
+        # compressed rotations are compared by their content
+        if path not in contents:
+            with open_compressed(sources.get(path, path), "rb") as f:
+                contents[path] = f.read()
+        return contents[path]
+
+    remaining: list[Path] = [p for p in files_list if sources.get(p, p).is_file()]
+    deleted: list[Path] = []
     keep_containing = True
     while keep_containing:
 
-        files_with_sizes: list[tuple[Path, int]] = [(p, p.stat().st_size) for p in files_list if p.is_file()]
+        files_with_sizes: list[tuple[Path, int]] = [(p, len(read(p))) for p in remaining]
 
         # Sort by size (descending)
         files_sorted = sorted(files_with_sizes, key=lambda x: x[0], reverse=True)
@@ -168,35 +322,79 @@ def run_containment(files_list: list[Path]) -> bool:
             for small_file in reversed(files_sorted):
                 if small_file is big_file:
                     break #stop when reaching the same file
-                with open(small_file[0], "rb") as f1, open(big_file[0], "rb") as f2:
-                    small = f1.read()
-                    big = f2.read()
-                    if is_equal(small, big):
-                        if is_old(big_file[0]): 
-                            # big_file is a .old file. 
-                            # It could be:
-                            # history.old or
-                            # history~YYYYMMDD-hhmmss.old file copied from .stversions/
-                            # It will be kept, and small file deleted
-                            print(f"{colored(small_file[0].name, 'red', attrs=['bold'])} will be deleted (equal to {colored(big_file[0].name, 'green', attrs=['bold'])})")
-                            to_be_deleted.add(small_file)
-                        else: 
-                            # big_file is not a .old file. 
-                            # It could be: 
-                            # history or 
-                            # history.n or 
-                            # history.old.n or 
-                            # history~YYYYMMDD-hhmmss file copied from .stversions/
-                            print(f"{colored(big_file[0].name, 'red', attrs=['bold'])} will be deleted (equal to {colored(small_file[0].name, 'green', attrs=['bold'])})")
-                            to_be_deleted.add(big_file)
-
-                    elif is_contained(small, big):
-                        print(f"{colored(small_file[0].name, 'red', attrs=['bold'])} will be deleted (contained in {colored(big_file[0].name, 'green', attrs=['bold'])})")
+                small = read(small_file[0])
+                big = read(big_file[0])
+                if is_equal(small, big):
+                    if is_old(sources.get(big_file[0], big_file[0])): 
+                        # big_file is a .old file. 
+                        # It could be:
+                        # history.old or
+                        # history~YYYYMMDD-hhmmss.old file copied from .stversions/
+                        # It will be kept, and small file deleted
+                        print(f"{colored(small_file[0].name, 'red', attrs=['bold'])} will be deleted (equal to {colored(big_file[0].name, 'green', attrs=['bold'])})")
                         to_be_deleted.add(small_file)
+                    else: 
+                        # big_file is not a .old file. 
+                        # It could be: 
+                        # history or 
+                        # history.n or 
+                        # history.old.n or 
+                        # history~YYYYMMDD-hhmmss file copied from .stversions/
+                        print(f"{colored(big_file[0].name, 'red', attrs=['bold'])} will be deleted (equal to {colored(small_file[0].name, 'green', attrs=['bold'])})")
+                        to_be_deleted.add(big_file)
+
+                elif is_contained(small, big):
+                    print(f"{colored(small_file[0].name, 'red', attrs=['bold'])} will be deleted (contained in {colored(big_file[0].name, 'green', attrs=['bold'])})")
+                    to_be_deleted.add(small_file)
                         
         if not to_be_deleted:
             keep_containing = False
         else:
             for file_tuple in to_be_deleted:
-                file_tuple[0].unlink()
-                files_list.remove(file_tuple[0])
+                remaining.remove(file_tuple[0])
+                deleted.append(file_tuple[0])
+
+    return deleted
+
+def run_containment(files_list: list[Path]) -> bool:
+
+    for path in plan_containment(files_list):
+        path.unlink()
+        files_list.remove(path)
+
+# ioctl request number of FICLONE (linux/fs.h): shares the extents of a file
+# on copy-on-write filesystems (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+def materialize(source: Path, destination: Path, link_mode: str = "auto") -> str:
+    """
+    Makes the content of source available at destination, avoiding to copy
+    the data when the filesystem allows it.
+    link_mode is one of:
+      - "reflink":  copy-on-write clone of source
+      - "hardlink": new directory entry for source
+      - "copy":     plain shutil.copy2()
+      - "auto":     tries reflink, then hardlink
+    Reflink and hardlink fall back to copy when not supported.
+    Returns how the file was materialized ("reflinked", "hardlinked" or "copied").
+    """
+    if link_mode in ("auto", "reflink"):
+        try:
+            import fcntl
+            with open(source, "rb") as f_in, open(destination, "wb") as f_out:
+                fcntl.ioctl(f_out.fileno(), FICLONE, f_in.fileno())
+            shutil.copystat(source, destination)
+            return "reflinked"
+        except (ImportError, OSError):
+            if destination.exists():
+                destination.unlink()
+
+    if link_mode in ("auto", "hardlink"):
+        try:
+            os.link(source, destination)
+            return "hardlinked"
+        except OSError:
+            pass
+
+    shutil.copy2(source, destination)
+    return "copied"
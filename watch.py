@@ -0,0 +1,200 @@
+#watch.py
+import os
+import time
+import ctypes
+import ctypes.util
+import select
+import struct
+from pathlib import Path
+from typing import Callable
+from termcolor import colored
+
+from utils import is_history_file
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+# Filesystems where inotify does not see changes made by other machines
+# (/mnt/j is a drvfs/9p mount of the Syncthing share under WSL)
+NO_INOTIFY_FS = {"9p", "drvfs", "cifs", "smb3", "nfs", "nfs4", "fuse", "fuseblk", "sshfs", "fuse.sshfs"}
+
+def mount_fstype(path: Path) -> str|None:
+    """
+    Returns the filesystem type of the mount point containing path,
+    reading /proc/mounts (None if not available).
+    """
+    try:
+        with open("/proc/mounts", "r") as f:
+            mounts = [line.split() for line in f]
+    except OSError:
+        return None
+
+    path_str = str(Path(path).absolute())
+    best: tuple[str, str]|None = None
+    for fields in mounts:
+        if len(fields) < 3:
+            continue
+        mount_point = fields[1]
+        if path_str == mount_point or path_str.startswith(mount_point.rstrip("/") + "/"):
+            if best is None or len(mount_point) > len(best[0]):
+                best = (mount_point, fields[2])
+    return best[1] if best else None
+
+def supports_inotify(path: Path) -> bool:
+    if not hasattr(select, "poll") or ctypes.util.find_library("c") is None:
+        return False
+    return mount_fstype(path) not in NO_INOTIFY_FS
+
+class Inotify:
+    """
+    Minimal ctypes binding to the Linux inotify API.
+    """
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.dirs: dict[int, str] = {}
+
+    def add_watch(self, directory: str) -> None:
+        if directory in self.dirs.values():
+            return
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(directory), WATCH_MASK)
+        if wd >= 0:
+            self.dirs[wd] = directory
+
+    def add_file_watches(self, files: list[str]) -> None:
+        # watch the directory of each file and its parent, where new
+        # user directories get created
+        for path in files:
+            self.add_watch(os.path.dirname(path))
+            self.add_watch(os.path.dirname(os.path.dirname(path)))
+
+    def read(self, timeout: float|None) -> list[tuple[str, int]]:
+        """
+        Waits up to timeout seconds (forever if None) and returns the
+        (path, mask) of the events received. A queue overflow, where events
+        were lost, is returned as ("", IN_Q_OVERFLOW).
+        """
+        poller = select.poll()
+        poller.register(self.fd, select.POLLIN)
+        if not poller.poll(None if timeout is None else int(timeout * 1000)):
+            return []
+
+        events: list[tuple[str, int]] = []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return events
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+            offset += struct.calcsize("iIII")
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.append(("", mask))
+            elif wd in self.dirs:
+                events.append((os.path.join(self.dirs[wd], os.fsdecode(name)), mask))
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+def snapshot(files: list[str]) -> dict[str, tuple[int, int]]:
+    stats: dict[str, tuple[int, int]] = {}
+    for path in files:
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        stats[path] = (st.st_size, st.st_mtime_ns)
+    return stats
+
+def watch_files(discover: Callable[[], list[str]],
+                on_change: Callable[[set[str]], None],
+                interval: float = 5.0,
+                debounce: float = 2.0,
+                rediscover: float = 60.0) -> None:
+    """
+    Calls on_change with the set of changed files whenever the files returned
+    by discover change, once no further change has been seen for debounce seconds.
+      - inotify is used when the files live on a local filesystem: the process
+        sleeps until the kernel reports an event
+      - otherwise the files are polled every interval seconds comparing size and
+        mtime, and discover is called again every rediscover seconds to pick up
+        new files
+    Runs until interrupted with Ctrl-C.
+    """
+    files: list[str] = discover()
+    root = Path(os.path.commonpath(files)) if files else Path(".")
+    use_inotify = supports_inotify(root)
+    print(f"Watching {len(files)} files under {root} ({'inotify' if use_inotify else f'polling every {interval} s'})")
+
+    pending: set[str] = set()
+    last_event: float = 0.0
+
+    try:
+        if use_inotify:
+            inotify = Inotify()
+            inotify.add_file_watches(files)
+
+            while True:
+                timeout = None if not pending else max(0.0, last_event + debounce - time.monotonic())
+                for path, mask in inotify.read(timeout):
+                    if mask & IN_Q_OVERFLOW:
+                        # events were lost: every file may have changed
+                        print(f"{colored('[WARN ]', 'yellow', attrs=['bold'])} inotify queue overflow, rescanning all the files")
+                        files = discover()
+                        inotify.add_file_watches(files)
+                        pending |= set(files)
+                        last_event = time.monotonic()
+                        continue
+                    if mask & IN_ISDIR:
+                        # new user/app directories: watch whatever discover finds now
+                        inotify.add_file_watches(discover())
+                        continue
+                    if not is_history_file(os.path.basename(path)):
+                        # summaries, temporary files, editor backups...
+                        continue
+                    pending.add(path)
+                    last_event = time.monotonic()
+
+                if pending and time.monotonic() - last_event >= debounce:
+                    changed, pending = pending, set()
+                    on_change(changed)
+                    inotify.add_file_watches(discover())
+        else:
+            stats = snapshot(files)
+            last_discover = time.monotonic()
+            while True:
+                time.sleep(interval)
+                if time.monotonic() - last_discover >= rediscover:
+                    files = discover()
+                    last_discover = time.monotonic()
+
+                current = snapshot(files)
+                changed = {path for path in current.keys() | stats.keys() if current.get(path) != stats.get(path)}
+                stats = current
+                if changed:
+                    pending |= changed
+                    last_event = time.monotonic()
+
+                if pending and time.monotonic() - last_event >= debounce:
+                    changed, pending = pending, set()
+                    on_change(changed)
+                    # stats stay those taken before on_change: what changed while
+                    # it ran, and files it created, are reported at the next poll
+                    files = discover()
+                    last_discover = time.monotonic()
+    except KeyboardInterrupt:
+        print("Watch stopped.")